@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+# Load generator for sublime-ibus-agent.py.  The agent runs against the
+# stand-in ibus, glib and Xlib modules in bench/fakes and is driven over
+# its stdin/stdout protocol at fixed key rates and in one unthrottled
+# burst.  Keys go out as the plugin's KeyCollector sends them: the keys of
+# one UI tick as one process_key_events line.  Reports sustained keys/s,
+# reply latency percentiles and agent CPU time per key, each the median
+# of several runs, and compares them with a stored baseline.
+#
+#   python2 bench/bench_agent.py [--latency-us N] [--keys N] [--runs N]
+#                                [--save | --check] [--baseline FILE]
+import os
+import sys
+import json
+import time
+import threading
+import subprocess
+from collections import deque
+from optparse import OptionParser
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+
+from histogram import Histogram
+
+AGENT = join(ROOT, 'sublimeibus', 'sublime-ibus-agent.py')
+FAKES = join(ROOT, 'bench', 'fakes')
+KEYS = [ord(c) for c in 'konnichiha'] + [0xff08]
+RATES = [50, 200, 1000, None]  # keys/s, None = one burst
+TICK = 0.005  # seconds; keys within one are sent together
+BURST_BATCH = 16  # keys per line in a burst, e.g. a held key
+
+
+class AgentDriver(object):
+    def __init__(self, python, latency_us, args=()):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = FAKES
+        env['FAKE_IBUS_LATENCY_US'] = str(latency_us)
+        self.proc = subprocess.Popen([python, '-u', AGENT] + list(args),
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, env=env)
+        self.lock = threading.Condition()
+        self.sent = deque()
+        self.latency = Histogram()
+        self.replies = 0
+        self.events = []
+        thread = threading.Thread(target=self.read)
+        thread.daemon = True
+        thread.start()
+
+    def read(self):
+        for line in iter(self.proc.stdout.readline, b''):
+            now = time.time()
+            try:
+                obj = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            self.lock.acquire()
+            if obj.get('command') == 'ibus_process_key_event_cb':
+                self.latency.record((now - self.sent.popleft()) * 1e6)
+                self.replies += 1
+            else:
+                self.events.append(obj)
+            self.lock.notify_all()
+            self.lock.release()
+
+    def send(self, line):
+        self.proc.stdin.write((line + '\n').encode('utf-8'))
+        self.proc.stdin.flush()
+
+    def wait_for(self, predicate, timeout=30):
+        deadline = time.time() + timeout
+        self.lock.acquire()
+        try:
+            while not predicate():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise RuntimeError('agent did not answer in time')
+                self.lock.wait(remaining)
+        finally:
+            self.lock.release()
+
+    def has_event(self, command, *args):
+        for obj in self.events:
+            if obj.get('command') == command and obj['args'][:len(args)] == list(args):
+                return True
+        return False
+
+    def setup(self):
+        self.wait_for(lambda: self.has_event('setq', 'started'))
+        self.send('create_imcontext()')
+        self.wait_for(lambda: self.has_event('ibus_create_imcontext_cb'))
+        self.send('enable(0)')
+        self.wait_for(lambda: self.has_event('ibus_status_changed_cb', 0))
+
+    def cpu_time(self):
+        with open('/proc/%d/stat' % self.proc.pid) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / \
+            float(os.sysconf('SC_CLK_TCK'))
+
+    def batch_line(self, keys):
+        # As KeyCollector: runs of the same key as "keysym*count"
+        runs = []
+        for keyval in keys:
+            if runs and runs[-1][0] == keyval:
+                runs[-1][1] += 1
+            else:
+                runs.append([keyval, 1])
+        return 'process_key_events(0, %s)' % ' '.join(
+            '%d*%d' % (keyval, n) if n > 1 else '%d' % keyval
+            for keyval, n in runs)
+
+    def send_batch(self, keys):
+        self.lock.acquire()
+        self.sent.extend([time.time()] * len(keys))
+        self.lock.release()
+        self.send(self.batch_line(keys))
+
+    def run(self, rate, count):
+        self.latency = Histogram()
+        self.replies = 0
+        cpu = self.cpu_time()
+        start = time.time()
+        keys = [KEYS[i % len(KEYS)] for i in range(count)]
+        if rate is None:
+            lines = [self.batch_line(keys[i:i + BURST_BATCH])
+                     for i in range(0, count, BURST_BATCH)]
+            self.lock.acquire()
+            self.sent.extend([start] * count)
+            self.lock.release()
+            self.send('\n'.join(lines))
+        else:
+            # Keys pressed within one tick go out together, once the last
+            # of them is pressed
+            i = 0
+            while i < count:
+                tick_end = start + i / float(rate) + TICK
+                batch = []
+                while i < count and start + i / float(rate) < tick_end:
+                    batch.append(keys[i])
+                    i += 1
+                delay = start + (i - 1) / float(rate) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                self.send_batch(batch)
+        self.wait_for(lambda: self.replies >= count)
+        elapsed = time.time() - start
+        return {
+            'keys_per_sec': count / elapsed,
+            'p50_us': self.latency.percentile(50),
+            'p95_us': self.latency.percentile(95),
+            'p99_us': self.latency.percentile(99),
+            'max_us': self.latency.max,
+            'cpu_us_per_key': (self.cpu_time() - cpu) * 1e6 / count,
+        }
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+
+def median_result(results):
+    # Each figure on its own, so one noisy run does not decide any of them
+    return dict((key, sorted(r[key] for r in results)[len(results) // 2])
+                for key in results[0])
+
+
+def rate_name(rate):
+    return 'burst' if rate is None else '%d/s' % rate
+
+
+def check(results, baseline, tolerance):
+    failures = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if name == 'burst' and result['keys_per_sec'] < \
+                base['keys_per_sec'] * (1 - tolerance):
+            failures.append('%s: %.0f keys/s, baseline %.0f' % (
+                name, result['keys_per_sec'], base['keys_per_sec']))
+        # Near the burst rate latency is mostly queueing and swings from
+        # run to run, so it is only checked at rates with headroom.  Tail
+        # latencies are noisy on shared machines, so p95 gets 10 ms of
+        # slack on top of the relative tolerance.
+        headroom = name != 'burst' and 'burst' in results and \
+            result['keys_per_sec'] * 2 <= results['burst']['keys_per_sec']
+        for key, slack in (('p50_us', 1000), ('p95_us', 10000)):
+            if headroom and result[key] > \
+                    base[key] * (1 + tolerance) + slack:
+                failures.append('%s: %s %d us, baseline %d us' % (
+                    name, key, result[key], base[key]))
+        if result['cpu_us_per_key'] > \
+                base['cpu_us_per_key'] * (1 + tolerance) + 20:
+            failures.append('%s: %.0f us CPU/key, baseline %.0f' % (
+                name, result['cpu_us_per_key'], base['cpu_us_per_key']))
+    return failures
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--python', default=sys.executable,
+                      help='interpreter for the agent (Python 2)')
+    parser.add_option('--latency-us', type='int', default=200,
+                      help='simulated IBus engine time per key event')
+    parser.add_option('--keys', type='int', default=2000,
+                      help='keys per rate')
+    parser.add_option('--runs', type='int', default=3,
+                      help='runs per rate, of which the median is taken')
+    parser.add_option('--baseline',
+                      default=join(ROOT, 'bench', 'agent_baseline.json'))
+    parser.add_option('--save', action='store_true',
+                      help='store the results as the new baseline')
+    parser.add_option('--check', action='store_true',
+                      help='exit with status 1 on regressions')
+    parser.add_option('--tolerance', type='float', default=0.5)
+    options, args = parser.parse_args()
+
+    driver = AgentDriver(options.python, options.latency_us)
+    results = {}
+    try:
+        driver.setup()
+        for rate in RATES:
+            count = options.keys if rate is None or rate >= 200 \
+                else options.keys // 10
+            result = median_result([driver.run(rate, count)
+                                    for i in range(options.runs)])
+            results[rate_name(rate)] = result
+            print('%-6s %8.0f keys/s  p50 %6d  p95 %6d  p99 %6d  max %6d us'
+                  '  %6.0f us CPU/key' % (
+                      rate_name(rate), result['keys_per_sec'],
+                      result['p50_us'], result['p95_us'], result['p99_us'],
+                      result['max_us'], result['cpu_us_per_key']))
+    finally:
+        driver.close()
+
+    if options.save:
+        with open(options.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+        print('baseline saved to %s' % options.baseline)
+    elif options.check:
+        with open(options.baseline) as f:
+            failures = check(results, json.load(f), options.tolerance)
+        for failure in failures:
+            print('REGRESSION ' + failure)
+        if failures:
+            sys.exit(1)
+        print('no regressions against %s' % options.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Compare the agent's old exec()-per-line command intake with the drained,
+# table-dispatched CommandReader.
+#
+#   python bench/bench_command_reader.py [number_of_commands]
+import os
+import sys
+import time
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'sublimeibus'))
+
+from commandreader import CommandReader, CommandTable, \
+    integer, boolean, string, optional
+
+
+def process_key_event(id_no, keyval, modmask, backslash, pressed=None):
+    pass
+
+
+def set_cursor_location(id_no, x, y, w, h):
+    pass
+
+
+def set_surrounding_text(id_no, text, cursor_pos, anchor_pos):
+    pass
+
+
+commands = CommandTable()
+commands.register('process_key_event', process_key_event,
+                  integer, integer, integer, optional(integer),
+                  optional(boolean))
+commands.register('set_cursor_location', set_cursor_location,
+                  integer, integer, integer, integer, integer)
+commands.register('set_surrounding_text', set_surrounding_text,
+                  integer, string, integer, integer)
+
+namespace = {
+    'process_key_event': process_key_event,
+    'set_cursor_location': set_cursor_location,
+    'set_surrounding_text': set_surrounding_text,
+}
+
+# Roughly what typing produces: mostly keys, a cursor update per few keys
+MIX = [
+    'process_key_event(0, 97, 0, None, None)',
+    'process_key_event(0, 105, 0, None, None)',
+    'process_key_event(0, 65288, 0, None, None)',
+    'set_cursor_location(0, 812, 344, 0, 17)',
+    'process_key_event(0, 32, 0, None, None)',
+    'set_surrounding_text(0, "a, b", 1, 1)',
+]
+
+
+def make_input(n):
+    lines = [MIX[i % len(MIX)] for i in range(n)]
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def feed(data):
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        while data:
+            data = data[os.write(w, data):]
+        os._exit(0)
+    os.close(w)
+    return r, pid
+
+
+def run_exec(data):
+    r, pid = feed(data)
+    stdin = os.fdopen(r, 'rb')
+    count = 0
+    wakeups = 0
+    start = time.time()
+    while True:
+        wakeups += 1
+        expr = stdin.readline()
+        if not expr:
+            break
+        exec(expr.decode('utf-8'), namespace)
+        count += 1
+    elapsed = time.time() - start
+    stdin.close()
+    os.waitpid(pid, 0)
+    return count, wakeups, elapsed
+
+
+def run_table(data):
+    import select
+    r, pid = feed(data)
+    reader = CommandReader(r)
+    count = 0
+    wakeups = 0
+    start = time.time()
+    while not reader.closed:
+        select.select([r], [], [])
+        wakeups += 1
+        for line in reader.read_lines():
+            commands.dispatch(line)
+            count += 1
+    elapsed = time.time() - start
+    os.close(r)
+    os.waitpid(pid, 0)
+    return count, wakeups, elapsed
+
+
+def report(name, result):
+    count, wakeups, elapsed = result
+    print('%-6s %8d commands %8d wakeups %10.0f commands/s %7.2f us/command' %
+          (name, count, wakeups, count / elapsed, elapsed * 1e6 / count))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = make_input(n)
+    report('exec', run_exec(data))
+    report('table', run_table(data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+# Time the editor's thread spends sending commands while the agent stalls
+# for a while, as when ibus-daemon hangs: writing straight to the pipe, as
+# ProcessChat.send did, against CommandWriter, and against a CommandWriter
+# whose queue fills up during the stall.  The editor sends a key after
+# every few cursor location updates; the keys must all arrive in order,
+# the cursor updates only in their latest version.  In a full queue the
+# cursor updates are droppable and must not wait at all.
+#
+#   python bench/bench_command_writer.py
+import os
+import re
+import sys
+import time
+import threading
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+
+from async import CommandWriter
+
+STALL = 0.5
+UPDATES = 20000
+SMALL_QUEUE = 64
+
+
+def write_all(fd):
+    def write(data):
+        while data:
+            data = data[os.write(fd, data):]
+    return write
+
+
+class Agent(object):
+    # Reads nothing for STALL seconds, then everything
+    def __init__(self):
+        self.r, self.w = os.pipe()
+        self.lines = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        time.sleep(STALL)
+        data = []
+        while True:
+            chunk = os.read(self.r, 65536)
+            if not chunk:
+                break
+            data.append(chunk)
+        self.lines = b''.join(data).decode('utf-8').splitlines()
+
+
+def session(push, agent):
+    worst = 0.0
+    start = time.time()
+    for i in range(UPDATES):
+        t = time.time()
+        push('set_cursor_location(0, %d, 100, 0, 14)\n' % (i % 1000),
+             ('cursor', 0), True)
+        if i % 50 == 0:
+            push('process_key_events(0, %d)\n' % (i // 50), None, False)
+        worst = max(worst, time.time() - t)
+    return time.time() - start, worst
+
+
+def check(lines):
+    keys = [int(m.group(1)) for m in
+            (re.match(r'process_key_events\(0, (\d+)\)', l) for l in lines) if m]
+    if keys != list(range(UPDATES // 50)):
+        raise AssertionError('keys lost or reordered')
+    if lines[-1] != 'set_cursor_location(0, %d, 100, 0, 14)' % \
+            ((UPDATES - 1) % 1000):
+        raise AssertionError('latest cursor location missing')
+    return len(lines) - len(keys)
+
+
+def main():
+    agent = Agent()
+    write = write_all(agent.w)
+    total, worst = session(
+        lambda data, key, droppable: write(data.encode('utf-8')), agent)
+    os.close(agent.w)
+    agent.thread.join()
+    updates = check(agent.lines)
+    print('direct         %7.1f ms in send, worst %7.1f ms, %5d cursor '
+          'updates written' % (total * 1e3, worst * 1e3, updates))
+
+    for name, writer_args in (('CommandWriter', {}),
+                              ('full queue', {'max_pending': SMALL_QUEUE,
+                                              'block_timeout': STALL * 4})):
+        agent = Agent()
+        writer = CommandWriter(write_all(agent.w), **writer_args)
+        total, worst = session(
+            lambda data, key, droppable: writer.put(data.encode('utf-8'),
+                                                    key, droppable), agent)
+        while writer.depth() or writer.writes == 0:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        writer.stop()
+        os.close(agent.w)
+        agent.thread.join()
+        updates = check(agent.lines)
+        print('%-14s %7.1f ms in send, worst %7.1f ms, %5d cursor '
+              'updates written' % (name, total * 1e3, worst * 1e3, updates))
+        print('  ' + writer.summary())
+
+
+if __name__ == "__main__":
+    main()
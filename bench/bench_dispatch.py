@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# Compare main-thread work for agent output: the old path (one
+# sublime.set_timeout per read, decoding, JSON parsing, a new IBusCallback
+# and a getattr per message on the main thread) against the reader-thread
+# framing/parsing with one batched drain per tick.
+#
+#   python bench/bench_dispatch.py [number_of_messages]
+import sys
+import json
+import time
+import types
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'sublimeibus'))
+
+# Stand-in for the editor: set_timeout() queues callbacks that run() later
+# executes, as the UI thread would.
+sublime = types.ModuleType('sublime')
+pending = []
+sublime.set_timeout = lambda callback, delay: pending.append(callback)
+sys.modules['sublime'] = sublime
+
+from async import SynchronizationContextListener
+from host import ChatDelegate
+
+
+class OldIBusCallback(object):
+    def execute(self, command, args):
+        if hasattr(self, command):
+            getattr(self, command)(*args)
+
+    def ibus_process_key_event_cb(self, id_no, handled):
+        pass
+
+    def ibus_commit_text_cb(self, id_no, text):
+        pass
+
+    def ibus_window_geometry_cb(self, window_id, left, top, width):
+        pass
+
+
+class IBusCallback(object):
+    def __init__(self):
+        self.handlers = {}
+        for name in dir(self):
+            if not name.startswith('_') and name not in ('execute', 'handlers'):
+                self.handlers[name] = getattr(self, name)
+
+    def execute(self, command, args):
+        cb = self.handlers.get(command)
+        if cb is not None:
+            cb(*args)
+
+    def ibus_process_key_event_cb(self, id_no, handled):
+        pass
+
+    def ibus_commit_text_cb(self, id_no, text):
+        pass
+
+    def ibus_window_geometry_cb(self, window_id, left, top, width):
+        pass
+
+
+def make_reads(n, per_read):
+    events = []
+    for i in range(n):
+        if i % 3 == 2:
+            events.append({'command': 'ibus_commit_text_cb',
+                           'args': [0, u'日本語']})
+        else:
+            events.append({'command': 'ibus_process_key_event_cb',
+                           'args': [0, i % 2]})
+    lines = [(json.dumps(e) + '\n').encode('utf-8') for e in events]
+    return [b''.join(lines[i:i + per_read])
+            for i in range(0, len(lines), per_read)]
+
+
+def run_main_thread():
+    callbacks = len(pending)
+    start = time.time()
+    while pending:
+        pending.pop(0)()
+    return callbacks, time.time() - start
+
+
+def old_path(reads):
+    state = {'buf': []}
+
+    def handle_read(data):
+        buf = data.decode('utf-8')
+        while True:
+            index = buf.find('\n')
+            if index == -1:
+                state['buf'].append(buf)
+                break
+            state['buf'].append(buf[:index])
+            line = ''.join(state['buf'])
+            state['buf'] = []
+            buf = buf[index + 1:]
+            cmdobj = json.loads(line)
+            OldIBusCallback().execute(cmdobj['command'], cmdobj['args'])
+
+    for data in reads:
+        pending.append(lambda data=data: handle_read(data))
+    return run_main_thread()
+
+
+def new_path(reads):
+    callback = IBusCallback()
+
+    def on_data(data):
+        callback.execute(data['command'], data['args'])
+
+    class Agent(object):
+        def on_data(self, chat, data):
+            on_data(data)
+    chat = ChatDelegate(Agent())
+    chat.set_terminator('\n')
+    listener = SynchronizationContextListener(chat)
+    # The reader thread's share of the work is not on the main thread.  All
+    # reads land before the main thread gets to run, as in a burst.
+    for data in reads:
+        listener.on_data(None, data)
+    return run_main_thread()
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    for per_read in (1, 8, 64):
+        reads = make_reads(n, per_read)
+        for name, path in (('old', old_path), ('new', new_path)):
+            callbacks, elapsed = path(reads)
+            print('%2d msg/read %-3s %6d main-thread callbacks  '
+                  '%7.1f ms dispatch per %d messages' %
+                  (per_read, name, callbacks, elapsed * 1e3, n))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# D-Bus calls per engine cycle (IbusCycleCommand) in the agent, with the
+# old next_engine/set_engine, which listed the engines twice and asked for
+# the current engine, and with EngineRegistry.  The old path gets
+# enabled_cb's get_engine() too, as the agent did not set the engine itself.  Loads the agent in-process
+# against the fakes.
+#
+#   python2 bench/bench_engines.py
+import os
+import sys
+import imp
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+sys.path.insert(0, join(ROOT, 'bench', 'fakes'))
+
+import ibus
+
+agent = imp.load_source('agent', join(ROOT, 'sublimeibus',
+                                       'sublime-ibus-agent.py'))
+
+
+def old_set_engine(id_no, name):
+    for engine in agent.bus.list_active_engines():
+        if name == '%s' % engine.name:
+            agent.imcontexts[id_no].set_engine(engine)
+            break
+    else:
+        agent.enable(id_no)
+
+
+def old_next_engine(id_no):
+    current_engine_name = agent.imcontexts[id_no].get_engine().name
+    all_engine_names = [i.name for i in agent.bus.list_active_engines()]
+    current_engine_index = all_engine_names.index(current_engine_name)
+    try:
+        next_engine_name = all_engine_names[current_engine_index + 1]
+    except IndexError:
+        next_engine_name = all_engine_names[0]
+    old_set_engine(id_no, next_engine_name)
+
+
+def calls_per_cycle(next_engine, rounds=300):
+    start = ibus.calls['dbus']
+    for i in range(rounds):
+        next_engine(0)
+    return (ibus.calls['dbus'] - start) / float(rounds)
+
+
+def main():
+    r, w = os.pipe()
+    agent.use_client(agent.Client(r, os.open(os.devnull, os.O_WRONLY)))
+    agent.create_imcontext()
+    agent.focus_in(0)
+    # Both include the enabled signal; the fake set_engine counts its
+    # own enable() as a second call
+    old = calls_per_cycle(old_next_engine)
+    new = calls_per_cycle(agent.next_engine)
+    print('D-Bus calls per engine cycle: old %.1f, registry %.1f; '
+          'engine list refreshes: %d' %
+          (old, new, agent.engines.refreshes))
+
+
+if __name__ == "__main__":
+    main()
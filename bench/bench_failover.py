@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+# Kill the agent while keys are being typed and time how long it takes
+# until keys are answered again: with a standby agent taking over, and
+# with a cold start of a new agent.  Checks that the new agent has the
+# contexts, engines and focus of the old one, and that every key is
+# answered once, in order.  Runs against the fakes.
+#
+#   python2 bench/bench_failover.py [--rounds N]
+import os
+import sys
+import time
+import signal
+import threading
+from optparse import OptionParser
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+
+import host
+
+AGENT_DIR = join(ROOT, 'sublimeibus')
+KEYS = 20
+
+
+class Client(object):
+    def __init__(self, standby):
+        self.agent = host.Agent()
+        self.agent.register_callback(self.on_data)
+        self.cond = threading.Condition()
+        self.events = []
+        self.agent.restart(AGENT_DIR, False, standby)
+
+    def on_data(self, data):
+        if isinstance(data, dict) and 'command' in data:
+            self.cond.acquire()
+            self.events.append((time.time(), data['command'], data['args']))
+            self.cond.notify_all()
+            self.cond.release()
+
+    def wait_for(self, count, command, timeout=10):
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                found = [e for e in self.events if e[1] == command]
+                if len(found) >= count:
+                    return found
+                if time.time() > deadline:
+                    raise RuntimeError('timed out waiting for %s' % command)
+                self.cond.wait(0.01)
+        finally:
+            self.cond.release()
+
+    def clear(self):
+        self.cond.acquire()
+        del self.events[:]
+        self.cond.release()
+
+
+def session(standby):
+    c = Client(standby)
+    c.agent.push('create_imcontext()\n')
+    c.agent.push('create_imcontext()\n')
+    c.agent.push('enable(0)\n')
+    # Engines are set on the focused context, as the plugin does
+    c.agent.push('focus_in(1)\n')
+    c.agent.push('set_engine(1, "mozc-jp")\n')
+    c.agent.push('focus_out(1)\n')
+    c.agent.push('focus_in(0)\n')
+    c.wait_for(2, 'ibus_status_changed_cb')
+    time.sleep(0.5)  # the standby is up as well
+    c.clear()
+    pid = c.agent.chat.async.proc.pid
+    killed = time.time()
+    os.kill(pid, signal.SIGKILL)
+    # Typing goes on; some keys are lost with the old agent
+    for i in range(KEYS):
+        c.agent.push('process_key_events(0, %d)\n' % (0x61 + i))
+        time.sleep(0.002)
+    replies = c.wait_for(KEYS, 'ibus_process_key_event_cb')
+    commits = [e[2][1] for e in c.wait_for(KEYS, 'ibus_commit_text_cb')]
+    expected = [unichr(0xff41 + i) for i in range(KEYS)]
+    if commits != expected or len(replies) != KEYS:
+        raise AssertionError('keys lost or reordered: %r' % commits)
+    engines = dict(e[2] for e in c.events if e[1] == 'ibus_status_changed_cb')
+    if engines != {0: 'anthy', 1: 'mozc-jp'}:
+        raise AssertionError('engines not restored: %r' % engines)
+    recovery = replies[0][0] - killed
+    c.agent.stop()
+    return recovery
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rounds', type='int', default=5)
+    options, args = parser.parse_args()
+    os.environ['PYTHONPATH'] = join(ROOT, 'bench', 'fakes')
+    for standby in (False, True):
+        times = [session(standby) for i in range(options.rounds)]
+        print('%-7s kill to first answered key: median %6.1f ms, max %6.1f ms'
+              ' (%d keys in order, engines restored)' %
+              ('standby' if standby else 'cold', median(times) * 1e3,
+               max(times) * 1e3, KEYS))
+    # Let the reader threads see their agents exit
+    time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    main()
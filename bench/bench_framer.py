@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+# Check LineFramer against random split points, then compare it with the
+# old ProcessChat.handle_read over several chunk sizes and message mixes.
+#
+#   python bench/bench_framer.py
+import sys
+import json
+import time
+import random
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, join(dirname(dirname(abspath(__file__))), 'sublimeibus'))
+
+from async import LineFramer
+
+
+class OldFramer(object):
+    # ProcessChat.handle_read before LineFramer
+    def __init__(self, terminator='\n'):
+        self.terminator = terminator
+        self.received_data = []
+        self.lines = []
+
+    def feed(self, data):
+        buf = data.decode('utf-8', 'replace')
+        while True:
+            index = buf.find(self.terminator)
+            if index != -1:
+                if index > 0:
+                    self.received_data.append(buf[:index])
+                self.lines.append(''.join(self.received_data))
+                self.received_data = []
+                buf = buf[index + len(self.terminator):]
+            else:
+                self.received_data.append(buf)
+                break
+        lines, self.lines = self.lines, []
+        return lines
+
+
+def event(command, *args):
+    return json.dumps({'command': command, 'args': args}, ensure_ascii=False)
+
+
+def make_messages(kind, n):
+    if kind == 'keys':
+        return [event('ibus_process_key_event_cb', 0, i % 2)
+                for i in range(n)]
+    if kind == 'cjk':
+        text = u'日本語入力のテスト'
+        return [event('ibus_commit_text_cb', 0, text * (1 + i % 4))
+                for i in range(n)]
+    if kind == 'burst':
+        return [event('ibus_update_auxiliary_text_cb', 0,
+                      u'候補' * 2000, True)
+                for i in range(n // 100 or 1)]
+    raise ValueError(kind)
+
+
+def encode(messages):
+    return (u'\n'.join(messages) + u'\n').encode('utf-8')
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def fuzz(rounds=2000, seed=1):
+    rnd = random.Random(seed)
+    pool = (make_messages('keys', 20) + make_messages('cjk', 20) +
+            [u'', u'é中\U0001f600'])
+    for r in range(rounds):
+        messages = [rnd.choice(pool) for i in range(rnd.randint(1, 30))]
+        data = encode(messages)
+        cuts = sorted(rnd.sample(range(1, len(data)),
+                                 min(len(data) - 1, rnd.randint(0, 40))))
+        framer = LineFramer('\n')
+        got = []
+        start = 0
+        for cut in cuts + [len(data)]:
+            got += framer.feed(data[start:cut])
+            start = cut
+        if got != messages:
+            raise AssertionError('round %d: %r != %r' % (r, got, messages))
+    # Lines over max_length are dropped without losing the next one
+    framer = LineFramer('\n', max_length=10)
+    got = []
+    for piece in chunks(b'short\n' + b'x' * 50 + b'\nnext\n', 7):
+        got += framer.feed(piece)
+    if got != [u'short', u'next'] or framer.dropped != 1:
+        raise AssertionError('max_length: %r' % got)
+    print('fuzz: %d random splits OK' % rounds)
+
+
+def run(framer_class, pieces):
+    framer = framer_class('\n')
+    count = 0
+    start = time.time()
+    for piece in pieces:
+        count += len(framer.feed(piece))
+    return count, time.time() - start
+
+
+def main():
+    fuzz()
+    for kind in ('keys', 'cjk', 'burst'):
+        data = encode(make_messages(kind, 20000))
+        for size in (64, 1024, 2 ** 15):
+            pieces = chunks(data, size)
+            results = []
+            for framer_class in (OldFramer, LineFramer):
+                count, elapsed = min(run(framer_class, pieces)
+                                     for i in range(3))
+                results.append('%s %7.1f MB/s' % (
+                    framer_class.__name__, len(data) / elapsed / 1e6))
+            print('%-5s %6d-byte chunks  %s  (%d lines)' %
+                  (kind, size, '  '.join(results), count))
+
+
+if __name__ == "__main__":
+    main()
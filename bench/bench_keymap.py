@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+# Check KeyMap against the keycode lookup process_key_event used to do
+# through Display.keysym_to_keycodes(), then compare their cost per key.
+# Uses the US keymap of the fake Xlib in bench/fakes.
+#
+#   python bench/bench_keymap.py
+import sys
+import time
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+sys.path.insert(0, join(ROOT, 'bench', 'fakes'))
+
+import Xlib.X
+import Xlib.display
+from keymap import KeyMap, SHIFT_MASK
+
+
+def old_lookup(display, keyval, modmask, backslash):
+    # process_key_event before KeyMap
+    def update_keymap():
+        display._update_keymap(display.display.info.min_keycode,
+                               (display.display.info.max_keycode
+                                - display.display.info.min_keycode + 1))
+
+    if backslash:
+        keycode = display.keysym_to_keycode(backslash) - 8
+        if keycode < 0:
+            update_keymap()
+            keycode = display.keysym_to_keycode(backslash) - 8
+        return keycode, modmask
+    keycodes = display.keysym_to_keycodes(keyval)
+    if not keycodes:
+        update_keymap()
+        keycodes = display.keysym_to_keycodes(keyval) or [(0, 0)]
+    if modmask & SHIFT_MASK:
+        for keycode_tuple in keycodes:
+            if keycode_tuple[1] & 1:
+                break
+        else:
+            keycode_tuple = keycodes[0]
+    elif keyval < 0x100:
+        for keycode_tuple in keycodes:
+            if keycode_tuple[1]:
+                if keycode_tuple[1] > 1:
+                    keycode_tuple = keycodes[0]
+                break
+        else:
+            keycode_tuple = keycodes[0]
+        if keycode_tuple[1] & 1:
+            modmask |= SHIFT_MASK
+    else:
+        keycode_tuple = keycodes[0]
+    return keycode_tuple[0] - 8, modmask
+
+
+def new_lookup(keymap, keyval, modmask, backslash):
+    if backslash:
+        return keymap.first_keycode(backslash) - 8, modmask
+    keycode, modmask = keymap.lookup(keyval, modmask)
+    return keycode - 8, modmask
+
+
+class MappingEvent(object):
+    type = Xlib.X.MappingNotify
+    request = Xlib.X.MappingKeyboard
+
+
+def check(display, keymap):
+    keysyms = list(display._keymap) + [0x1234, 0xfe03]
+    cases = 0
+    for keyval in keysyms:
+        for modmask in (0, SHIFT_MASK, 4, SHIFT_MASK | 4):
+            for backslash in (0, 0x5c, 0x7c):
+                old = old_lookup(display, keyval, modmask, backslash)
+                new = new_lookup(keymap, keyval, modmask, backslash)
+                if old != new:
+                    raise AssertionError('%#x %d %#x: %r != %r' % (
+                        keyval, modmask, backslash, old, new))
+                cases += 1
+    # A new layout only shows up after MappingNotify
+    display._keymap[0x4a5] = [(250, 0)]
+    if keymap.lookup(0x4a5, 0)[0] != 0:
+        raise AssertionError('rebuilt without MappingNotify')
+    keymap.mapping_notify(MappingEvent())
+    if keymap.lookup(0x4a5, 0)[0] != 250:
+        raise AssertionError('not rebuilt on MappingNotify')
+    del display._keymap[0x4a5]
+    keymap.mapping_notify(MappingEvent())
+    print('check: %d lookups match' % cases)
+
+
+def timed(lookup, context, keys, rounds):
+    requests = Xlib.display.requests['count']
+    start = time.time()
+    for i in range(rounds):
+        for keyval, modmask in keys:
+            lookup(context, keyval, modmask, 0)
+    n = float(rounds * len(keys))
+    return ((time.time() - start) / n,
+            (Xlib.display.requests['count'] - requests) / n)
+
+
+def main():
+    display = Xlib.display.Display()
+    keymap = KeyMap(display)
+    check(display, keymap)
+    typing = [(ord(c), 0) for c in 'konnichiha'] + [(ord('K'), 0), (0xff08, 0)]
+    unmapped = [(0x4a4, 0), (0x4ab, 0)]  # kana keysyms, not in a US keymap
+    for name, keys in (('typing', typing), ('unmapped', unmapped)):
+        old = min(timed(old_lookup, display, keys, 2000) for i in range(3))
+        new = min(timed(new_lookup, keymap, keys, 2000) for i in range(3))
+        print('%-8s  keysym_to_keycodes %6.2f us/key %4.2f X req/key  '
+              'KeyMap %6.2f us/key %4.2f X req/key' %
+              (name, old[0] * 1e6, old[1], new[0] * 1e6, new[1]))
+
+
+if __name__ == "__main__":
+    main()
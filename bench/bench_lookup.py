@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Bytes the agent writes while the user walks through a candidate list:
+# the old show_lookup_table_cb, which sent the current page on every
+# update, and the revision-keyed pages of update_lookup_table_cb.  Loads
+# the agent in-process against the fakes.
+#
+#   python2 bench/bench_lookup.py
+import os
+import sys
+import imp
+import json
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+sys.path.insert(0, join(ROOT, 'bench', 'fakes'))
+
+import ibus
+
+agent = imp.load_source('agent', join(ROOT, 'sublimeibus',
+                                       'sublime-ibus-agent.py'))
+
+
+class LookupTable(object):
+    # The parts of ibus.LookupTable the agent uses
+    def __init__(self, candidates, page_size=9):
+        self.candidates = [ibus.Text(text) for text in candidates]
+        self.page_size = page_size
+        self.cursor_pos = 0
+
+    def get_number_of_candidates(self):
+        return len(self.candidates)
+
+    def get_candidate(self, index):
+        return self.candidates[index]
+
+    def get_page_size(self):
+        return self.page_size
+
+    def get_cursor_pos(self):
+        return self.cursor_pos
+
+    def get_cursor_pos_in_current_page(self):
+        return self.cursor_pos % self.page_size
+
+    def get_candidates_in_current_page(self):
+        start = self.cursor_pos - self.cursor_pos % self.page_size
+        return self.candidates[start:start + self.page_size]
+
+
+class CountingClient(agent.Client):
+    def __init__(self):
+        r, w = os.pipe()
+        agent.Client.__init__(self, r, w)
+        self.bytes = 0
+        self.messages = 0
+
+    def send(self, line):
+        self.bytes += len(line) + 1
+        self.messages += 1
+
+
+def old_update(ic, lookup_table, visible):
+    # update_lookup_table_cb and show_lookup_table_cb as they were meant to
+    # work before revisions
+    ic.lookup_table = lookup_table
+    agent.print_command('ibus_show_lookup_table_cb',
+        ic.id_no,
+        [item.text for item in ic.lookup_table.get_candidates_in_current_page()],
+        ic.lookup_table.get_cursor_pos_in_current_page())
+
+
+def walk(update, ic, candidates):
+    # Convert, step through every candidate, then convert the next segment
+    for segment in range(2):
+        table = LookupTable([u'%s候補%d' % (u'変換' * (segment + 1), i)
+                             for i in range(candidates)])
+        for cursor in range(candidates):
+            table.cursor_pos = cursor
+            update(ic, table, True)
+
+
+def main():
+    c = CountingClient()
+    agent.use_client(c)
+    agent.create_imcontext()
+    ic = agent.imcontexts[0]
+    for candidates in (9, 45, 200):
+        results = []
+        for name, update in (('page per update', old_update),
+                             ('revisions', agent.update_lookup_table_cb)):
+            c.bytes = c.messages = 0
+            walk(update, ic, candidates)
+            results.append('%s %6.1f bytes/move' %
+                           (name, c.bytes / (2.0 * candidates)))
+        print('%3d candidates: %s' % (candidates, '  '.join(results)))
+
+
+if __name__ == "__main__":
+    main()
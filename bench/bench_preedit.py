@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Check preedit.delta against random edits, then compare the bytes the
+# agent writes per preedit update during a long composition: the old
+# ibus_update_preedit_text_cb (full text and Lisp attribute strings) and
+# the delta-encoded ibus_update_preedit_cb.  Loads the agent in-process
+# against the fakes.
+#
+#   python2 bench/bench_preedit.py
+import os
+import sys
+import imp
+import json
+import random
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+sys.path.insert(0, join(ROOT, 'bench', 'fakes'))
+
+import ibus
+import preedit
+
+agent = imp.load_source('agent', join(ROOT, 'sublimeibus',
+                                       'sublime-ibus-agent.py'))
+
+KANA = u'あいうえおかきくけこさしすせそたちつてとなにぬねの漢字変換'
+
+
+class Attribute(object):
+    def __init__(self, type, value, start_index, end_index):
+        self.type = type
+        self.value = value
+        self.start_index = start_index
+        self.end_index = end_index
+
+
+class CountingClient(agent.Client):
+    def __init__(self):
+        r, w = os.pipe()
+        agent.Client.__init__(self, r, w)
+        self.bytes = 0
+        self.messages = 0
+
+    def send(self, line):
+        self.bytes += len(line) + 1
+        self.messages += 1
+
+
+def old_update(ic, text, cursor_pos, visible):
+    # update_preedit_text_cb before delta encoding
+    attrs = ['%s %d %d %d' %
+             (["nil", "'underline", "'foreground", "'background"][attr.type],
+              attr.value & 0xffffff, attr.start_index, attr.end_index)
+             for attr in text.attributes]
+    agent.print_command('ibus_update_preedit_text_cb',
+        ic.id_no, text.text.encode("utf-8"),
+        cursor_pos, visible, ' '.join(attrs))
+
+
+def fuzz(rounds=20000, seed=1):
+    rnd = random.Random(seed)
+    for r in range(rounds):
+        old = u''.join(rnd.choice(u'abあい') for i in range(rnd.randint(0, 8)))
+        new = u''.join(rnd.choice(u'abあい') for i in range(rnd.randint(0, 8)))
+        start, end, text = preedit.delta(old, new)
+        if preedit.apply(old, start, end, text) != new:
+            raise AssertionError('%r -> %r' % (old, new))
+    print('fuzz: %d random edits OK' % rounds)
+
+
+def compose(update, ic, length):
+    # Type a composition one character at a time, then convert the last
+    # two characters (a highlighted segment), as in a long sentence
+    text = u''
+    for i in range(length):
+        text += KANA[i % 25]
+        attrs = [Attribute(1, 1, 0, len(text))]
+        update(ic, ibus.Text(text, attrs), len(text), True)
+    text = text[:-2] + KANA[-4:-2]
+    attrs = [Attribute(1, 1, 0, len(text)),
+             Attribute(3, 0xc0c0c0, len(text) - 2, len(text))]
+    update(ic, ibus.Text(text, attrs), len(text), True)
+
+
+def main():
+    fuzz()
+    c = CountingClient()
+    agent.use_client(c)
+    agent.create_imcontext()
+    ic = agent.imcontexts[0]
+    for length in (10, 100, 400):
+        results = []
+        for name, update in (('full', old_update),
+                             ('delta', agent.update_preedit_text_cb)):
+            agent.clear_preedit(ic)
+            c.bytes = c.messages = 0
+            compose(update, ic, length)
+            results.append('%s %6.1f bytes/update' %
+                           (name, c.bytes / float(c.messages)))
+        print('%3d-character composition: %s' % (length, '  '.join(results)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+# Time from Agent.restart() to a ready input context, as on every plugin
+# reload: spawning a private agent over stdin/stdout, versus connecting to
+# the shared daemon.  Two clients of the daemon type at once to check that
+# their input contexts and replies stay apart.  Runs against the fakes.
+#
+#   python2 bench/bench_reload.py [--rounds N]
+import os
+import sys
+import time
+import glob
+import shutil
+import signal
+import tempfile
+import threading
+from optparse import OptionParser
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+
+import host
+
+AGENT_DIR = join(ROOT, 'sublimeibus')
+
+
+class Client(object):
+    def __init__(self):
+        self.agent = host.Agent()
+        self.agent.register_callback(self.on_data)
+        self.cond = threading.Condition()
+        self.events = []
+
+    def on_data(self, data):
+        if isinstance(data, dict) and 'command' in data:
+            self.cond.acquire()
+            self.events.append((data['command'], data['args']))
+            self.cond.notify_all()
+            self.cond.release()
+
+    def wait_for(self, command, timeout=10):
+        deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while True:
+                for event in self.events:
+                    if event[0] == command:
+                        self.events.remove(event)
+                        return event[1]
+                if time.time() > deadline:
+                    raise RuntimeError('timed out waiting for %s' % command)
+                self.cond.wait(0.05)
+        finally:
+            self.cond.release()
+
+    def restart(self, daemon):
+        start = time.time()
+        self.agent.restart(AGENT_DIR, daemon)
+        self.agent.push('create_imcontext()\n')
+        id_no = self.wait_for('ibus_create_imcontext_cb')[0]
+        return id_no, time.time() - start
+
+
+def kill_daemon(runtime_dir):
+    # The daemon outlives its clients; find it by its socket path
+    for cmdline in glob.glob('/proc/[0-9]*/cmdline'):
+        try:
+            args = open(cmdline).read().split('\0')
+        except IOError:
+            continue
+        if '--daemon' in args and any(a.startswith(runtime_dir) for a in args):
+            os.kill(int(cmdline.split('/')[2]), signal.SIGTERM)
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--rounds', type='int', default=10)
+    options, args = parser.parse_args()
+    os.environ['PYTHONPATH'] = join(ROOT, 'bench', 'fakes')
+    os.environ['XDG_RUNTIME_DIR'] = runtime_dir = tempfile.mkdtemp()
+    try:
+        for daemon in (False, True):
+            client = Client()
+            times = []
+            for i in range(options.rounds + 1):
+                times.append(client.restart(daemon)[1])
+            client.agent.stop()
+            # With the daemon, the first round also spawns it
+            print('%-7s first %7.1f ms  reload median %7.1f ms' % (
+                'daemon' if daemon else 'stdio', times[0] * 1e3,
+                median(times[1:]) * 1e3))
+
+        # Two editors sharing the daemon get their own context 0
+        a, b = Client(), Client()
+        ids = [a.restart(True)[0], b.restart(True)[0]]
+        for c, text in ((a, 'abc'), (b, 'xyz')):
+            c.agent.push('enable(0)\n')
+            c.agent.push('process_key_events(0, %s)\n' %
+                         ' '.join(str(ord(ch)) for ch in text))
+        for c in (a, b):
+            for i in range(3):
+                c.wait_for('ibus_process_key_event_cb')
+            if any(e[0] == 'ibus_process_key_event_cb' for e in c.events):
+                raise AssertionError('replies leaked between clients')
+        a.agent.stop()
+        b.agent.stop()
+        print('two clients: context ids %r, replies kept apart' % ids)
+    finally:
+        kill_daemon(runtime_dir)
+        shutil.rmtree(runtime_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
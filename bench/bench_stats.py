@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# Cost of the counters stats() reports, per command run through them,
+# and a check of their X request and D-Bus call counts against the ones
+# the fakes keep.  Ends with the stats() table and the head of a
+# profile_start()/profile_stop() report.  Loads the agent in-process
+# against the fakes.
+#
+#   python2 bench/bench_stats.py
+import os
+import sys
+import imp
+import json
+import time
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+sys.path.insert(0, join(ROOT, 'bench', 'fakes'))
+
+import ibus
+import Xlib.display
+
+agent = imp.load_source('agent', join(ROOT, 'sublimeibus',
+                                       'sublime-ibus-agent.py'))
+
+LINES = ['set_cursor_location(0, 10, 20, 2, 16)',
+         'process_key_event(0, 97, 0, 0)',
+         'focus_out(0)',
+         'focus_in(0)']
+
+
+class RecordingClient(agent.Client):
+    def __init__(self):
+        r, w = os.pipe()
+        agent.Client.__init__(self, r, w)
+        self.outbox = []
+
+    def send(self, line):
+        self.outbox.append(json.loads(line))
+
+    def take(self, command):
+        for message in self.outbox:
+            if message.get('command') == command:
+                return message['args']
+        raise AssertionError('no %s' % command)
+
+
+def dispatch(line):
+    agent.commands.dispatch(line)
+
+
+def measured(line):
+    agent.stats.measure(line.partition('(')[0], agent.commands.dispatch, line)
+
+
+def timed(run, rounds):
+    start = time.time()
+    for i in range(rounds):
+        for line in LINES:
+            run(line)
+    return (time.time() - start) / (rounds * len(LINES))
+
+
+def main():
+    client = RecordingClient()
+    agent.use_client(client)
+    agent.create_imcontext()
+    agent.enable(0)
+    # Counted calls against the fakes' own counters
+    agent.stats.reset()
+    x_start = Xlib.display.requests['count']
+    dbus_start = ibus.calls['dbus']
+    timed(measured, 100)
+    rows = agent.stats.rows()
+    for i, counter in ((3, Xlib.display.requests['count'] - x_start),
+                       (4, ibus.calls['dbus'] - dbus_start)):
+        # Signals are counted inside the commands that raise them
+        counted = sum(row[i] for row in rows if ' ' not in row[0])
+        if counted != counter:
+            raise AssertionError('counted %d, made %d' % (counted, counter))
+    print('check: X requests and D-Bus calls match the fakes')
+
+    plain = min(timed(dispatch, 2000) for i in range(3))
+    counted = min(timed(measured, 2000) for i in range(3))
+    print('dispatch %6.2f us/command  with counters %6.2f us/command  '
+          '(+%.2f us)' % (plain * 1e6, counted * 1e6,
+                          (counted - plain) * 1e6))
+
+    agent.stats.reset()
+    timed(measured, 100)
+    agent.show_stats()
+    print('%-32s %6s %10s %6s %6s' % ('', 'calls', 'ms', 'X req', 'D-Bus'))
+    for row in client.take('ibus_stats_cb')[0]:
+        print('%-32s %6d %10.3f %6d %6d' % tuple(row))
+
+    agent.profile_start()
+    timed(dispatch, 100)
+    agent.profile_stop(5)
+    report = client.take('ibus_profile_cb')[0]
+    print('\n'.join(report.splitlines()[:12]))
+
+
+if __name__ == "__main__":
+    main()
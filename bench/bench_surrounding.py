@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Keep the agent's copy of the surrounding text in step with an editor
+# buffer while typing, with an engine that deletes text before the cursor
+# the way ibus-bogo does, and with deletions reaching the editor one key
+# late so that its changes cross them.  Then compare the bytes sent per
+# key to keep the text up to date with the old query per key, which also
+# cost a round trip before the key could go to the engine.  Loads the agent in-process against the fakes.
+#
+#   python2 bench/bench_surrounding.py
+import os
+import sys
+import imp
+import json
+import random
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+sys.path.insert(0, join(ROOT, 'bench', 'fakes'))
+
+import glib
+import surrounding
+from preedit import delta
+from commandreader import quote
+
+agent = imp.load_source('agent', join(ROOT, 'sublimeibus',
+                                       'sublime-ibus-agent.py'))
+
+CHARS = 256
+TEXT = u'あいうえおかきくけこ漢字 abc\n'
+
+
+class RecordingClient(agent.Client):
+    def __init__(self):
+        r, w = os.pipe()
+        agent.Client.__init__(self, r, w)
+        self.surrounding_text = True
+        self.outbox = []
+        self.bytes = 0
+
+    def send(self, line):
+        self.bytes += len(line) + 1
+        self.outbox.append(json.loads(line))
+
+
+class Editor(object):
+    # SurroundingText of the plugin over a plain string buffer
+    def __init__(self, text, cursor):
+        self.text = text
+        self.cursor = cursor
+        self.known = None
+        self.revision = 0
+        self.bytes = 0
+
+    def push(self, line):
+        line = line.encode('utf-8')
+        self.bytes += len(line) + 1
+        agent.commands.dispatch(line)
+
+    def sync(self):
+        start, end = surrounding.window(self.cursor, len(self.text), CHARS)
+        text = self.text[start:end]
+        cursor = self.cursor - start
+        if self.known is None:
+            self.push('set_surrounding_text(0, %s, %d, %d, %d)' % (
+                quote(text), cursor, cursor, self.revision))
+        else:
+            first, last, changed = delta(self.known[0], text)
+            self.push('update_surrounding_text(0, %d, %d, %d, %s, %d, %d)' % (
+                self.revision, first, last, quote(changed), cursor, cursor))
+        self.known = (text, cursor, cursor)
+
+    def type(self, text):
+        self.text = self.text[:self.cursor] + text + self.text[self.cursor:]
+        self.cursor += len(text)
+
+    def receive(self, message):
+        command, args = message['command'], message['args']
+        if command == 'ibus_delete_surrounding_text_cb':
+            self.revision = args[1]
+            self.text, self.cursor, _ = surrounding.replay(
+                (self.text, self.cursor, self.cursor), args[2])
+            self.known = surrounding.replay(self.known, args[2])
+        elif command == 'ibus_query_surrounding_text_cb':
+            self.known = None
+            self.sync()
+        elif command == 'ibus_commit_text_cb':
+            self.type(args[1])
+
+
+def run_idle():
+    for source_id, source in sorted(glib._sources.items()):
+        if source[0] == 'idle':
+            glib._dispatch(source_id, source)
+
+
+def session(keys, seed=1):
+    rnd = random.Random(seed)
+    c = RecordingClient()
+    agent.use_client(c)
+    agent.use_surrounding_text = True
+    agent.create_imcontext()
+    ic = agent.imcontexts[0]
+    editor = Editor(TEXT * 400, len(TEXT) * 200)
+    queries = 0
+    crossed = 0
+    for i in range(keys):
+        editor.sync()
+        # The engine sees the key, sometimes replacing the last characters
+        if rnd.random() < 0.2:
+            n = rnd.randint(1, 3)
+            for j in range(n):
+                ic.emit('delete-surrounding-text', -1, 1)
+            ic.emit('commit-text', agent.ibus.Text(u'ệ' * n))
+        run_idle()
+        # Replies reach the editor after it typed another key
+        late, c.outbox = c.outbox, []
+        editor.type(rnd.choice(TEXT))
+        if rnd.random() < 0.05:
+            editor.cursor = rnd.randint(0, len(editor.text))
+        editor.sync()
+        for message in late:
+            if message['command'] == 'ibus_query_surrounding_text_cb':
+                queries += 1
+            elif message['command'] == 'ibus_delete_surrounding_text_cb':
+                crossed += 1
+            editor.receive(message)
+    run_idle()
+    for message in c.outbox:
+        editor.receive(message)
+    editor.sync()
+    start, end = surrounding.window(editor.cursor, len(editor.text), CHARS)
+    if ic.surrounding[0] != editor.text[start:end] \
+            or ic.surrounding[0] != editor.known[0] \
+            or ic.surrounding_text != ic.surrounding:
+        raise AssertionError('surrounding text out of step')
+    full = len('set_surrounding_text(0, %s, %d, %d)' % (
+        quote(editor.known[0]), CHARS, CHARS)) + 1
+    query = len(json.dumps({'command': 'ibus_query_surrounding_text_cb',
+                            'args': [0, 97, 0, None, None]})) + 1
+    print('%d keys, %d deletions crossing edits, %d resyncs: in step' %
+          (keys, crossed, queries))
+    print('query per key  %6.1f bytes/key, 1 round trip/key' % (full + query))
+    print('deltas         %6.1f bytes/key, 0 round trips/key' %
+          (float(editor.bytes) / keys))
+
+
+if __name__ == "__main__":
+    session(2000)
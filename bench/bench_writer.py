@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+# Bytes and write() calls per committed character: the old one write per
+# event with \uXXXX escapes, against the buffered client flushed once per
+# main loop iteration with raw UTF-8.  Keys go through the toy engine of
+# the fakes, which commits each key as its full-width form, and converted
+# phrases are committed on Enter.  Loads the agent in-process against the
+# fakes.
+#
+#   python2 bench/bench_writer.py
+import os
+import sys
+import imp
+import json
+import fcntl
+from os.path import join, dirname, abspath
+
+ROOT = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(ROOT, 'sublimeibus'))
+sys.path.insert(0, join(ROOT, 'bench', 'fakes'))
+
+import glib
+import ibus
+
+agent = imp.load_source('agent', join(ROOT, 'sublimeibus',
+                                       'sublime-ibus-agent.py'))
+
+writes = {'calls': 0, 'bytes': 0}
+os_write = os.write
+
+
+def counting_write(fd, data):
+    writes['calls'] += 1
+    writes['bytes'] += len(data)
+    return os_write(fd, data)
+
+
+class UnbufferedClient(agent.Client):
+    # Client.send as it was: print(json.dumps(...)) under python -u
+    def send(self, line):
+        line = json.dumps(json.loads(line))
+        agent.write_all(self.fd_out, line + '\n')
+
+
+def type_keys(text, batch):
+    # One process_key_events line per batch of keys, as the plugin sends
+    for i in range(0, len(text), batch):
+        yield text[i:i + batch], None
+
+
+def convert(phrases):
+    for phrase in phrases:
+        yield '\r', phrase
+
+
+def run(client_class, steps):
+    r, w = os.pipe()
+    fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+    c = client_class(r, w)
+    agent.use_client(c)
+    agent.create_imcontext()
+    agent.enable(0)
+    loop = glib.MainLoop()
+
+    def drain():
+        while [s for s in glib._sources.values() if s[0] == 'idle']:
+            loop.iteration()
+        try:
+            while os.read(r, 65536):
+                pass
+        except OSError:
+            pass
+
+    drain()
+    writes['calls'] = writes['bytes'] = 0
+    committed = 0
+    for keys, phrase in steps:
+        agent.use_client(c)
+        if phrase is not None:
+            agent.imcontexts[0].emit('commit-text', ibus.Text(phrase))
+            committed += len(phrase)
+        else:
+            committed += len(keys)
+        agent.process_key_events(0, [(ord(ch), 1) for ch in keys])
+        drain()
+    c.close()
+    os.close(r)
+    os.close(w)
+    return (float(writes['bytes']) / committed,
+            float(writes['calls']) / committed)
+
+
+def main():
+    os.write = counting_write
+    text = 'nihongonyuuryoku' * 64
+    phrases = [u'日本語入力', u'変換候補を選択する', u'東京'] * 100
+    for name, steps in (('1 key per line', lambda: type_keys(text, 1)),
+                        ('4 keys per line', lambda: type_keys(text, 4)),
+                        ('phrases', lambda: convert(phrases))):
+        old = run(UnbufferedClient, steps())
+        new = run(agent.Client, steps())
+        print('%-15s  per event %5.1f bytes %4.2f writes/char  '
+              'buffered %5.1f bytes %4.2f writes/char' % ((name,) + old + new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,16 @@
+NONE = 0
+KeyPress = 2
+FocusIn = 9
+FocusOut = 10
+DestroyNotify = 17
+ConfigureNotify = 22
+PropertyNotify = 28
+MappingNotify = 34
+
+FocusChangeMask = 1 << 21
+PropertyChangeMask = 1 << 22
+StructureNotifyMask = 1 << 17
+
+MappingModifier = 0
+MappingKeyboard = 1
+MappingPointer = 2
@@ -0,0 +1 @@
+WINDOW = 33
@@ -0,0 +1,3 @@
+# Stand-in for python-xlib: a single fake screen whose only client window
+# is an editor window, a US keyboard mapping, and an event queue that
+# stays empty unless a test puts events into it.
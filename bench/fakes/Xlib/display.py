@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import os
+
+from Xlib import X
+
+ROOT_ID = 0x100
+EDITOR_ID = 0x3a00003
+
+requests = {'count': 0}
+
+
+class _Reply(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Window(object):
+    def __init__(self, display, window_id):
+        self.display = display
+        self.id = window_id
+
+    def __eq__(self, other):
+        return getattr(other, 'id', other) == self.id
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.id
+
+    def _request(self):
+        self.display._request()
+
+    def change_attributes(self, **kwargs):
+        self._request()
+
+    def get_geometry(self):
+        self._request()
+        return _Reply(root=self.display.root, x=0, y=0, width=1280,
+                      height=800)
+
+    def translate_coords(self, src_window, x, y):
+        self._request()
+        return _Reply(x=x + 64, y=y + 48)
+
+    def query_tree(self):
+        self._request()
+        return _Reply(root=self.display.root, parent=self.display.root)
+
+    def get_wm_class(self):
+        self._request()
+        if self.id == EDITOR_ID:
+            return ('sublime_text', 'Sublime_text')
+        return None
+
+    def get_wm_name(self):
+        self._request()
+        return 'fake' if self.id == EDITOR_ID else None
+
+    def get_property(self, atom, type, offset, length):
+        self._request()
+        return _Reply(value=[EDITOR_ID])
+
+    def get_full_property(self, atom, type):
+        return self.get_property(atom, type, 0, 1)
+
+
+class Display(object):
+    def __init__(self, name=None):
+        self.name = name or os.environ.get('DISPLAY', ':0')
+        self.root = Window(self, ROOT_ID)
+        self.events = []
+        # Never written to: the fake server sends no events by itself
+        self._event_r, self._event_w = os.pipe()
+        self.display = _Reply(info=_Reply(min_keycode=8, max_keycode=255),
+                              request_serial=0)
+        # US layout: keycodes 10.. for printable ASCII, index 1 = shifted
+        self._keymap = {}
+        keycode = 10
+        for lower, upper in zip('`1234567890-=qwertyuiop[]\\asdfghjkl;\'zxcvbnm,./',
+                                '~!@#$%^&*()_+QWERTYUIOP{}|ASDFGHJKL:"ZXCVBNM<>?'):
+            self._keymap.setdefault(ord(lower), []).append((keycode, 0))
+            self._keymap.setdefault(ord(upper), []).append((keycode, 1))
+            keycode += 1
+        for keysym in (0x20, 0xff08, 0xff09, 0xff0d, 0xff1b, 0xff50, 0xff51,
+                       0xff52, 0xff53, 0xff54, 0xff55, 0xff56, 0xff57,
+                       0xffff):
+            self._keymap[keysym] = [(keycode, 0)]
+            keycode += 1
+
+    def _request(self):
+        requests['count'] += 1
+        self.display.request_serial += 1
+
+    def get_display_name(self):
+        return self.name
+
+    def set_error_handler(self, handler):
+        self.error_handler = handler
+
+    def fileno(self):
+        return self._event_r
+
+    def pending_events(self):
+        return len(self.events)
+
+    def next_event(self):
+        return self.events.pop(0)
+
+    def intern_atom(self, name, only_if_exists=False):
+        self._request()
+        return hash(name) & 0xffff
+
+    get_atom = intern_atom
+
+    def screen(self):
+        return _Reply(root=self.root)
+
+    def create_resource_object(self, type, resource_id):
+        return Window(self, resource_id)
+
+    def get_input_focus(self):
+        self._request()
+        return _Reply(focus=Window(self, EDITOR_ID))
+
+    def keysym_to_keycodes(self, keysym):
+        return list(self._keymap.get(keysym, []))
+
+    def keysym_to_keycode(self, keysym):
+        codes = self._keymap.get(keysym)
+        return codes[0][0] if codes else 0
+
+    def get_keyboard_mapping(self, first_keycode, count):
+        self._request()
+        mapping = [[0] * 4 for i in range(count)]
+        for keysym, codes in self._keymap.items():
+            for keycode, index in codes:
+                if first_keycode <= keycode < first_keycode + count:
+                    mapping[keycode - first_keycode][index] = keysym
+        return mapping
+
+    def refresh_keyboard_mapping(self, event):
+        pass
+
+    def _update_keymap(self, first_keycode, count):
+        self._request()
@@ -0,0 +1,6 @@
+class XError(Exception):
+    pass
+
+
+class BadWindow(XError):
+    pass
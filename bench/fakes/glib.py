@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# Stand-in for pygtk's glib module: a poll()-based main loop with glib's
+# dispatch order (I/O watches before idle callbacks).
+import os
+import sys
+import time
+import atexit
+import select
+import traceback
+
+IO_IN = select.POLLIN
+IO_PRI = select.POLLPRI
+IO_ERR = select.POLLERR
+IO_HUP = select.POLLHUP
+PRIORITY_HIGH = -100
+PRIORITY_DEFAULT = 0
+PRIORITY_DEFAULT_IDLE = 200
+
+_sources = {}
+_next_id = [1]
+
+
+def _add(source):
+    source_id = _next_id[0]
+    _next_id[0] += 1
+    _sources[source_id] = source
+    return source_id
+
+
+def io_add_watch(fd, condition, callback, *args):
+    if hasattr(fd, 'fileno'):
+        fd = fd.fileno()
+    return _add(('io', fd, condition, callback, args))
+
+
+def idle_add(callback, *args, **kwargs):
+    priority = kwargs.get('priority', PRIORITY_DEFAULT_IDLE)
+    return _add(('idle', priority, None, callback, args))
+
+
+def timeout_add(interval, callback, *args):
+    return _add(('timeout', time.time() + interval / 1000.0, interval,
+                 callback, args))
+
+
+def source_remove(source_id):
+    return _sources.pop(source_id, None) is not None
+
+
+# Like PyGObject: exceptions raised by callbacks are printed and
+# swallowed, except SystemExit, which ends the process after running the
+# exit handlers.
+def _dispatch(source_id, source, *extra):
+    kind, _, _, callback, args = source
+    try:
+        keep = callback(*(extra + args))
+    except SystemExit as e:
+        atexit._run_exitfuncs()
+        sys.stdout.flush()
+        os._exit(e.code or 0)
+    except Exception:
+        traceback.print_exc()
+        keep = True
+    if not keep:
+        _sources.pop(source_id, None)
+
+
+class MainLoop(object):
+    def __init__(self):
+        self.running = False
+
+    def quit(self):
+        self.running = False
+
+    def run(self):
+        self.running = True
+        while self.running and _sources:
+            self.iteration()
+
+    def iteration(self):
+        # Idle callbacks above the default priority go before any I/O
+        urgent = [(i, s) for i, s in sorted(_sources.items())
+                  if s[0] == 'idle' and s[1] < PRIORITY_DEFAULT]
+        if urgent:
+            for source_id, source in urgent:
+                if source_id in _sources:
+                    _dispatch(source_id, source)
+            return
+        now = time.time()
+        idle = [(i, s) for i, s in sorted(_sources.items()) if s[0] == 'idle']
+        timers = [s[1] for s in _sources.values() if s[0] == 'timeout']
+        if idle:
+            timeout = 0
+        elif timers:
+            timeout = max(0, int((min(timers) - now) * 1000))
+        else:
+            timeout = None
+        poll = select.poll()
+        watches = {}
+        for source_id, source in sorted(_sources.items()):
+            if source[0] == 'io':
+                fd, condition = source[1], source[2]
+                poll.register(fd, watches.get(fd, 0) | condition)
+                watches[fd] = watches.get(fd, 0) | condition
+        ready = dict(poll.poll(timeout)) if watches else {}
+        if not watches and timeout:
+            time.sleep(timeout / 1000.0)
+        if ready:
+            for source_id, source in sorted(_sources.items()):
+                if source[0] == 'io' and source_id in _sources:
+                    events = ready.get(source[1], 0) & source[2]
+                    if events:
+                        _dispatch(source_id, source, source[1], events)
+            return
+        for source_id, source in idle:
+            if source_id in _sources:
+                _dispatch(source_id, source)
+        now = time.time()
+        for source_id, source in sorted(_sources.items()):
+            if source[0] == 'timeout' and source[1] <= now:
+                _sources[source_id] = (source[0], now + source[2] / 1000.0) \
+                    + source[2:]
+                _dispatch(source_id, source)
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+# Stand-in for python-ibus with a toy engine: while enabled, printable keys
+# are committed as their full-width forms after FAKE_IBUS_LATENCY_US
+# microseconds of simulated engine time.
+import os
+import time
+
+from ibus import modifier
+
+_latency = int(os.environ.get('FAKE_IBUS_LATENCY_US', '0')) / 1e6
+_engines = ['anthy', 'mozc-jp', 'xkb:us::eng']
+calls = {'dbus': 0}
+
+
+def get_version():
+    return '1.4.2'
+
+
+class Text(object):
+    def __init__(self, text, attributes=()):
+        self.text = text
+        self.attributes = list(attributes)
+
+
+class EngineDesc(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class _Object(object):
+    def __init__(self):
+        self.__handlers = {}
+
+    def connect(self, signal, callback):
+        self.__handlers.setdefault(signal, []).append(callback)
+
+    def emit(self, signal, *args):
+        for callback in self.__handlers.get(signal, []):
+            callback(self, *args)
+
+
+class _Connection(object):
+    # Every method call goes through here, as with dbus-python
+    def call_blocking(self):
+        calls['dbus'] += 1
+
+    def call_async(self):
+        calls['dbus'] += 1
+
+
+_connection = _Connection()
+
+
+def _call():
+    _connection.call_blocking()
+
+
+class Bus(_Object):
+    def __init__(self):
+        super(Bus, self).__init__()
+        self.count = 0
+
+    def get_dbusconn(self):
+        return _connection
+
+    def create_input_context(self, name):
+        _call()
+        self.count += 1
+        return '/org/freedesktop/IBus/InputContext_%d' % self.count
+
+    def list_active_engines(self):
+        _call()
+        return [EngineDesc(name) for name in _engines]
+
+    def get_config(self):
+        return _Object()
+
+
+class InputContext(_Object):
+    def __init__(self, bus, path, watch_signals=False):
+        super(InputContext, self).__init__()
+        self.bus = bus
+        self.path = path
+        self.enabled = False
+        self.focused = False
+        self.engine = EngineDesc(_engines[0])
+        self.surrounding_text = None
+
+    def set_capabilities(self, caps):
+        _call()
+        self.caps = caps
+
+    def process_key_event(self, keyval, keycode, state):
+        _call()
+        if _latency:
+            time.sleep(_latency)
+        if not self.enabled:
+            return False
+        if state & modifier.RELEASE_MASK:
+            return 0x20 <= keyval < 0x7f
+        if 0x21 <= keyval < 0x7f:
+            self.emit('commit-text', Text(unichr(keyval + 0xfee0)))
+            return True
+        return False
+
+    def set_cursor_location(self, x, y, w, h):
+        _call()
+
+    def focus_in(self):
+        _call()
+        self.focused = True
+
+    def focus_out(self):
+        _call()
+        self.focused = False
+
+    def reset(self):
+        _call()
+
+    def enable(self):
+        _call()
+        self.enabled = True
+        self.emit('enabled')
+
+    def disable(self):
+        _call()
+        self.enabled = False
+        self.emit('disabled')
+
+    def is_enabled(self):
+        _call()
+        return self.enabled
+
+    def get_engine(self):
+        _call()
+        return self.engine
+
+    # As ibus-daemon, which ignores SetEngine without the focus
+    def set_engine(self, engine):
+        _call()
+        if not self.focused:
+            return
+        self.engine = engine
+        self.enable()
+
+    def needs_surrounding_text(self):
+        return False
+
+    def set_surrounding_text(self, text, cursor_pos, anchor_pos):
+        _call()
+        self.surrounding_text = (text, cursor_pos, anchor_pos)
+
+    def destroy(self):
+        _call()
@@ -0,0 +1,5 @@
+SHIFT_MASK = 1 << 0
+LOCK_MASK = 1 << 1
+CONTROL_MASK = 1 << 2
+MOD1_MASK = 1 << 3
+RELEASE_MASK = 1 << 30
@@ -1,7 +1,16 @@
 # -*- coding: utf-8 -*-
 import os
+import time
+import codecs
+import errno
+import select
+import socket
+import stat
 import subprocess
 import logging
+import threading
+from collections import deque
+from daemon import is_private
 try:
     import _thread as thread
 except ImportError:
@@ -12,10 +21,68 @@ if os.name == "nt" and not hasattr(subprocess, 'STARTF_USESHOWWINDOW'):
     subprocess.STARTF_USESHOWWINDOW = subprocess._subprocess.STARTF_USESHOWWINDOW
 
 
+class LineFramer(object):
+    # Splits a byte stream into decoded lines.  Multibyte characters may be
+    # split across reads, so decoding is incremental; incomplete lines are
+    # kept as a list of pieces and joined once, when their terminator
+    # arrives.  Lines longer than max_length are dropped.
+    def __init__(self, terminator='\n', max_length=2 ** 20, encoding='utf-8'):
+        self.terminator = terminator
+        self.max_length = max_length
+        self.decoder = codecs.getincrementaldecoder(encoding)('replace')
+        self.pieces = []
+        self.length = 0
+        self.overflow = False
+        self.dropped = 0
+
+    def feed(self, data):
+        text = self.decoder.decode(data)
+        lines = text.split(self.terminator)
+        last = lines.pop()
+        if lines:
+            if self.pieces or self.overflow:
+                self.append(lines[0])
+                lines[0] = self.take()
+            if self.max_length is not None \
+                    and (lines[0] is None
+                         or max(map(len, lines)) > self.max_length):
+                count = len(lines)
+                lines = [line for line in lines
+                         if line is not None and len(line) <= self.max_length]
+                self.dropped += count - len(lines)
+        if last:
+            self.append(last)
+        return lines
+
+    def append(self, text):
+        if self.overflow:
+            return
+        self.length += len(text)
+        if self.max_length is not None and self.length > self.max_length:
+            self.pieces = []
+            self.length = 0
+            self.overflow = True
+        else:
+            self.pieces.append(text)
+
+    def take(self):
+        if self.overflow:
+            line = None
+        else:
+            line = ''.join(self.pieces)
+        self.pieces = []
+        self.length = 0
+        self.overflow = False
+        return line
+
+
 class ProcessListener(object):
     def on_data(self, proc, data):
         pass
 
+    def on_error_data(self, proc, data):
+        self.on_data(proc, data)
+
     def on_finished(self, proc):
         pass
 
@@ -35,11 +102,8 @@ class AsyncProcess(object):
         self.proc = subprocess.Popen(arg_list, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
             stderr=subprocess.PIPE, startupinfo=startupinfo, shell=False)
 
-        if self.proc.stdout:
-            thread.start_new_thread(self.read_stdout, ())
-
-        if self.proc.stderr:
-            thread.start_new_thread(self.read_stderr, ())
+        if self.proc.stdout or self.proc.stderr:
+            thread.start_new_thread(self.read_output, ())
 
     def kill(self):
         if not self.killed:
@@ -53,29 +117,249 @@ class AsyncProcess(object):
     def exit_code(self):
         return self.proc.poll()
 
-    def read_stdout(self):
-        while True:
-            data = os.read(self.proc.stdout.fileno(), 2 ** 15)
+    def write(self, data):
+        self.proc.stdin.write(data)
+        self.proc.stdin.flush()
+
+    # A single thread serves both pipes
+    def read_output(self):
+        pipes = {}
+        for pipe in (self.proc.stdout, self.proc.stderr):
+            if pipe:
+                pipes[pipe.fileno()] = pipe
+        while pipes:
+            try:
+                readable, _, _ = select.select(list(pipes), [], [])
+            except (select.error, OSError) as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                data = os.read(fd, 2 ** 15)
+                pipe = pipes[fd]
+                if data:
+                    if self.listener:
+                        if pipe is self.proc.stdout:
+                            self.listener.on_data(self, data)
+                        else:
+                            self.listener.on_error_data(self, data)
+                else:
+                    pipe.close()
+                    del pipes[fd]
+                    if pipe is self.proc.stdout and self.listener:
+                        self.listener.on_finished(self)
+
+
+class AsyncSocket(object):
+    # AsyncProcess over a Unix socket connection.  Connecting happens on the
+    # reader thread: if nobody listens yet, spawn() is called once to start
+    # the server and connecting is retried until the timeout.  Data written
+    # before the connection is up is sent first, in order.
+    def __init__(self, path, listener, spawn=None, timeout=10):
+        self.path = path
+        self.listener = listener
+        self.spawn = spawn
+        self.timeout = timeout
+        self.sock = None
+        self.pending = []
+        self.killed = False
+        self.finished = False
+        self.lock = thread.allocate_lock()
+        thread.start_new_thread(self.read_output, ())
 
-            if data != "":
-                if self.listener:
-                    self.listener.on_data(self, data)
-            else:
-                self.proc.stdout.close()
-                if self.listener:
-                    self.listener.on_finished(self)
-                break
+    def kill(self):
+        self.lock.acquire()
+        try:
+            self.killed = True
+            self.listener = None
+            sock = self.sock
+        finally:
+            self.lock.release()
+        if sock is not None:
+            # Wakes up the reader thread, which closes the socket
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
 
-    def read_stderr(self):
-        while True:
-            data = os.read(self.proc.stderr.fileno(), 2 ** 15)
+    def poll(self):
+        return not (self.killed or self.finished)
 
-            if data != "":
-                if self.listener:
-                    self.listener.on_data(self, data)
+    def write(self, data):
+        self.lock.acquire()
+        try:
+            sock = self.sock
+            if sock is None:
+                if not self.killed:
+                    self.pending.append(data)
+                return
+        finally:
+            self.lock.release()
+        sock.sendall(data)
+
+    def connect(self):
+        deadline = time.time() + self.timeout
+        spawned = False
+        while not self.killed:
+            # Anybody else's socket could be listening to every key
+            if os.path.lexists(self.path) and \
+                    not is_private(self.path, stat.S_ISSOCK):
+                logging.getLogger('AsyncSocket').warning(
+                    'refusing socket %s: not private', self.path)
+                return None
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                return sock
+            except socket.error:
+                sock.close()
+            if self.spawn is not None and not spawned:
+                spawned = True
+                self.spawn()
+            elif time.time() > deadline:
+                break
             else:
-                self.proc.stderr.close()
+                time.sleep(0.01)
+        return None
+
+    def read_output(self):
+        sock = self.connect()
+        if sock is not None:
+            self.lock.acquire()
+            try:
+                if self.killed:
+                    sock.close()
+                    sock = None
+                else:
+                    for data in self.pending:
+                        sock.sendall(data)
+                    self.pending = []
+                    self.sock = sock
+            finally:
+                self.lock.release()
+        while sock is not None:
+            try:
+                data = sock.recv(2 ** 15)
+            except socket.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                data = b''
+            if not data:
+                sock.close()
                 break
+            listener = self.listener
+            if listener:
+                listener.on_data(self, data)
+        self.finished = True
+        listener = self.listener
+        if listener:
+            listener.on_finished(self)
+
+
+class CommandWriter(object):
+    # Writes on its own thread, so a stalled agent or a full pipe never
+    # blocks the caller.  The queue holds at most max_pending messages.  A
+    # message given a key replaces the queued one with the same key, as
+    # long as no message without a key was put after it, so messages
+    # without a key (e.g. keys) are never reordered.  When the queue is
+    # full, a droppable message (e.g. the cursor location) is dropped at
+    # once; others wait for room up to block_timeout seconds, then are
+    # dropped too, so a stalled agent cannot freeze the caller.  put()
+    # returns False for a dropped message.
+    def __init__(self, write, max_pending=1024, block_timeout=1.0):
+        self.write = write
+        self.max_pending = max_pending
+        self.block_timeout = block_timeout
+        self.queue = deque()
+        # key -> its queued entry, since the last message without a key
+        self.slots = {}
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.max_depth = 0
+        self.replaced = 0
+        self.dropped = 0
+        self.writes = 0
+        self.errors = 0
+        self.blocked_time = 0.0
+        self.write_time = 0.0
+        thread.start_new_thread(self.run, ())
+
+    def put(self, data, key=None, droppable=False):
+        self.cond.acquire()
+        try:
+            if key is not None and key in self.slots:
+                self.slots[key][1] = data
+                self.replaced += 1
+                return True
+            if len(self.queue) >= self.max_pending and not self.stopped:
+                if droppable:
+                    self.dropped += 1
+                    return False
+                start = time.time()
+                deadline = start + self.block_timeout
+                while len(self.queue) >= self.max_pending and not self.stopped:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                self.blocked_time += time.time() - start
+                if len(self.queue) >= self.max_pending and not self.stopped:
+                    self.dropped += 1
+                    return False
+            if self.stopped:
+                return False
+            entry = [key, data]
+            self.queue.append(entry)
+            if key is None:
+                self.slots.clear()
+            else:
+                self.slots[key] = entry
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.cond.notify_all()
+            return True
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def depth(self):
+        return len(self.queue)
+
+    # Everything queued is written at once
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.queue and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                entries = list(self.queue)
+                self.queue.clear()
+                self.slots.clear()
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+            start = time.time()
+            try:
+                self.write(b''.join(entry[1] for entry in entries))
+            except (IOError, OSError, socket.error, ValueError):
+                self.errors += 1
+            self.writes += 1
+            self.write_time += time.time() - start
+
+    def summary(self):
+        return ('queued: %d, max: %d, replaced: %d, dropped: %d, '
+                'writes: %d, errors: %d, blocked: %.1f ms, writing: %.1f ms' %
+                (self.depth(), self.max_depth, self.replaced, self.dropped,
+                 self.writes, self.errors, self.blocked_time * 1e3,
+                 self.write_time * 1e3))
 
 
 class SynchronizationContextListener(ProcessListener):
@@ -93,15 +377,49 @@ class SynchronizationContextListener(ProcessListener):
                 callback()
             self.sync = simple_call
 
+        self.queue = deque()
+        self.lock = thread.allocate_lock()
+        self.scheduled = False
+        self.drains = 0
         self.chat.handle_connect()
 
+    # Called on the reader thread: lines are framed and parsed there and
+    # queued, and the main thread drains the whole queue at once, so a
+    # burst costs one main-thread callback instead of one per read.
     def on_data(self, proc, data):
-        def next():
-            self.chat.handle_read(data)
-        self.sync(next)
+        self.post(self.chat.read_messages(data))
+
+    def on_error_data(self, proc, data):
+        self.post(self.chat.read_error_messages(data))
+
+    def post(self, messages):
+        if not messages:
+            return
+        self.lock.acquire()
+        try:
+            self.queue.extend(messages)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        finally:
+            self.lock.release()
+        self.sync(self.drain)
+
+    def drain(self):
+        self.lock.acquire()
+        try:
+            messages = list(self.queue)
+            self.queue.clear()
+            self.scheduled = False
+        finally:
+            self.lock.release()
+        if messages:
+            self.drains += 1
+            self.chat.handle_messages(messages)
 
     def on_finished(self, proc):
         def next():
+            self.drain()
             self.chat.handle_close()
         self.sync(next)
 
@@ -109,7 +427,10 @@ class SynchronizationContextListener(ProcessListener):
 class ProcessChat(object):
     def __init__(self):
         self.async = None
-        self.received_data = []
+        self.writer = None
+        self.max_line_length = 2 ** 20
+        self.framer = None
+        self.error_framer = None
         self.logger = logging.getLogger('ProcessChat')
 
     def start(self, cmd):
@@ -117,54 +438,66 @@ class ProcessChat(object):
         if self.async is None:
             listener = SynchronizationContextListener(self)
             self.async = AsyncProcess(cmd, listener)
+            self.writer = CommandWriter(self.async.write)
+        else:
+            raise
+
+    # Talk to a server on a Unix socket instead of a child process
+    def connect(self, path, spawn=None):
+        self.logger.debug('connect %s', path)
+        if self.async is None:
+            listener = SynchronizationContextListener(self)
+            self.async = AsyncSocket(path, listener, spawn)
+            self.writer = CommandWriter(self.async.write)
         else:
             raise
 
     def stop(self):
         if self.async is not None:
+            self.writer.stop()
             if self.async.poll():
                 self.async.kill()
             self.async = None
         else:
             raise
 
-    def send(self, data):
+    # Written by self.writer; see CommandWriter for key
+    def send(self, data, key=None, droppable=False):
         if self.async is not None:
-            return self.async.proc.stdin.write(data.encode('utf-8'))
+            return self.writer.put(data.encode('utf-8'), key, droppable)
         else:
             raise
 
-    def push(self, data):
-        self.send(data)
+    def push(self, data, key=None, droppable=False):
+        return self.send(data, key, droppable)
 
-    def handle_read(self, data):
-        buf = data.decode('utf-8')
-        terminator = self.get_terminator()
+    def read_messages(self, data):
+        return [self.parse_message(line) for line in self.framer.feed(data)]
 
-        while True:
-            index = buf.find(terminator)
-            if index != -1:
-                if index > 0:
-                    self.collect_incoming_data(buf[:index])
-                self.found_terminator()
-                buf = buf[index + len(terminator):]
-            else:
-                self.collect_incoming_data(buf)
-                break
+    def read_error_messages(self, data):
+        return self.error_framer.feed(data)
 
-    def collect_incoming_data(self, data):
-        self.received_data.append(data)
+    # Runs on the reader thread
+    def parse_message(self, line):
+        return line
+
+    # A message whose callback fails must not take the rest of the batch,
+    # key replies among them, down with it
+    def handle_messages(self, messages):
+        for message in messages:
+            try:
+                self.process_data(message)
+            except Exception:
+                self.logger.exception('process_data() failed: %r', message)
 
     def set_terminator(self, term):
         self.terminator = term
+        self.framer = LineFramer(term, self.max_line_length)
+        self.error_framer = LineFramer(term, self.max_line_length)
 
     def get_terminator(self):
         return self.terminator
 
-    def found_terminator(self):
-        self.process_data(''.join(self.received_data))
-        self.received_data = []
-
     def process_data(self, data):
         self.logger.debug('process_data() -> (%d)\n"""%s"""', len(data), data)
 
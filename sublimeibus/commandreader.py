@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import ast
+import errno
+import fcntl
+
+
+class CommandError(ValueError):
+    pass
+
+
+def set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+
+########################################################################
+# Argument decoders
+########################################################################
+
+def integer(token):
+    # base 0 accepts both "97" and "0x61"
+    return int(token, 0)
+
+
+_booleans = {'True': True, 'False': False, '1': True, '0': False}
+
+
+def boolean(token):
+    try:
+        return _booleans[token]
+    except KeyError:
+        raise CommandError('not a boolean: %s' % token)
+
+
+def string(token):
+    if token[:1] in ('"', "'"):
+        return ast.literal_eval(token)
+    return token
+
+
+def quote(text):
+    # The token string() reads back as text encoded in UTF-8.  Only
+    # quotes, backslashes and control characters are escaped, as \u
+    # escapes mean nothing in the agent's byte strings.
+    chars = []
+    for c in text:
+        if c in ('"', '\\'):
+            chars.append('\\' + c)
+        elif ord(c) < 0x20 or c == '\x7f':
+            chars.append('\\x%02x' % ord(c))
+        else:
+            chars.append(c)
+    return '"' + ''.join(chars) + '"'
+
+
+def optional(decoder):
+    def decode(token):
+        if token == 'None':
+            return None
+        return decoder(token)
+    return decode
+
+
+def key_sequence(token):
+    # "97 105 65288*3" -> [(97, 1), (105, 1), (65288, 3)]
+    keys = []
+    for item in token.split():
+        keyval, _, count = item.partition('*')
+        keys.append((int(keyval, 0), int(count) if count else 1))
+    return keys
+
+
+def split_args(text):
+    if not text.strip():
+        return []
+    if '"' not in text and "'" not in text:
+        return [arg.strip() for arg in text.split(',')]
+    # Slow path: commas may appear inside quoted strings
+    args = []
+    start = 0
+    quote = None
+    escaped = False
+    for i, c in enumerate(text):
+        if quote:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in ('"', "'"):
+            quote = c
+        elif c == ',':
+            args.append(text[start:i].strip())
+            start = i + 1
+    if quote:
+        raise CommandError('unterminated string: %s' % text)
+    args.append(text[start:].strip())
+    return args
+
+
+########################################################################
+# Dispatch table
+########################################################################
+
+class CommandTable(object):
+    def __init__(self):
+        self.commands = {}
+
+    def register(self, name, handler, *decoders):
+        self.commands[name] = (handler, decoders)
+
+    def parse(self, line):
+        name, paren, rest = line.partition('(')
+        rest = rest.rstrip()
+        if not paren or not rest.endswith(')'):
+            raise CommandError('malformed command: %s' % line)
+        name = name.strip()
+        try:
+            handler, decoders = self.commands[name]
+        except KeyError:
+            raise CommandError('unknown command: %s' % name)
+        args = split_args(rest[:-1])
+        if len(args) > len(decoders):
+            raise CommandError('too many arguments: %s' % line)
+        try:
+            args = [decode(arg) for decode, arg in zip(decoders, args)]
+        except (ValueError, SyntaxError):
+            raise CommandError('bad argument: %s' % line)
+        return handler, args
+
+    def dispatch(self, line):
+        handler, args = self.parse(line)
+        return handler(*args)
+
+
+########################################################################
+# Non-blocking line reader
+########################################################################
+
+class CommandReader(object):
+    def __init__(self, fd, chunk_size=2 ** 15):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.pending = b''
+        self.closed = False
+        set_nonblocking(fd)
+
+    def read_lines(self):
+        # Drain everything that is readable right now.  Nothing may be left
+        # in a user-space buffer, otherwise glib would consider the fd idle
+        # while complete commands are still waiting to be executed.
+        chunks = [self.pending]
+        while True:
+            try:
+                data = os.read(self.fd, self.chunk_size)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                self.closed = True
+                break
+            chunks.append(data)
+        lines = b''.join(chunks).split(b'\n')
+        self.pending = lines.pop()
+        if self.closed and self.pending:
+            lines.append(self.pending)
+            self.pending = b''
+        if str is not bytes:
+            lines = [line.decode('utf-8') for line in lines]
+        return [line.strip() for line in lines if line.strip()]
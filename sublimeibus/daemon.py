@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import stat
+import errno
+
+
+def is_private(path, kind=stat.S_ISDIR):
+    # Keys and buffer text go through the socket, so it and its directory
+    # must be ours alone: no symlink, our uid, nothing for group or others
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return False
+    return (kind(st.st_mode) and st.st_uid == os.getuid()
+            and st.st_mode & 0o077 == 0)
+
+
+def socket_path(display=None):
+    # One shared agent per user and X display.  Outside XDG_RUNTIME_DIR the
+    # socket lives in a private directory, as /tmp is world-writable.
+    if display is None:
+        display = os.environ.get('DISPLAY', '')
+    name = 'sublime-ibus-agent-%s.sock' % re.sub(r'[^\w.-]', '_', display)
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime_dir and is_private(runtime_dir):
+        return os.path.join(runtime_dir, name)
+    directory = '/tmp/sublime-ibus-%d' % os.getuid()
+    try:
+        os.mkdir(directory, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    # Someone else may have created it first
+    if not is_private(directory):
+        raise OSError(errno.EACCES, 'not a private directory', directory)
+    return os.path.join(directory, name)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import math
+
+
+class Histogram(object):
+    # HDR-style histogram of non-negative integers (microseconds here).
+    # Values are rounded down to `significant_bits` significant bits, so the
+    # relative error stays below 2 ** -(significant_bits - 1) over any range
+    # while the number of buckets only grows with the log of the maximum.
+    def __init__(self, significant_bits=7):
+        self.bits = significant_bits
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def record(self, value):
+        value = max(0, int(value))
+        if value > self.max:
+            self.max = value
+        shift = math.frexp(value)[1] - self.bits
+        if shift > 0:
+            value = (value >> shift) << shift
+        self.counts[value] = self.counts.get(value, 0) + 1
+        self.count += 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0
+        target = self.count * p / 100.0
+        seen = 0
+        for value in sorted(self.counts):
+            seen += self.counts[value]
+            if seen >= target:
+                return value
+        return self.max
+
+    def reset(self):
+        self.counts = {}
+        self.count = 0
+        self.max = 0
+
+    def summary(self):
+        return 'n=%d p50=%d p95=%d p99=%d max=%d' % (
+            self.count, self.percentile(50), self.percentile(95),
+            self.percentile(99), self.max)
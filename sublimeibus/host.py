@@ -3,44 +3,321 @@ import os
 import time
 import json
 import logging
+import threading
+import subprocess
 from os.path import join
+from collections import deque
 from async import ProcessChat
+from daemon import socket_path
+from commandreader import split_args, key_sequence, quote
 
 
 class ChatDelegate(ProcessChat):
     def __init__(self, agent=None):
         super(ChatDelegate, self).__init__()
         self.agent = agent
+        self.started = time.time()
+
+    # Runs on the reader thread, so JSON decoding stays off the main thread
+    def parse_message(self, line):
+        if line.startswith('{'):
+            try:
+                return json.loads(line)
+            except ValueError as e:
+                self.logger.debug('error: %s %r', e, line)
+        return line
 
     def process_data(self, data):
-        if self.agent is not None and self.agent.callback is not None:
-            self.agent.callback(data)
+        if self.agent is not None:
+            self.agent.on_data(self, data)
+
+    def handle_close(self):
+        if self.agent is not None:
+            self.agent.on_close(self)
+
+
+class SessionState(object):
+    # What an agent has been told and has reported, as far as it has to be
+    # told again to a new agent: settings, input contexts with their engine
+    # and focus, and the keys it has not answered yet.
+    settings = {
+        'set_key_timing': 'set_key_timing',
+        'set_inline_preedit': 'set_inline_preedit',
+        'set_candidate_popup': 'set_candidate_popup',
+        'set_surrounding_text_support': 'set_surrounding_text_support',
+        'watch_active_window': 'watch_active_window',
+        'start_focus_observation': 'focus_observation',
+        'stop_focus_observation': 'focus_observation',
+        }
+
+    def __init__(self):
+        # setting key -> latest line, in the order first seen
+        self.lines = {}
+        self.order = []
+        self.watched = []
+        # context id -> in use, as the agent's ibus_create_imcontext_cb
+        # gave them out
+        self.allocated = []
+        # ids recreated by replay(), whose callbacks are not passed on
+        self.recreated = set()
+        # context id -> engine name, focus, set_cursor_location line
+        self.engines = {}
+        self.focus = {}
+        self.cursor = {}
+        # (context id, keysym) or (None, line) of each unanswered key
+        self.keys = deque()
+
+    def pushed(self, line):
+        name, _, rest = line.strip().partition('(')
+        name = name.strip()
+        if name in self.settings:
+            key = self.settings[name]
+            if key not in self.lines:
+                self.order.append(key)
+            self.lines[key] = line
+            return
+        if name == 'process_key_events':
+            id_no, _, seq = rest.rstrip(')').partition(',')
+            for keyval, count in key_sequence(seq):
+                for i in range(count):
+                    self.keys.append((int(id_no), keyval))
+        elif name == 'process_key_event':
+            self.keys.append((None, line))
+        elif name in ('destroy_imcontext', 'focus_in', 'focus_out',
+                      'set_cursor_location', 'watch_window_geometry'):
+            id_no = int(split_args(rest.rstrip(')'))[0], 0)
+            if name == 'destroy_imcontext':
+                if id_no < len(self.allocated):
+                    self.allocated[id_no] = False
+                while self.allocated and not self.allocated[-1]:
+                    self.allocated.pop()
+                for table in (self.engines, self.focus, self.cursor):
+                    table.pop(id_no, None)
+            elif name == 'set_cursor_location':
+                self.cursor[id_no] = line
+            elif name == 'watch_window_geometry':
+                if line not in self.watched:
+                    self.watched.append(line)
+            else:
+                self.focus[id_no] = name == 'focus_in'
+
+    # False for messages only the replay asked for
+    def received(self, data):
+        if not isinstance(data, dict):
+            return True
+        command = data.get('command')
+        if command == 'ibus_create_imcontext_cb':
+            id_no = data['args'][0]
+            if id_no in self.recreated:
+                self.recreated.discard(id_no)
+                return False
+            while len(self.allocated) <= id_no:
+                self.allocated.append(False)
+            self.allocated[id_no] = True
+        elif command == 'ibus_process_key_event_cb':
+            # As in the plugin, keys ahead of the one replied to are gone
+            args = data['args']
+            keyval = args[3] if len(args) > 3 else None
+            for answered, (id_no, key) in enumerate(self.keys):
+                if keyval is None or id_no is None or key == keyval:
+                    for i in range(answered + 1):
+                        self.keys.popleft()
+                    break
+        elif command == 'ibus_status_changed_cb':
+            id_no, engine_name = data['args'][:2]
+            self.engines[id_no] = engine_name
+        return True
+
+    def replay(self):
+        lines = [self.lines[key] for key in self.order] + self.watched
+        # Contexts come back under the ids they had; contexts still being
+        # created are asked for again by the client
+        self.recreated = set(id_no for id_no, used in
+                             enumerate(self.allocated) if used)
+        lines += ['create_imcontext(%d)\n' % id_no
+                  for id_no in sorted(self.recreated)]
+        # IBus only sets the engine of a focused context, so the others
+        # get the focus for a moment, before the focused ones get it back
+        for id_no, engine_name in sorted(self.engines.items()):
+            if engine_name is not None and not self.focus.get(id_no):
+                lines += ['focus_in(%d)\n' % id_no,
+                          'set_engine(%d, %s)\n' % (id_no, quote(engine_name)),
+                          'focus_out(%d)\n' % id_no]
+        for id_no, focused in sorted(self.focus.items()):
+            if focused:
+                lines.append('focus_in(%d)\n' % id_no)
+                engine_name = self.engines.get(id_no)
+                if engine_name is not None:
+                    lines.append('set_engine(%d, %s)\n' % (
+                        id_no, quote(engine_name)))
+        lines += [line for id_no, line in sorted(self.cursor.items())]
+        # Unanswered keys in order, runs of a context as one line
+        run_id, run = None, []
+        for id_no, key in self.keys:
+            if run and (id_no is None or id_no != run_id):
+                lines.append('process_key_events(%d, %s)\n' %
+                             (run_id, ' '.join(run)))
+                run = []
+            if id_no is None:
+                lines.append(key)
+            else:
+                run_id = id_no
+                run.append('%d' % key)
+        if run:
+            lines.append('process_key_events(%d, %s)\n' %
+                         (run_id, ' '.join(run)))
+        return lines
 
 
 class Agent(object):
+    # With standby, a second agent process is kept running next to the
+    # active one.  When the active agent exits, the standby takes over at
+    # once, is told the session state again (see SessionState), and gets
+    # the keys the old agent left unanswered; a new standby is started.
+    # Without a standby, a new agent is started the same way as the old.
+    # An agent exiting within min_uptime of its start counts as a quick
+    # failure, and after max_quick_failures in a row the agent is left
+    # stopped.
+    min_uptime = 5.0
+    max_quick_failures = 3
+
     def __init__(self):
         self.chat = None
+        self.standby_chat = None
+        self.standby = False
+        self.daemon = False
         self.callback = None
+        self.state = SessionState()
+        self.lock = threading.RLock()
+        self.failovers = 0
+        self.quick_failures = 0
         self.logger = logging.getLogger('Agent')
 
     def register_callback(self, callback):
         self.callback = callback
 
-    def start(self, agent_dir):
-        self.agent_dir = agent_dir
-        if self.chat is None:
-            self.chat = ChatDelegate(self)
-            self.chat.set_terminator('\n')
-            self.chat.start(["python", "-u", join(agent_dir, "sublime-ibus-agent.py")])
+    # With daemon, connect to the agent shared by all editors of this user
+    # and display, spawning it first if it is not running.  Closing the
+    # connection only destroys this client's input contexts.  A standby
+    # agent is always a private one, and one still running is kept.  With
+    # daemon there is none: a standby per editor would undo the sharing.
+    def start(self, agent_dir, daemon=False, standby=False):
+        self.lock.acquire()
+        try:
+            self.agent_dir = agent_dir
+            self.daemon = daemon
+            self.standby = standby = standby and not daemon
+            if self.chat is None:
+                self.state = SessionState()
+                self.quick_failures = 0
+                self.chat = self.open_chat(daemon)
+            if not standby and self.standby_chat is not None:
+                self.standby_chat.stop()
+                self.standby_chat = None
+            elif standby and self.standby_chat is None:
+                self.spawn_standby()
+        finally:
+            self.lock.release()
 
-    def stop(self):
-        if self.chat is not None:
-            self.chat.stop()
-            self.chat = None
+    def command(self):
+        return ["python", "-u", join(self.agent_dir, "sublime-ibus-agent.py")]
 
-    def restart(self, agent_dir):
-        self.stop()
-        self.start(agent_dir)
+    def open_chat(self, daemon=False):
+        chat = ChatDelegate(self)
+        chat.set_terminator('\n')
+        if daemon:
+            try:
+                path = socket_path()
+            except OSError as e:
+                # No safe place for the socket; keep the agent private
+                self.logger.warning('no shared agent: %s', e)
+                daemon = False
+        if daemon:
+            chat.connect(path, lambda: self.spawn_daemon(self.command(), path))
+        else:
+            chat.start(self.command())
+        return chat
+
+    def spawn_standby(self):
+        self.logger.debug('spawn standby agent')
+        self.standby_chat = self.open_chat()
+
+    def spawn_daemon(self, command, path):
+        self.logger.debug('spawn daemon %s', path)
+        null = open(os.devnull, 'r+b')
+        try:
+            # Returns as soon as the daemon has forked itself away
+            subprocess.Popen(command + ['--daemon', '--socket', path],
+                             stdin=null, stdout=null, stderr=null,
+                             close_fds=True).wait()
+        finally:
+            null.close()
+
+    def stop(self, standby=True):
+        self.lock.acquire()
+        try:
+            if self.chat is not None:
+                self.chat.stop()
+                self.chat = None
+            if standby and self.standby_chat is not None:
+                self.standby_chat.stop()
+                self.standby_chat = None
+        finally:
+            self.lock.release()
+
+    # On every plugin reload.  The standby knows nothing of the session, so
+    # there is no need to replace it with another IBus client.
+    def restart(self, agent_dir, daemon=False, standby=False):
+        self.lock.acquire()
+        try:
+            self.stop(standby=False)
+            self.start(agent_dir, daemon, standby)
+        finally:
+            self.lock.release()
+
+    def on_data(self, chat, data):
+        # Until it takes over, the standby has nothing to say
+        if chat is self.chat:
+            if self.state.received(data) and self.callback is not None:
+                self.callback(data)
+
+    def on_close(self, chat):
+        self.lock.acquire()
+        try:
+            if chat is self.chat:
+                self.failover(time.time() - chat.started < self.min_uptime)
+            elif chat is self.standby_chat:
+                # Started again at the next failover if it did not last
+                self.standby_chat = None
+                if time.time() - chat.started >= self.min_uptime:
+                    self.spawn_standby()
+        finally:
+            self.lock.release()
+
+    def failover(self, quick):
+        self.quick_failures = self.quick_failures + 1 if quick else 0
+        if self.quick_failures > self.max_quick_failures:
+            self.logger.debug('agent keeps exiting, giving up')
+            self.stop()
+            if self.callback is not None:
+                self.callback({'command': 'error',
+                               'args': ['agent keeps exiting']})
+            return
+        self.failovers += 1
+        chat, self.standby_chat = self.standby_chat, None
+        if chat is None:
+            chat = self.open_chat(self.daemon)
+        else:
+            # Quick failures count from the takeover, not from the spawn
+            chat.started = time.time()
+        self.logger.debug('failover #%d', self.failovers)
+        self.chat = chat
+        if self.callback is not None:
+            self.callback({'command': 'ibus_agent_restarted_cb', 'args': []})
+        for line in self.state.replay():
+            chat.push(line)
+        if self.standby:
+            self.spawn_standby()
 
     def setup(self):
         self.push('list_active_engines()\n')
@@ -52,9 +329,22 @@ class Agent(object):
         # self.push('update_frame_coordinates(50331843)\n')
         # self.push('set_cursor_location(0, 100, 100, 0, 14)\n')
 
-    def push(self, data):
+    # False if the message was dropped, see CommandWriter
+    def push(self, data, key=None, droppable=False):
         self.logger.debug('push %s', repr(data))
-        self.chat.push(data)
+        self.lock.acquire()
+        try:
+            if self.chat is None:
+                return False
+            self.state.pushed(data)
+            return self.chat.push(data, key, droppable)
+        finally:
+            self.lock.release()
+
+    def writer_summary(self):
+        if self.chat is None or self.chat.writer is None:
+            return 'not running'
+        return self.chat.writer.summary()
 
     def feedkeys(self, keys):
         for k in keys:
@@ -68,14 +358,10 @@ agent = Agent()
 
 
 def on_data(data):
-    if data.find('{') != 0:
-        print('message: ' + data)
+    if isinstance(data, dict):
+        print(data)
     else:
-        try:
-            print(json.loads(data))
-        except ValueError as e:
-            print('error: ' + e)
-            print(repr(data))
+        print('message: ' + data)
 
 
 def main():
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+SHIFT_MASK = 1         # X.ShiftMask, same bit as ibus.modifier.SHIFT_MASK
+MAPPING_KEYBOARD = 1   # X.MappingKeyboard
+
+# (first keycode, keycode, extra modmask, keycode with shift) of a keysym
+# missing from the keyboard mapping
+MISSING = (0, 0, 0, 0)
+
+
+def choose_keycodes(keysym, keycodes):
+    # keycodes is [(keycode, index), ...] sorted by index, as returned by
+    # Display.keysym_to_keycodes().  Index 1 is the shifted column.
+    first = keycodes[0]
+    for shifted in keycodes:
+        if shifted[1] & 1:
+            break
+    else:
+        shifted = first
+    if keysym < 0x100:
+        for plain in keycodes:
+            if plain[1]:
+                if plain[1] > 1:
+                    plain = first
+                break
+        else:
+            plain = first
+        extra = SHIFT_MASK if plain[1] & 1 else 0
+    else:
+        plain = first
+        extra = 0
+    return (first[0], plain[0], extra, shifted[0])
+
+
+class KeyMap(object):
+    # keysym -> keycode table built from a single GetKeyboardMapping
+    # request.  It is rebuilt only when the server sends MappingNotify, so
+    # translating a key is one dict lookup without any Xlib work.
+    def __init__(self, display):
+        self.display = display
+        self.table = {}
+        self.rebuilds = 0
+        self.rebuild()
+
+    def rebuild(self):
+        info = self.display.display.info
+        first_keycode = info.min_keycode
+        count = info.max_keycode - first_keycode + 1
+        mapping = self.display.get_keyboard_mapping(first_keycode, count)
+        keycodes = {}
+        for i, keysyms in enumerate(mapping):
+            for index, keysym in enumerate(keysyms):
+                if keysym:
+                    keycodes.setdefault(keysym, []).append(
+                        (index, first_keycode + i))
+        table = {}
+        for keysym, pairs in keycodes.items():
+            pairs.sort()
+            table[keysym] = choose_keycodes(
+                keysym, [(keycode, index) for index, keycode in pairs])
+        self.table = table
+        self.rebuilds += 1
+
+    def mapping_notify(self, event):
+        # Keep Xlib's own keymap in sync too
+        self.display.refresh_keyboard_mapping(event)
+        if event.request == MAPPING_KEYBOARD:
+            self.rebuild()
+
+    def first_keycode(self, keysym):
+        return self.table.get(keysym, MISSING)[0]
+
+    def lookup(self, keysym, modmask):
+        # Returns (keycode, modmask); shift is added to modmask when the
+        # keysym is only reachable from the shifted column.
+        entry = self.table.get(keysym, MISSING)
+        if modmask & SHIFT_MASK:
+            return entry[3], modmask
+        return entry[1], modmask | entry[2]
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+
+
+def strip_comments(text):
+    # .sublime-settings files are JSON with // and /* */ comments.  Keys such
+    # as "/" may contain comment markers, so strings are skipped verbatim.
+    result = []
+    i = 0
+    start = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if c == '"':
+            i += 1
+            while i < length and text[i] != '"':
+                if text[i] == '\\':
+                    i += 1
+                i += 1
+        elif text.startswith('//', i):
+            result.append(text[start:i])
+            i = text.find('\n', i)
+            if i < 0:
+                i = length
+            start = i
+            continue
+        elif text.startswith('/*', i):
+            result.append(text[start:i])
+            i = text.find('*/', i + 2)
+            i = length if i < 0 else i + 2
+            start = i
+            continue
+        i += 1
+    result.append(text[start:])
+    return ''.join(result)
+
+
+def strip_trailing_commas(text):
+    # Sublime accepts a comma before a closing bracket, json does not
+    result = []
+    i = 0
+    start = 0
+    length = len(text)
+    while i < length:
+        c = text[i]
+        if c == '"':
+            i += 1
+            while i < length and text[i] != '"':
+                if text[i] == '\\':
+                    i += 1
+                i += 1
+        elif c == ',':
+            j = i + 1
+            while j < length and text[j].isspace():
+                j += 1
+            if j < length and text[j] in '}]':
+                result.append(text[start:i])
+                start = i + 1
+        i += 1
+    result.append(text[start:])
+    return ''.join(result)
+
+
+def parse_names(text):
+    # Key names defined in the text of a settings file.  Raises ValueError
+    # if it cannot be read.
+    return list(json.loads(strip_trailing_commas(strip_comments(text))).keys())
+
+
+def read_text(path):
+    # Text of a file, or None if it does not exist.
+    if not os.path.exists(path):
+        return None
+    f = open(path, 'rb')
+    try:
+        return f.read().decode('utf-8')
+    finally:
+        f.close()
+
+
+class KeyTable(object):
+    # Compiled form of SublimeIBusKeyTable and SublimeIBusFallBackCommand.
+    #   keysyms:   key name -> keysym
+    #   fallbacks: key name -> fallback command
+    #   names:     keysym -> key name
+    #   commands:  keysym -> fallback command
+    # Several names may share a keysym ("enter" and "return"); the reverse
+    # tables prefer a name that has a fallback command, then the shortest.
+    def __init__(self, keysyms, fallbacks):
+        self.keysyms = dict(keysyms)
+        self.fallbacks = dict(fallbacks)
+        self.names = {}
+        self.commands = {}
+        ranked = sorted(self.keysyms, key=lambda name: (
+            name not in self.fallbacks, len(name), name))
+        for name in ranked:
+            keysym = self.keysyms[name]
+            if keysym in self.names:
+                continue
+            self.names[keysym] = name
+            if name in self.fallbacks:
+                self.commands[keysym] = self.fallbacks[name]
+
+    def keysym(self, name):
+        return self.keysyms.get(name)
+
+    def fallback(self, name):
+        return self.fallbacks.get(name)
+
+    def name(self, keysym):
+        return self.names.get(keysym)
+
+    def command(self, keysym):
+        return self.commands.get(keysym)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+
+def solve_edges(fractions, spans):
+    # Pixel position of every grid line of a window layout, i.e. of every
+    # entry of layout['cols'] or layout['rows'].  spans holds one
+    # (first_line, last_line, pixels) per group, with pixels None for
+    # groups that could not be measured.  Positions are propagated from the
+    # first line through the measured groups; lines no group reaches are
+    # placed by their layout fraction.
+    edges = [None] * len(fractions)
+    edges[0] = 0
+    changed = True
+    while changed:
+        changed = False
+        for first, last, pixels in spans:
+            if pixels is None:
+                continue
+            if edges[first] is not None and edges[last] is None:
+                edges[last] = edges[first] + pixels
+                changed = True
+            elif edges[last] is not None and edges[first] is None:
+                edges[first] = edges[last] - pixels
+                changed = True
+    if None in edges:
+        scale = 0
+        for i in range(len(edges) - 1, 0, -1):
+            if edges[i] is not None and fractions[i] > 0:
+                scale = edges[i] / float(fractions[i])
+                break
+        for i, edge in enumerate(edges):
+            if edge is None:
+                edges[i] = int(fractions[i] * scale)
+    return edges
+
+
+class GroupLayout(object):
+    # Pixel offsets of the groups of one window, built from
+    # window.get_layout() so that irregular layouts (groups spanning several
+    # cells) work too.  Group sizes are set one by one and the offsets are
+    # recomputed lazily, only after a size actually changed.
+    def __init__(self, layout):
+        self.cols = layout['cols']
+        self.rows = layout['rows']
+        self.cells = layout['cells']
+        self.widths = [None] * len(self.cells)
+        self.heights = [None] * len(self.cells)
+        self.x_edges = None
+        self.y_edges = None
+
+    def set_group_size(self, group, width, height):
+        if self.widths[group] != width or self.heights[group] != height:
+            self.widths[group] = width
+            self.heights[group] = height
+            self.x_edges = None
+            self.y_edges = None
+
+    def solve(self):
+        if self.x_edges is None:
+            self.x_edges = solve_edges(
+                self.cols, [(cell[0], cell[2], width)
+                            for cell, width in zip(self.cells, self.widths)])
+            self.y_edges = solve_edges(
+                self.rows, [(cell[1], cell[3], height)
+                            for cell, height in zip(self.cells, self.heights)])
+
+    def offset(self, group):
+        self.solve()
+        cell = self.cells[group]
+        return (self.x_edges[cell[0]], self.y_edges[cell[1]])
+
+    def total_width(self):
+        self.solve()
+        return self.x_edges[-1]
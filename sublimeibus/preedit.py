@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+
+# Preedit attribute types, indexed by IBusAttrType
+ATTRIBUTE_TYPES = [None, 'underline', 'foreground', 'background']
+
+
+def delta(old, new):
+    # (start, end, text) with old[:start] + text + old[end:] == new, leaving
+    # out the common prefix and suffix, so an edit at the end of a long
+    # composition only carries the edited characters.
+    limit = min(len(old), len(new))
+    start = 0
+    while start < limit and old[start] == new[start]:
+        start += 1
+    limit -= start
+    tail = 0
+    while tail < limit and old[-1 - tail] == new[-1 - tail]:
+        tail += 1
+    return start, len(old) - tail, new[start:len(new) - tail]
+
+
+def apply(old, start, end, text):
+    return old[:start] + text + old[end:]
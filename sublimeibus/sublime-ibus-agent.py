@@ -86,16 +86,127 @@
 
 # Code:
 
-import sys
+import os
+import time
 import glib
 import json
+import errno
+import atexit
+import select
+import socket
+import stat
 
 import ibus
 from ibus import modifier
 
+from commandreader import CommandReader, CommandTable, CommandError, \
+    integer, boolean, string, optional, key_sequence
+from keymap import KeyMap
+from daemon import socket_path, is_private
+import preedit
+import surrounding
+
+
+########################################################################
+# Clients
+########################################################################
+
+def write_all(fd, data):
+    while data:
+        try:
+            data = data[os.write(fd, data):]
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno != errno.EAGAIN:
+                raise
+            select.select([], [fd], [])
+
+class Client(object):
+    # An editor talking to the agent, either over stdin/stdout or over a
+    # connection to the daemon socket.  Each client has its own input
+    # contexts, numbered from 0, and its own output.  Output is collected
+    # during a main loop iteration and written at once at the start of the
+    # next one.
+    def __init__(self, fd_in, fd_out, sock=None):
+        self.reader = CommandReader(fd_in)
+        self.fd_out = fd_out
+        self.sock = sock
+        self.pending = []
+        self.imcontexts = []
+        self.sources = []
+        self.closed = False
+        # Whether the editor draws preedit text and candidates itself
+        self.inline_preedit = False
+        self.candidate_popup = False
+        # Whether the editor keeps the surrounding text up to date
+        self.surrounding_text = False
+
+    def send(self, line):
+        if self.closed:
+            return
+        if not self.pending:
+            glib.idle_add(self.flush, priority=glib.PRIORITY_HIGH)
+        self.pending.append(line)
+
+    def flush(self):
+        if self.pending and not self.closed:
+            data = '\n'.join(self.pending) + '\n'
+            del self.pending[:]
+            try:
+                write_all(self.fd_out, data)
+            except OSError:
+                if self.sock is None:
+                    raise
+                self.close()
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for source in self.sources:
+            glib.source_remove(source)
+        for ic in self.imcontexts:
+            if ic:
+                ic.destroy()
+        del self.imcontexts[:]
+        if self in clients:
+            clients.remove(self)
+        if self.sock is not None:
+            self.sock.close()
+
+# The client whose commands are being executed, or who owns the input
+# context whose signal is being handled.  imcontexts is its list.
+client = Client(0, 1)
+clients = [client]
+imcontexts = client.imcontexts
+
+def use_client(c):
+    global client, imcontexts
+    client = c
+    imcontexts = c.imcontexts
+
+# Messages said before exiting still reach the client
+@atexit.register
+def flush_clients():
+    for c in list(clients):
+        c.flush()
+
+# Text goes out as raw UTF-8, half the size of \uXXXX escapes for CJK.
+# Callbacks pass text as unicode; byte strings are only expected to be
+# ASCII, else everything is escaped.
+def encode(dic):
+    try:
+        line = json.dumps(dic, ensure_ascii=False)
+    except UnicodeDecodeError:
+        return json.dumps(dic)
+    if isinstance(line, unicode):
+        line = line.encode('utf-8')
+    return line
 
 def printj(dic):
-    print(json.dumps(dic))
+    client.send(encode(dic))
 
 def print_command(command, *args):
     printj({'command': command, 'args': args})
@@ -103,6 +214,12 @@ def print_command(command, *args):
 def print_message(message):
     printj({'message': message})
 
+# X events concern every client
+def broadcast_command(command, *args):
+    line = encode({'command': command, 'args': args})
+    for c in list(clients):
+        c.send(line)
+
 
 ########################################################################
 # Process command line option
@@ -110,6 +227,8 @@ def print_message(message):
 
 start_ibus_daemon = True
 use_surrounding_text = False
+surrounding_text_default = False
+daemon_socket = None
 
 if __name__ == "__main__":
 
@@ -121,13 +240,30 @@ if __name__ == "__main__":
     parser.add_option("-s", "--surrounding-text",
                       action="store_true", dest="surrounding_text", default=False,
                       help="enable surrounding text support")
+    parser.add_option("-d", "--daemon",
+                      action="store_true", dest="daemon", default=False,
+                      help="serve clients on a per-user socket")
+    parser.add_option("--socket", dest="socket", default=None,
+                      help="socket path of the daemon")
     options, args = parser.parse_args()
     if options.quit:
         start_ibus_daemon = False
-    if options.surrounding_text \
-            and map(int, ibus.get_version().split(".")) >= [1, 4, 0]:
+    if options.daemon:
+        daemon_socket = options.socket or socket_path()
+        # The spawning editor only waits for this fork to return
+        if os.fork():
+            os._exit(0)
+        os.setsid()
+        null = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(null, fd)
+        del clients[:]
+    # Clients ask for surrounding text with set_surrounding_text_support()
+    if map(int, ibus.get_version().split(".")) >= [1, 4, 0]:
         use_surrounding_text = True
-        print_message('Surrounding text support enabled')
+        if options.surrounding_text:
+            surrounding_text_default = client.surrounding_text = True
+            print_message('Surrounding text support enabled')
 
 ########################################################################
 # Setup Xlib
@@ -135,6 +271,7 @@ if __name__ == "__main__":
 
 try:
     import Xlib.display
+    import Xlib.error
     import Xlib.X
     import Xlib.Xatom
 except ImportError:
@@ -151,8 +288,31 @@ class Frame(object):
         self.left = 0
         self.top = 0
         self.focus = None
-        self.focus_cb_id = None
+        self.observing_focus = False
+        self.focus_in = None
+        self.focus_out = None
+        self.active_window_changed = False
+        self.active_window_watched = False
+        # Per-window event masks, since change_attributes() replaces the
+        # whole mask selected by this client
+        self.event_masks = {}
+        # Windows whose geometry is pushed to the client, and the last
+        # (left, top, width) sent for each of them
+        self.geometry_windows = {}
+        self.geometries = {}
+        self.net_active_window = display.intern_atom('_NET_ACTIVE_WINDOW')
+        self.active_window_id = None
+        self.event_handlers = {
+            Xlib.X.PropertyNotify: self.__property_notify_cb,
+            Xlib.X.FocusIn: self.__focus_in_cb,
+            Xlib.X.FocusOut: self.__focus_out_cb,
+            Xlib.X.ConfigureNotify: self.__configure_notify_cb,
+            Xlib.X.DestroyNotify: self.__destroy_notify_cb,
+            # Sent to every client, no event mask needed
+            Xlib.X.MappingNotify: self.__mapping_notify_cb,
+        }
         display.set_error_handler(self.__error_handler)
+        glib.io_add_watch(display.fileno(), glib.IO_IN, self.__display_cb)
 
     # When the active window vanishes, focus.query_tree() etc. may cause
     # BadWIndow error unwantedly.  This handler quiets all Xlib's errors,
@@ -160,30 +320,128 @@ class Frame(object):
     def __error_handler(self, error, request):
         print_command('error', error)
 
-    def __update_focus_cb(self, command, sync=False):
-        # Check FocusIn/FocusOut events
-        if self.focus:
-            focus_in = None
-            focus_out = None
-            for i in range(display.pending_events()):
-                event = display.next_event()
-                if event.type == Xlib.X.FocusIn:
-                    focus_in = event.window
-                elif event.type == Xlib.X.FocusOut:
-                    focus_out = event.window
-            if focus_in == self.focus:
-                if focus_out != self.focus:
-                    # This is ugly workaround, but necessary to avoid a
-                    # problem that the language bar doesn't appear after
-                    # moving to other workspace in Ubuntu Unity desktop.
-                    # If old version of ibus.el which doesn't define
-                    # `ibus-redo-focus-in-cb' is running on Emacs, the
-                    # following message will just be ignored and take no effect.
-                    print_command('ibus_redo_focus_in_cb')
-                if sync:
-                    print_command(command, focus_in.id)
-                return True
-        # Main part
+    def __display_cb(self, fd, condition):
+        self.process_events()
+        return True
+
+    # Xlib may already have queued events while waiting for a reply, and
+    # then the fd watch won't fire for them, so this is also called after
+    # each batch of client commands.
+    def process_events(self):
+        # Handlers make requests of their own, which may queue more events
+        while True:
+            count = self.display.pending_events()
+            if not count:
+                break
+            for i in range(count):
+                event = self.display.next_event()
+                handler = self.event_handlers.get(event.type)
+                if handler:
+                    handler(event)
+            if self.observing_focus:
+                self.check_focus()
+
+    def select_input(self, window, mask):
+        mask |= self.event_masks.get(window.id, 0)
+        if mask != self.event_masks.get(window.id):
+            window.change_attributes(event_mask=mask)
+            self.event_masks[window.id] = mask
+
+    def __focus_in_cb(self, event):
+        self.focus_in = event.window
+
+    def __focus_out_cb(self, event):
+        self.focus_out = event.window
+
+    def __property_notify_cb(self, event):
+        if event.atom == self.net_active_window:
+            self.active_window_changed = True
+            if self.active_window_watched:
+                self.update_active_window()
+
+    def watch_active_window(self):
+        root = self.display.screen().root
+        self.select_input(root, Xlib.X.PropertyChangeMask)
+        self.active_window_watched = True
+        self.active_window_id = None
+        self.update_active_window()
+
+    def update_active_window(self):
+        root = self.display.screen().root
+        try:
+            prop = root.get_full_property(self.net_active_window,
+                                          Xlib.Xatom.WINDOW)
+            window_id = prop.value[0] if prop and len(prop.value) else 0
+            if window_id == self.active_window_id:
+                return
+            wm_class = None
+            if window_id:
+                window = self.display.create_resource_object('window',
+                                                             window_id)
+                wm_class = window.get_wm_class()
+        except Xlib.error.XError:
+            return
+        self.active_window_id = window_id
+        broadcast_command('ibus_active_window_cb', window_id,
+                      wm_class[1] if wm_class else None)
+
+    def __configure_notify_cb(self, event):
+        if event.window.id in self.geometry_windows:
+            self.update_geometry(event.window.id)
+
+    def __destroy_notify_cb(self, event):
+        self.forget_window(event.window.id)
+
+    def __mapping_notify_cb(self, event):
+        keymap.mapping_notify(event)
+
+    def forget_window(self, window_id):
+        self.geometry_windows.pop(window_id, None)
+        self.geometries.pop(window_id, None)
+        self.event_masks.pop(window_id, None)
+
+    def watch_geometry(self, window_id):
+        if window_id not in self.geometry_windows:
+            window = self.display.create_resource_object('window', window_id)
+            self.select_input(window, Xlib.X.StructureNotifyMask)
+            self.geometry_windows[window_id] = window
+        elif window_id in self.geometries:
+            # Already watched for another client and kept up to date
+            print_command('ibus_window_geometry_cb', window_id,
+                          *self.geometries[window_id])
+            return
+        self.update_geometry(window_id)
+
+    def update_geometry(self, window_id):
+        window = self.geometry_windows[window_id]
+        try:
+            geometry = window.get_geometry()
+            origin = geometry.root.translate_coords(window, 0, 0)
+        except Xlib.error.XError:
+            self.forget_window(window_id)
+            return
+        value = (origin.x, origin.y, geometry.width)
+        if self.geometries.get(window_id) != value:
+            self.geometries[window_id] = value
+            broadcast_command('ibus_window_geometry_cb', window_id, *value)
+
+    def check_focus(self):
+        focus_in, self.focus_in = self.focus_in, None
+        focus_out, self.focus_out = self.focus_out, None
+        active_window_changed = self.active_window_changed
+        self.active_window_changed = False
+        if self.focus and focus_in == self.focus and focus_out != self.focus:
+            # This is ugly workaround, but necessary to avoid a
+            # problem that the language bar doesn't appear after
+            # moving to other workspace in Ubuntu Unity desktop.
+            # If old version of ibus.el which doesn't define
+            # `ibus-redo-focus-in-cb' is running on Emacs, the
+            # following message will just be ignored and take no effect.
+            broadcast_command('ibus_redo_focus_in_cb')
+        elif focus_in or focus_out or active_window_changed:
+            self.update_focus('ibus_focus_changed_cb')
+
+    def update_focus(self, command, sync=False):
         focus = self.display.get_input_focus().focus
         try:
             # get_input_focus() may return an integer 0 that query_tree()
@@ -195,35 +453,37 @@ class Frame(object):
                 if not (focus.get_wm_class() or focus.get_wm_name()):
                     focus = tree.parent
                 if focus != self.focus or sync:
-                    print_command(command, focus.id)
-                    focus.change_attributes(event_mask=Xlib.X.FocusChangeMask)
+                    broadcast_command(command, focus.id)
+                    self.select_input(focus, Xlib.X.FocusChangeMask)
                     self.focus = focus
-                return True
+                return
         except AttributeError:
             if sync:
-                print_command(command, 0)
-            return True
+                broadcast_command(command, 0)
+            return
         # Fallback
-        atom = display.get_atom("_NET_ACTIVE_WINDOW", True)
-        focus_id = tree.root.get_property(atom, Xlib.Xatom.WINDOW, 0, 1).value[0]
+        focus_id = tree.root.get_property(self.net_active_window,
+                                          Xlib.Xatom.WINDOW, 0, 1).value[0]
         focus = display.create_resource_object("window", focus_id)
         if focus != self.focus or sync:
-            print_command(command, focus_id)
-            focus.change_attributes(event_mask=Xlib.X.FocusChangeMask)
+            broadcast_command(command, focus_id)
+            self.select_input(focus, Xlib.X.FocusChangeMask)
             self.focus = focus
-        return True
 
     def stop_focus_observation(self):
         self.focus = None
-        if self.focus_cb_id:
-            glib.source_remove(self.focus_cb_id)
-            self.focus_cb_id = None
+        self.observing_focus = False
 
-    def start_focus_observation(self, interval):
+    # Focus changes are noticed from FocusIn/FocusOut on the focused window
+    # and from _NET_ACTIVE_WINDOW changes on the root window, so the agent
+    # never wakes up while idle.  The interval is only kept for
+    # compatibility with older clients.
+    def start_focus_observation(self, interval=None):
         self.stop_focus_observation()
-        self.__update_focus_cb('ibus_start_focus_observation_cb', True)
-        self.focus_cb_id = glib.timeout_add(interval, self.__update_focus_cb,
-                                            'ibus_focus_changed_cb')
+        root = self.display.screen().root
+        self.select_input(root, Xlib.X.PropertyChangeMask)
+        self.update_focus('ibus_start_focus_observation_cb', True)
+        self.observing_focus = True
 
     def update_coordinates(self):
         if self.window:
@@ -245,6 +505,7 @@ except:
     display = Xlib.display.Display()
 
 frame = Frame(display)
+keymap = KeyMap(display)
 
 ########################################################################
 # Connect to IBus daemon
@@ -274,6 +535,114 @@ except:
         print_command('error', 'Failed to launch ibus-daemon')
         exit(1)
 
+########################################################################
+# Active engines
+########################################################################
+
+class EngineRegistry(object):
+    # The active engines are listed once and listed again only when IBus
+    # reports a change, so no command needs a D-Bus round trip for them.
+    # Changes are pushed to every client.
+    def __init__(self, bus):
+        self.bus = bus
+        self.engines = None
+        self.by_name = {}
+        self.refreshes = 0
+        for signal in ('registry-changed', 'config-reloaded'):
+            try:
+                bus.connect(signal, self.__changed_cb)
+            except TypeError:
+                pass
+        try:
+            self.config = bus.get_config()
+            self.config.connect('value-changed', self.__value_changed_cb)
+        except (TypeError, AttributeError):
+            self.config = None
+
+    def __changed_cb(self, *args):
+        self.refresh()
+        broadcast_command('ibus_list_active_engines_cb', self.names())
+
+    def __value_changed_cb(self, config, section, name, value):
+        if section == 'general' and name in ('preload_engines',
+                                             'engines_order'):
+            self.__changed_cb()
+
+    def refresh(self):
+        self.engines = list(self.bus.list_active_engines())
+        self.by_name = dict((engine.name, engine) for engine in self.engines)
+        self.refreshes += 1
+
+    def list(self):
+        if self.engines is None:
+            self.refresh()
+        return self.engines
+
+    def names(self):
+        return [engine.name for engine in self.list()]
+
+    def find(self, name):
+        self.list()
+        return self.by_name.get(name)
+
+engines = EngineRegistry(bus)
+
+########################################################################
+# Statistics
+########################################################################
+
+class CommandStats(object):
+    # Calls, wall time, X requests and D-Bus calls per command, counted
+    # all the time.  Costs are inclusive: signals handled while a command
+    # runs count for the signal and for the command.
+    def __init__(self, display, bus):
+        self.display = display
+        self.table = {}  # name -> [calls, seconds, X requests, D-Bus calls]
+        self.dbus_calls = 0
+        # python-ibus goes through dbus-python, whose proxies look these up
+        # on the connection at each call
+        try:
+            conn = bus.get_dbusconn()
+            for name in ('call_blocking', 'call_async'):
+                setattr(conn, name, self.__counted(getattr(conn, name)))
+        except AttributeError:
+            pass
+
+    def __counted(self, method):
+        def call(*args, **kwargs):
+            self.dbus_calls += 1
+            return method(*args, **kwargs)
+        return call
+
+    def counters(self):
+        return (time.time(), self.display.display.request_serial,
+                self.dbus_calls)
+
+    def measure(self, name, function, *args):
+        start = self.counters()
+        try:
+            return function(*args)
+        finally:
+            end = self.counters()
+            row = self.table.get(name)
+            if row is None:
+                row = self.table[name] = [0, 0.0, 0, 0]
+            row[0] += 1
+            for i in range(3):
+                row[i + 1] += end[i] - start[i]
+
+    # [name, calls, milliseconds, X requests, D-Bus calls], costliest first
+    def rows(self):
+        rows = [[name, row[0], round(row[1] * 1e3, 3), row[2], row[3]]
+                for name, row in self.table.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows
+
+    def reset(self):
+        self.table.clear()
+
+stats = CommandStats(display, bus)
+
 ########################################################################
 # Input Context
 ########################################################################
@@ -285,10 +654,35 @@ class IBusELInputContext(ibus.InputContext):
         self.__path = bus.create_input_context("IBusELInputContext")
         super(IBusELInputContext, self).__init__(bus, self.__path, True)
 
+        self.client = client
         self.id_no = 0
-        self.preediting = False
+        # Name of the current engine, None until known, and the engine
+        # this agent just set, which the next 'enabled' signal is about
+        self.engine_name = None
+        self.expected_engine = None  # (name, deadline)
+        # IBus ignores SetEngine without the focus
+        self.has_focus = False
+        # Preedit as last sent to the client
+        self.preedit_text = u''
+        self.preedit_cursor = 0
+        self.preedit_attrs = []
+        # Candidates of the lookup table, its revision as known to the
+        # client, and the pages of that revision already sent
         self.lookup_table = None
-        self.surrouding_text_received = False
+        self.table_texts = []
+        self.table_page_size = 0
+        self.table_revision = 0
+        self.table_pages = set()
+        # The editor's window of text around the cursor, as the engine
+        # sees it, and the number of deletions the engine asked for.  The
+        # editor's own copy is kept at the revision it last based a change
+        # on, with the batches of deletions sent since then.
+        self.surrounding = (u'', 0, 0)  # text, cursor, anchor
+        self.surrounding_revision = 0
+        self.editor_surrounding = (u'', 0, 0)
+        self.editor_revision = 0
+        self.deletions = []
+        self.sent_deletions = []
 
         self.connect('commit-text', commit_text_cb)
         self.connect('update-preedit-text', update_preedit_text_cb)
@@ -315,35 +709,69 @@ class IBusELInputContext(ibus.InputContext):
         except TypeError:
             pass
 
+    # Signals are reported to the client owning this context
+    def connect(self, signal, callback):
+        name = signal + ' signal'
+        def cb(ic, *args):
+            use_client(ic.client)
+            return stats.measure(name, callback, ic, *args)
+        return super(IBusELInputContext, self).connect(signal, cb)
+
 ########################################################################
 # Callbacks
 ########################################################################
 
 def commit_text_cb(ic, text):
+    # Text replacing deleted surrounding text goes after the deletion
+    flush_deletions(ic)
+    # The client drops the preedit when text is committed
+    clear_preedit(ic)
     print_command('ibus_commit_text_cb',
-        ic.id_no, text.text.encode("utf-8"))
+        ic.id_no, text.text)
 
+def clear_preedit(ic):
+    ic.preedit_text = u''
+    ic.preedit_cursor = 0
+    ic.preedit_attrs = []
+
+# Only the changed span is sent: (start, end) of the replaced part of the
+# previous preedit, the new text for it and the cursor.  Attributes are
+# [type, value, start, end] lists, sent only when they changed.
 def update_preedit_text_cb(ic, text, cursor_pos, visible):
-    preediting = len(text.text) > 0
-    if preediting or ic.preediting:
-        attrs = ['%s %d %d %d'%
-                 (["nil", "'underline", "'foreground", "'background"][attr.type],
-                  attr.value & 0xffffff, attr.start_index, attr.end_index)
+    if visible:
+        new_text = text.text
+        # An end of -1 stands for the end of the preedit, so that the
+        # usual underline of the whole text stays the same while typing
+        attrs = [[preedit.ATTRIBUTE_TYPES[attr.type], attr.value & 0xffffff,
+                  attr.start_index,
+                  -1 if attr.end_index >= len(new_text) else attr.end_index]
                  for attr in text.attributes]
-        print_command('ibus_update_preedit_text_cb',
-            ic.id_no, text.text.encode("utf-8"),
-            cursor_pos, visible, ' '.join(attrs))
-    ic.preediting = preediting
+    else:
+        new_text = u''
+        attrs = []
+        cursor_pos = 0
+    if new_text == ic.preedit_text and cursor_pos == ic.preedit_cursor \
+            and attrs == ic.preedit_attrs:
+        return
+    start, end, inserted = preedit.delta(ic.preedit_text, new_text)
+    print_command('ibus_update_preedit_cb',
+        ic.id_no, start, end, inserted, cursor_pos,
+        attrs if attrs != ic.preedit_attrs else None)
+    ic.preedit_text = new_text
+    ic.preedit_cursor = cursor_pos
+    ic.preedit_attrs = attrs
 
 def show_preedit_text_cb(ic):
     print_command('ibus_show_preedit_text_cb', ic.id_no)
 
 def hide_preedit_text_cb(ic):
+    # The client removes the preedit; it is sent in full when shown again
+    clear_preedit(ic)
     print_command('ibus_hide_preedit_text_cb', ic.id_no)
 
 def update_auxiliary_text_cb(ic, text, visible):
     print_command('ibus_update_auxiliary_text_cb',
-        ic.id_no, text.text.encode("utf-8"), visible)
+        ic.id_no, text.text, visible)
 
 def show_auxiliary_text_cb(ic):
     print_command('ibus_show_auxiliary_text_cb', ic.id_no)
@@ -351,18 +779,40 @@ def show_auxiliary_text_cb(ic):
 def hide_auxiliary_text_cb(ic):
     print_command('ibus_hide_auxiliary_text_cb', ic.id_no)
 
+# The client caches pages of candidates per revision of the table.  A new
+# revision starts when the candidates or the page size change; moving the
+# cursor or flipping pages only sends the cursor, plus the pages the client
+# does not have yet.  The page after the current one is sent ahead.
 def update_lookup_table_cb(ic, lookup_table, visible):
     ic.lookup_table = lookup_table
-    if visible:
-        self.__show_lookup_table_cb(ic)
-    else:
-        self.__hide_lookup_table_cb(ic)
+    texts = [lookup_table.get_candidate(i).text
+             for i in range(lookup_table.get_number_of_candidates())]
+    page_size = lookup_table.get_page_size()
+    if texts != ic.table_texts or page_size != ic.table_page_size:
+        ic.table_texts = texts
+        ic.table_page_size = page_size
+        ic.table_revision += 1
+        ic.table_pages = set()
+    cursor_pos = lookup_table.get_cursor_pos()
+    if page_size:
+        page = cursor_pos // page_size
+        send_lookup_table_page(ic, page)
+        send_lookup_table_page(ic, page + 1)
+    print_command('ibus_update_lookup_table_cb',
+        ic.id_no, ic.table_revision, cursor_pos, page_size, len(texts),
+        visible)
+
+def send_lookup_table_page(ic, page):
+    start = page * ic.table_page_size
+    if page in ic.table_pages or start >= len(ic.table_texts):
+        return
+    ic.table_pages.add(page)
+    print_command('ibus_lookup_table_page_cb',
+        ic.id_no, ic.table_revision, page,
+        ic.table_texts[start:start + ic.table_page_size])
 
 def show_lookup_table_cb(ic):
-    print_command('ibus_show_lookup_table_cb',
-        ic.id_no,
-        [item.text for item in ic.lookup_table.get_candidates_in_current_page()],
-        ic.lookup_table.get_cursor_pos_in_current_page())
+    print_command('ibus_show_lookup_table_cb', ic.id_no)
 
 def hide_lookup_table_cb(ic):
     print_command('ibus_hide_lookup_table_cb', ic.id_no)
@@ -380,27 +830,54 @@ def cursor_down_lookup_table_cb(ic):
     print_command('ibus_log', 'cursor down lookup table')
 
 def enabled_cb(ic):
-    print_command('ibus_status_changed_cb', ic.id_no, ic.get_engine().name)
-    ic.surrouding_text_received = False
+    expected, ic.expected_engine = ic.expected_engine, None
+    if expected is not None and time.time() < expected[1]:
+        ic.engine_name = expected[0]
+    else:
+        # Switched from outside, e.g. by an IBus hotkey
+        ic.engine_name = ic.get_engine().name
+    print_command('ibus_status_changed_cb', ic.id_no, ic.engine_name)
+    # A new engine has not seen the surrounding text yet
+    if ic.client.surrounding_text:
+        send_surrounding_text(ic)
 
 def disabled_cb(ic):
     print_command('ibus_status_changed_cb', ic.id_no, None)
-    ic.surrouding_text_received = False
 
 def forward_key_event_cb(ic, keyval, keycode, modifiers):
+    flush_deletions(ic)
     print_command('ibus_forward_key_event_cb',
         ic.id_no, keyval, modifiers & ~modifier.RELEASE_MASK,
-        (modifiers & modifier.RELEASE_MASK == 0))
+        (modifiers & modifier.RELEASE_MASK) == 0)
 
+# Deletions are applied to our copy of the surrounding text at once, and
+# sent to the client together once the engine is done with the key, as
+# one [[offset, n_chars], ...] list with the new revision.
 def delete_surrounding_text_cb(ic, offset, n_chars):
-    print_command('ibus_delete_surrounding_text_cb',
-        ic.id_no, offset, n_chars)
+    if not ic.deletions:
+        glib.idle_add(flush_deletions, ic)
+    surrounding.merge(ic.deletions, offset, n_chars)
+    ic.surrounding = surrounding.delete(ic.surrounding, offset, n_chars)
+    ic.surrounding_revision += 1
+
+def flush_deletions(ic):
+    if ic.deletions and ic in ic.client.imcontexts:
+        deletions, ic.deletions = ic.deletions, []
+        ic.sent_deletions.append((ic.surrounding_revision, deletions))
+        use_client(ic.client)
+        print_command('ibus_delete_surrounding_text_cb',
+            ic.id_no, ic.surrounding_revision, deletions)
+        send_surrounding_text(ic)
+    return False
 
 ########################################################################
 # Process methods from client
 ########################################################################
 
-imcontexts = []
+# When enabled, replies to process_key_event carry time stamps of the
+# stages a key went through in the agent (see set_key_timing())
+key_timing = False
+command_received = 0.0
 
 IBUS_CAP_PREEDIT_TEXT       = 1 << 0
 IBUS_CAP_AUXILIARY_TEXT     = 1 << 1
@@ -410,97 +887,129 @@ IBUS_CAP_PROPERTY           = 1 << 4
 IBUS_CAP_SURROUNDING_TEXT   = 1 << 5
 
 
-def create_imcontext():
+# The id is given out here and sent back; clients map their contexts to
+# it.  An id is only passed in to recreate a client's contexts after a
+# restart.
+def create_imcontext(id_no = None):
+    if id_no is None:
+        try:
+            id_no = imcontexts.index(None)
+        except ValueError:
+            id_no = len(imcontexts)
+    elif id_no < len(imcontexts) and imcontexts[id_no] is not None:
+        print_command('error', 'input context %d exists' % id_no)
+        return
+    while len(imcontexts) <= id_no:
+        imcontexts.append(None)
     ic = IBusELInputContext(bus)
-    try:
-        ic.id_no = imcontexts.index(None)
-        imcontexts[ic.id_no] = ic
-    except ValueError:
-        ic.id_no = len(imcontexts)
-        imcontexts.append(ic)
+    ic.id_no = id_no
+    imcontexts[id_no] = ic
+
+    ic.set_capabilities(capabilities())
+    print_command('ibus_create_imcontext_cb', ic.id_no)
 
+def capabilities():
     caps = IBUS_CAP_FOCUS
-    # caps |= IBUS_CAP_PREEDIT_TEXT
-    if use_surrounding_text:
+    if client.inline_preedit:
+        caps |= IBUS_CAP_PREEDIT_TEXT
+    if client.candidate_popup:
+        caps |= IBUS_CAP_LOOKUP_TABLE
+    if use_surrounding_text and client.surrounding_text:
         caps |= IBUS_CAP_SURROUNDING_TEXT
+    return caps
 
-    ic.set_capabilities(caps)
-    print_command('ibus_create_imcontext_cb', ic.id_no)
+def set_inline_preedit(enabled):
+    client.inline_preedit = enabled
+    update_capabilities()
+
+def set_candidate_popup(enabled):
+    client.candidate_popup = enabled
+    update_capabilities()
+
+def set_surrounding_text_support(enabled):
+    if enabled and not use_surrounding_text:
+        print_message('Surrounding text needs IBus 1.4 or later')
+    client.surrounding_text = enabled
+    update_capabilities()
+
+def update_capabilities():
+    caps = capabilities()
+    for ic in imcontexts:
+        if ic:
+            ic.set_capabilities(caps)
 
 def destroy_imcontext(id_no):
+    if id_no >= len(imcontexts) or imcontexts[id_no] is None:
+        return
     imcontexts[id_no].destroy()
-    if id_no == len(imcontexts) - 1:
+    imcontexts[id_no] = None
+    # Trim freed slots at the tail, also those left by earlier destroys
+    while imcontexts and imcontexts[-1] is None:
         imcontexts.pop()
-    else:
-        imcontexts[id_no] = None
 
+# Replies end with the keyval, so that the client can tell which key a
+# reply is for.  Every key gets one, even if processing it failed.
 def process_key_event(id_no, keyval, modmask, backslash, pressed = None):
-    def update_keymap():
-        display._update_keymap(display.display.info.min_keycode,
-                               (display.display.info.max_keycode
-                                - display.display.info.min_keycode + 1))
-
-    def reply(id_no, handled):
-        print_command('ibus_process_key_event_cb', id_no, handled)
+    def reply(owner, id_no, handled, stamps):
+        use_client(owner)
+        if stamps is not None:
+            stamps.append(time.time())
+        print_command('ibus_process_key_event_cb', id_no, handled, stamps,
+                      keyval)
         return False
 
-    ic = imcontexts[id_no]
-    if use_surrounding_text and pressed != False \
-            and ic.needs_surrounding_text() and not ic.surrouding_text_received:
-        print_command('ibus_query_surrounding_text_cb',
-            id_no, keyval, modmask, backslash, pressed)
-        return
-
-    if backslash:
-        keycode = display.keysym_to_keycode(backslash) - 8
-        if keycode < 0:
-            update_keymap()
-            keycode = display.keysym_to_keycode(backslash) - 8
-    else:
-        keycodes = display.keysym_to_keycodes(keyval)
-        if not keycodes:
-            update_keymap()
-            keycodes = display.keysym_to_keycodes(keyval) or [(0, 0)]
-        if modmask & modifier.SHIFT_MASK:
-            for keycode_tuple in keycodes:
-                if keycode_tuple[1] & 1:
-                    break
-            else:
-                keycode_tuple = keycodes[0]
-        elif keyval < 0x100:
-            for keycode_tuple in keycodes:
-                if keycode_tuple[1]:
-                    if keycode_tuple[1] > 1:
-                        keycode_tuple = keycodes[0]
-                    break
-            else:
-                keycode_tuple = keycodes[0]
-            if keycode_tuple[1] & 1:
-                modmask |= modifier.SHIFT_MASK
+    # The client pushes the surrounding text ahead of keys, so keys never
+    # wait for it
+    stamps = [command_received, time.time()] if key_timing else None
+    try:
+        ic = imcontexts[id_no]
+        if backslash:
+            keycode = keymap.first_keycode(backslash) - 8
         else:
-            keycode_tuple = keycodes[0]
-        keycode = keycode_tuple[0] - 8
-    if pressed != None:
-        if not pressed:
-            modmask |= modifier.RELEASE_MASK
-        handled = ic.process_key_event(keyval, keycode, modmask)
-    else:
-        handled_p = ic.process_key_event(keyval, keycode, modmask)
-        handled_r = ic.process_key_event(keyval, keycode,
-                                         modmask | modifier.RELEASE_MASK)
-        handled = handled_p or handled_r
-    glib.idle_add(reply, id_no, handled)
+            keycode, modmask = keymap.lookup(keyval, modmask)
+            keycode -= 8
+        if pressed != None:
+            if not pressed:
+                modmask |= modifier.RELEASE_MASK
+            handled = ic.process_key_event(keyval, keycode, modmask)
+        else:
+            handled_p = ic.process_key_event(keyval, keycode, modmask)
+            handled_r = ic.process_key_event(keyval, keycode,
+                                             modmask | modifier.RELEASE_MASK)
+            handled = handled_p or handled_r
+    except:
+        import traceback
+        print_command('error', traceback.format_exc())
+        handled = False
+    if stamps is not None:
+        stamps.append(time.time())
+    glib.idle_add(reply, client, id_no, handled, stamps)
+
+def process_key_events(id_no, keys):
+    # Keys are processed and replied to one by one and in order, so the
+    # client sees exactly what a series of process_key_event() would give.
+    for keyval, count in keys:
+        for i in range(count):
+            process_key_event(id_no, keyval, 0, None, None)
+
+# Stamps are [received, engine start, engine done, reply sent]
+def set_key_timing(enabled):
+    global key_timing
+    key_timing = enabled
 
 def set_cursor_location(id_no, x, y, w, h):
     imcontexts[id_no].set_cursor_location(max(0, frame.left + x),
                                           frame.top + y, w, h)
 
 def focus_in(id_no):
-    imcontexts[id_no].focus_in()
+    ic = imcontexts[id_no]
+    ic.focus_in()
+    ic.has_focus = True
 
 def focus_out(id_no):
-    imcontexts[id_no].focus_out()
-    print('{}')  # Dummy response
+    ic = imcontexts[id_no]
+    ic.focus_out()
+    ic.has_focus = False
 
 def reset(id_no):
     imcontexts[id_no].reset()
@@ -512,23 +1021,77 @@ def disable(id_no):
     imcontexts[id_no].disable()
 
 def set_engine(id_no, name):
-    for engine in bus.list_active_engines():
-        if name == '%s'%engine.name:
-            imcontexts[id_no].set_engine(engine)
-            break
+    engine = engines.find(name)
+    if engine is not None:
+        ic = imcontexts[id_no]
+        # The 'enabled' signal, if it follows soon, is taken for this
+        # change without asking IBus.  IBus may not send it at all, e.g.
+        # for a context that already is, so the name is kept at once.
+        if ic.has_focus:
+            ic.expected_engine = (engine.name, time.time() + 1.0)
+        ic.set_engine(engine)
+        if ic.has_focus:
+            ic.engine_name = engine.name
     else:
         enable(id_no)
 
-def set_surrounding_text(id_no, text, cursor_pos, anchor_pos):
+# Changes from the client are based on the revision of the deletions it
+# had applied.  Changes crossing deletions on their way to the client are
+# applied to the client's copy, and the deletions replayed on top, as the
+# client itself will do.
+def set_surrounding_text(id_no, text, cursor_pos, anchor_pos, revision=0):
+    ic = imcontexts[id_no]
+    if not rebase_surrounding_text(ic, revision):
+        # The whole text replaces what we had
+        ic.sent_deletions = [d for d in ic.sent_deletions if d[0] > revision]
+        ic.editor_revision = revision
+    update_editor_surrounding(ic,
+        (text.decode("utf-8"), cursor_pos, anchor_pos))
+
+def update_surrounding_text(id_no, revision, start, end, text,
+                            cursor_pos, anchor_pos):
     ic = imcontexts[id_no]
-    ic.set_surrounding_text(text.decode("utf-8"), cursor_pos, anchor_pos)
-    ic.surrouding_text_received = True
+    if not rebase_surrounding_text(ic, revision):
+        # Not a revision we know of; start over from the client's text
+        print_command('ibus_query_surrounding_text_cb', ic.id_no)
+        return
+    update_editor_surrounding(ic,
+        (preedit.apply(ic.editor_surrounding[0], start, end,
+                       text.decode("utf-8")),
+         cursor_pos, anchor_pos))
+
+def rebase_surrounding_text(ic, revision):
+    flush_deletions(ic)
+    revisions = [r for r, deletions in ic.sent_deletions]
+    if revision != ic.editor_revision and revision not in revisions:
+        return False
+    while ic.sent_deletions and ic.sent_deletions[0][0] <= revision:
+        ic.editor_surrounding = surrounding.replay(ic.editor_surrounding,
+                                                   ic.sent_deletions.pop(0)[1])
+    ic.editor_revision = revision
+    return True
+
+def update_editor_surrounding(ic, editor_surrounding):
+    ic.editor_surrounding = ic.surrounding = editor_surrounding
+    for revision, deletions in ic.sent_deletions:
+        ic.surrounding = surrounding.replay(ic.surrounding, deletions)
+    send_surrounding_text(ic)
+
+def send_surrounding_text(ic):
+    if use_surrounding_text:
+        ic.set_surrounding_text(*ic.surrounding)
 
 def update_frame_coordinates(window_id = None):
     if window_id:
         frame.set_window_id(window_id)
     frame.update_coordinates()
 
+def watch_window_geometry(window_id):
+    frame.watch_geometry(window_id)
+
+def watch_active_window():
+    frame.watch_active_window()
+
 def start_focus_observation(interval):
     frame.start_focus_observation(interval)
 
@@ -536,18 +1099,92 @@ def stop_focus_observation():
     frame.stop_focus_observation()
 
 def list_active_engines():
-    print_command('ibus_list_active_engines_cb', [i.name for i in bus.list_active_engines()])
+    print_command('ibus_list_active_engines_cb', engines.names())
 
 def next_engine(id_no):
-    current_engine_name = imcontexts[id_no].get_engine().name
-    all_engine_names = [i.name for i in bus.list_active_engines()]
-    current_engine_index = all_engine_names.index(current_engine_name)
+    ic = imcontexts[id_no]
+    if ic.engine_name is None:
+        ic.engine_name = ic.get_engine().name
+    all_engine_names = engines.names()
+    if not all_engine_names:
+        return
+    try:
+        current_engine_index = all_engine_names.index(ic.engine_name)
+    except ValueError:
+        current_engine_index = -1
     try:
         next_engine_name = all_engine_names[current_engine_index + 1]
     except IndexError:
         next_engine_name = all_engine_names[0]
     set_engine(id_no, next_engine_name)
 
+def show_stats(reset=False):
+    print_command('ibus_stats_cb', stats.rows())
+    if reset:
+        stats.reset()
+
+# The profiler sees every main loop callback from profile_start() to
+# profile_stop(), whichever client they are for
+profiler = None
+
+def profile_start():
+    global profiler
+    if profiler is None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+def profile_stop(limit=None):
+    global profiler
+    if profiler is None:
+        print_command('error', 'profiler is not running')
+        return
+    profiler.disable()
+    import pstats
+    import StringIO
+    report = StringIO.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats('cumulative') \
+        .print_stats(limit or 40)
+    profiler = None
+    print_command('ibus_profile_cb', report.getvalue())
+
+commands = CommandTable()
+commands.register('create_imcontext', create_imcontext, optional(integer))
+commands.register('destroy_imcontext', destroy_imcontext, integer)
+commands.register('process_key_event', process_key_event,
+                  integer, integer, integer, optional(integer),
+                  optional(boolean))
+commands.register('process_key_events', process_key_events,
+                  integer, key_sequence)
+commands.register('set_key_timing', set_key_timing, boolean)
+commands.register('set_inline_preedit', set_inline_preedit, boolean)
+commands.register('set_candidate_popup', set_candidate_popup, boolean)
+commands.register('set_surrounding_text_support',
+                  set_surrounding_text_support, boolean)
+commands.register('set_cursor_location', set_cursor_location,
+                  integer, integer, integer, integer, integer)
+commands.register('focus_in', focus_in, integer)
+commands.register('focus_out', focus_out, integer)
+commands.register('reset', reset, integer)
+commands.register('enable', enable, integer)
+commands.register('disable', disable, integer)
+commands.register('set_engine', set_engine, integer, string)
+commands.register('set_surrounding_text', set_surrounding_text,
+                  integer, string, integer, integer, optional(integer))
+commands.register('update_surrounding_text', update_surrounding_text,
+                  integer, integer, integer, integer, string, integer, integer)
+commands.register('update_frame_coordinates', update_frame_coordinates,
+                  optional(integer))
+commands.register('watch_window_geometry', watch_window_geometry, integer)
+commands.register('watch_active_window', watch_active_window)
+commands.register('start_focus_observation', start_focus_observation, integer)
+commands.register('stop_focus_observation', stop_focus_observation)
+commands.register('list_active_engines', list_active_engines)
+commands.register('next_engine', next_engine, integer)
+commands.register('stats', show_stats, optional(boolean))
+commands.register('profile_start', profile_start)
+commands.register('profile_stop', profile_stop, optional(integer))
+
 ########################################################################
 # Main loop
 ########################################################################
@@ -557,9 +1194,10 @@ class IBusModeMainLoop(glib.MainLoop):
     def __init__(self, bus):
         super(IBusModeMainLoop, self).__init__()
         bus.connect("disconnected", self.__disconnected_cb)
+        self.server = None
 
     def __disconnected_cb(self, *args):
-        print_command('ibus_log', 'disconnected')
+        broadcast_command('ibus_log', 'disconnected')
         exit()
 
     def __start_cb(self):
@@ -569,23 +1207,89 @@ class IBusModeMainLoop(glib.MainLoop):
             display.get_display_name())
         return False
 
-    def __stdin_cb(self, fd, condition):
-        try:
-            expr = sys.stdin.readline()
-            exec(expr)
-        except:
-            import traceback
-            print_command('error', 'error expr: ' + expr)
-            print_command('error', traceback.format_exc())
-        return True
+    def __client_cb(self, fd, condition, c):
+        global command_received
+        use_client(c)
+        lines = c.reader.read_lines()
+        command_received = time.time()
+        for line in lines:
+            try:
+                # Unknown names fail in dispatch() without an entry
+                name = line.partition('(')[0].strip()
+                if name in commands.commands:
+                    stats.measure(name, commands.dispatch, line)
+                else:
+                    commands.dispatch(line)
+            except CommandError as e:
+                print_command('error', str(e))
+            except:
+                import traceback
+                print_command('error', 'error expr: ' + line)
+                print_command('error', traceback.format_exc())
+            use_client(c)
+        frame.process_events()
+        if c.reader.closed and c.sock is not None:
+            c.close()
+        # At EOF of stdin, leave the rest to __io_error_cb
+        return not c.reader.closed
 
     def __io_error_cb(self, fd, condition):
         exit()
 
-    def run(self):
-        glib.idle_add(self.__start_cb)
-        glib.io_add_watch(0, glib.IO_IN, self.__stdin_cb)
-        glib.io_add_watch(0, glib.IO_ERR | glib.IO_HUP, self.__io_error_cb)
+    def __hangup_cb(self, fd, condition, c):
+        c.close()
+        return False
+
+    def listen(self, path):
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(path)
+        except socket.error as e:
+            if e.args[0] != errno.EADDRINUSE:
+                raise
+            # Neither talk to nor remove a socket of somebody else
+            if not is_private(path, stat.S_ISSOCK):
+                exit(1)
+            # A running daemon accepts connections, a stale socket refuses
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                os.unlink(path)
+                server.bind(path)
+            else:
+                probe.close()
+                exit()
+        os.chmod(path, 0o600)
+        server.listen(16)
+        glib.io_add_watch(server.fileno(), glib.IO_IN, self.__accept_cb)
+        self.server = server
+
+    def __accept_cb(self, fd, condition):
+        try:
+            sock, address = self.server.accept()
+        except socket.error:
+            return True
+        c = Client(sock.fileno(), sock.fileno(), sock)
+        c.surrounding_text = surrounding_text_default
+        c.sources = [
+            glib.io_add_watch(sock.fileno(), glib.IO_IN, self.__client_cb, c),
+            glib.io_add_watch(sock.fileno(), glib.IO_ERR | glib.IO_HUP,
+                              self.__hangup_cb, c)]
+        clients.append(c)
+        use_client(c)
+        self.__start_cb()
+        return True
+
+    def run(self, path=None):
+        if path:
+            self.listen(path)
+        else:
+            glib.idle_add(self.__start_cb)
+            client.sources = [
+                glib.io_add_watch(0, glib.IO_IN, self.__client_cb, client),
+                glib.io_add_watch(0, glib.IO_ERR | glib.IO_HUP,
+                                  self.__io_error_cb)]
         while True:
             try:
                 super(IBusModeMainLoop, self).run()
@@ -594,11 +1298,10 @@ class IBusModeMainLoop(glib.MainLoop):
                 print_command('error', traceback.format_exc())
             else:
                 break
-        for ic in imcontexts:
-            if ic:
-                ic.destroy()
+        for c in list(clients):
+            c.close()
 
 if __name__ == "__main__":
 
     mainloop = IBusModeMainLoop(bus)
-    mainloop.run()
+    mainloop.run(daemon_socket)
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Surrounding text is a window of the buffer around the cursor, kept as a
+# (text, cursor, anchor) tuple.  The editor and the agent both keep a copy
+# of it; the editor sends changes to it as preedit.delta() spans, and
+# deletions asked for by the engine are applied to both copies with
+# delete() so they stay the same.
+
+
+def window(cursor, size, chars):
+    # (start, end) of the window for a cursor.  start moves in steps of
+    # half a window, and end keeps a fixed distance from the cursor, so
+    # typing only changes the text at the cursor.
+    step = max(1, chars // 2)
+    start = max(0, (cursor - chars) // step * step)
+    return start, min(size, cursor + chars)
+
+
+def delete(surrounding, offset, n_chars):
+    # Apply a delete-surrounding-text request, offset being relative to
+    # the cursor, clamped to the window
+    text, cursor, anchor = surrounding
+    start = max(0, min(len(text), cursor + offset))
+    end = max(start, min(len(text), cursor + offset + n_chars))
+
+    def shift(pos):
+        if pos >= end:
+            return pos - (end - start)
+        return min(pos, start)
+
+    return text[:start] + text[end:], shift(cursor), shift(anchor)
+
+
+def replay(surrounding, deletions):
+    for offset, n_chars in deletions:
+        surrounding = delete(surrounding, offset, n_chars)
+    return surrounding
+
+
+def merge(deletions, offset, n_chars):
+    # A run of deletions next to the cursor, as sent for each backspace of
+    # a word, becomes a single one
+    if deletions:
+        last_offset, last_chars = deletions[-1]
+        if offset + n_chars == 0 and last_offset + last_chars == 0:
+            deletions[-1] = [last_offset + offset, last_chars + n_chars]
+            return
+        if offset == 0 and last_offset == 0:
+            deletions[-1] = [0, last_chars + n_chars]
+            return
+    deletions.append([offset, n_chars])
@@ -2,18 +2,30 @@
 import sublime
 import sublime_plugin
 import os
-import json
 from os.path import join
 import sys
-import subprocess
-import re
 import math
+import time
+from collections import deque
 
 BASE_PATH = os.path.abspath(os.path.dirname(__file__))
 if BASE_PATH not in sys.path:
     sys.path += [BASE_PATH] + [join(BASE_PATH, 'sublimeibus')]
 
 from sublimeibus.host import agent
+from sublimeibus.layout import GroupLayout
+from sublimeibus.histogram import Histogram
+from sublimeibus.keytable import KeyTable, parse_names, read_text
+from sublimeibus.commandreader import quote
+from sublimeibus.preedit import delta, apply
+from sublimeibus import surrounding
+
+# Editors providing on_*_async event hooks call them off the UI thread
+ASYNC_EVENTS = hasattr(sublime, 'set_timeout_async')
+
+# Inline preedit is drawn as a phantom, without touching the buffer.
+# Elsewhere IBus draws it in a window of its own.
+INLINE_PREEDIT = hasattr(sublime, 'PhantomSet')
 
 
 class Logger(object):
@@ -37,6 +49,15 @@ class IBusStatus(object):
         self.enable = False
         self.view = None
         self._id_no = -1
+        # X window id of the editor window last seen active
+        self.active_window_id = None
+        # X window id -> (left, top, width), kept up to date by the agent
+        self.geometries = {}
+        # keys sent to the agent and not yet answered by
+        # ibus_process_key_event_cb, oldest first
+        self.pending_keys = deque()
+        # Names of the active IBus engines, pushed by the agent
+        self.engines = []
 
     def id_no():
         def fget(self):
@@ -68,46 +89,790 @@ class IBusCommand(object):
         self.agent = agent
         self.window_layout = None
 
-    def push(self, data):
+    # Messages with a key only matter in their latest version; the agent's
+    # writer keeps one per key while they wait to be written.  Droppable
+    # ones are dropped rather than wait when the agent is behind, and
+    # False is returned.
+    def push(self, data, key=None, droppable=False):
         # logger.debug('push: ' + repr(data))
-        self.agent.push(data + '\n')
+        return self.agent.push(data + '\n', key, droppable)
 
     def setup(self):
-        # self.push('list_active_engines()')
-        self.push('create_imcontext()')
-        # wait for ibus_create_imcontext_cb
-
-    def setup2(self):
+        self.push('list_active_engines()')
+        settings = sublime.load_settings('SublimeIBus.sublime-settings')
+        if settings.get('sublime_ibus_key_timing', True):
+            self.push('set_key_timing(True)')
+        if INLINE_PREEDIT and settings.get('sublime_ibus_inline_preedit',
+                                           False):
+            self.push('set_inline_preedit(True)')
+        if settings.get('sublime_ibus_candidate_popup', False):
+            self.push('set_candidate_popup(True)')
+        if surrounding_text.enabled:
+            self.push('set_surrounding_text_support(True)')
+        self.push('watch_active_window()')
         self.push('start_focus_observation(1000)')
-        self.push('focus_in(%d)' % status.id_no)
-        self.set_status(False)
-
+        # The active view takes the first context the agent answers with
+        pool.fill()
+        window = sublime.active_window()
+        view = window.active_view() if window is not None else None
+        if view is not None:
+            self.activate(view)
+
+    # Switching views only moves the focus between warm contexts
+    def activate(self, view):
+        id_no = pool.acquire(view)
+        if id_no != status.id_no:
+            if pool.view(status.id_no) is not None:
+                self.push('focus_out(%d)' % status.id_no,
+                          ('focus', status.id_no))
+            if id_no is None:
+                # No context until ibus_create_imcontext_cb, which
+                # activates the view again
+                status.id_no = -1
+                status.view = view
+                status.set_status(False, view)
+            else:
+                self.push('focus_in(%d)' % id_no, ('focus', id_no))
+                status.id_no = id_no
+                engine_name = pool.engines.get(id_no)
+                status.set_status(engine_name is not None, view, engine_name)
+        pool.fill()
+
+    def close(self, view):
+        id_no = pool.release(view.id())
+        if id_no is not None and id_no == status.id_no:
+            status.id_no = -1
+            status.enable = False
+
+    # Between closing the active view and activating another one there is
+    # no context to talk about; imcontexts[-1] would be some other view's
     def set_status(self, enable):
+        if status.id_no < 0:
+            return
         if enable:
             self.push('enable(%d)' % status.id_no)
         else:
             self.push('disable(%d)' % status.id_no)
 
-    def process_key(self, keysym):
-        self.push('process_key_event(%d, %d, 0, None, None)' %
-                  (status.id_no, keysym))
-        # self.push('set_surrounding_text(%d, "", 0, 0)' % status.id_no)
+    def process_keys(self, keys):
+        if status.id_no < 0:
+            return
+        seq = ' '.join(('%d*%d' % (keysym, count) if count > 1 else
+                        '%d' % keysym) for keysym, count in keys)
+        self.push('process_key_events(%d, %s)' % (status.id_no, seq))
 
     def set_cursor_location(self):
-        if self.window_layout is None:
+        cursor_updater.request()
+
+    # With cached_only, raises CacheMiss instead of measuring the window
+    def cursor_location(self, cached_only=False):
+        id_no = status.id_no
+        if self.window_layout is None or id_no < 0:
+            return None
+        location = self.window_layout.cursor_location(cached_only)
+        if location is None:
+            return None
+        left, top, view = location
+        return (id_no, left, top, view.line_height())
+
+    def send_cursor_location(self, location):
+        return self.push('set_cursor_location(%d, %d, %d, 0, %d)' % location,
+                         ('cursor', location[0]), droppable=True)
+
+    def update_window(self, window_id):
+        if window_id is None:
             return
-        left, top = self.window_layout.cursor_location()
-        height = self.window_layout.view.line_height()
-        self.push('set_cursor_location(%d, %d, %d, 0, %d)' %
-                  (status.id_no, left, top, height))
+        if self.window_layout is None:
+            self.window_layout = WindowLayout()
+        if window_id not in status.geometries:
+            self.push('watch_window_geometry(%d)' % window_id)
+        self.window_layout.window_id = window_id
+        self.set_cursor_location()
 
     def next_engine(self):
+        if status.id_no < 0:
+            return
         self.push('next_engine(%d)' % (status.id_no))
 
 
+class KeyEvent(object):
+    def __init__(self, key, view, keysym=None):
+        self.key = key
+        self.view = view
+        self.keysym = keysym
+        self.pressed = time.time()
+        self.sent = None
+        self.committed = False
+
+
+class KeyCollector(object):
+    # Keys arriving within the same UI tick are sent as one
+    # process_key_events line; runs of the same key (auto-repeat) are
+    # compressed to "keysym*count".
+    def __init__(self, command):
+        self.command = command
+        self.keys = []
+        self.events = []
+        self.scheduled = False
+
+    def add(self, event, keysym):
+        self.events.append(event)
+        if self.keys and self.keys[-1][0] == keysym:
+            self.keys[-1][1] += 1
+        else:
+            self.keys.append([keysym, 1])
+        if not self.scheduled:
+            self.scheduled = True
+            sublime.set_timeout(self.flush, 0)
+
+    def flush(self):
+        self.scheduled = False
+        keys, self.keys = self.keys, []
+        events, self.events = self.events, []
+        if keys:
+            # The engine gets the text around the cursor before the keys
+            commit_collector.flush()
+            surrounding_text.sync(events[0].view)
+            self.command.process_keys(keys)
+            now = time.time()
+            for event in events:
+                event.sent = now
+
+
+class CommitCollector(object):
+    # Engines may commit several segments in a burst.  Commits arriving
+    # within the same UI tick are inserted as one edit per view, at every
+    # selection, and the cursor location is recomputed once.  Anything
+    # else touching the buffer flushes them first, to keep the order.
+    def __init__(self, command):
+        self.command = command
+        self.commits = []
+        self.scheduled = False
+        self.received = 0
+        self.edits = 0
+        # Keys whose commit latency ends with this flush
+        self.events = []
+
+    def add(self, view, text, event=None):
+        self.received += 1
+        if event is not None:
+            self.events.append(event)
+        if self.commits and self.commits[-1][0].id() == view.id():
+            self.commits[-1][1].append(text)
+        else:
+            self.commits.append((view, [text]))
+        if not self.scheduled:
+            self.scheduled = True
+            sublime.set_timeout(self.flush, 0)
+
+    def flush(self):
+        self.scheduled = False
+        commits, self.commits = self.commits, []
+        events, self.events = self.events, []
+        for view, texts in commits:
+            self.edits += 1
+            view.run_command('ibus_insert', {'text': ''.join(texts)})
+        now = time.time()
+        for event in events:
+            latency.record('commit', now - event.pressed)
+        if commits:
+            self.command.set_cursor_location()
+
+    def summary(self):
+        return 'commits: %d, edits: %d' % (self.received, self.edits)
+
+
+class ContextPool(object):
+    # One agent input context per view, so preedit and engine state never
+    # leak between buffers.  Spare contexts are created ahead of need, and
+    # beyond sublime_ibus_context_pool_size views the least recently used
+    # view's context is destroyed.  Ids are the ones the agent sends back in
+    # ibus_create_imcontext_cb, in the order of our create_imcontext()s; a
+    # view that finds no spare has no context until its id arrives.
+    def __init__(self, command):
+        self.command = command
+        settings = sublime.load_settings('SublimeIBus.sublime-settings')
+        self.size = max(1, settings.get('sublime_ibus_context_pool_size', 8))
+        self.spare_count = settings.get('sublime_ibus_context_spares', 1)
+        self.spares = []
+        # per create_imcontext() not answered yet, the view waiting for it,
+        # or None for a spare
+        self.pending = deque()
+        # view id -> context id, and context id -> view
+        self.contexts = {}
+        self.views = {}
+        # view id -> tick of its last activation
+        self.used = {}
+        self.tick = 0
+        # context id -> engine name, None when disabled
+        self.engines = {}
+        self.created = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def create(self, view=None):
+        self.command.push('create_imcontext()')
+        self.pending.append(view)
+        self.created += 1
+
+    # Returns the view that gets the context, if any
+    def created_cb(self, id_no):
+        if not self.pending:
+            logger.debug('unexpected input context: %d' % id_no)
+            return None
+        view = self.pending.popleft()
+        if view is None:
+            if len(self.spares) < self.spare_count:
+                self.spares.append(id_no)
+            else:
+                self.destroy(id_no)
+            return None
+        self.contexts[view.id()] = id_no
+        self.views[id_no] = view
+        return view
+
+    # The agent recreates the contexts it answered for; the others are
+    # asked for again
+    def restarted(self):
+        for view in self.pending:
+            self.command.push('create_imcontext()')
+
+    def destroy(self, id_no):
+        self.command.push('destroy_imcontext(%d)' % id_no)
+        surrounding_text.forget(id_no)
+        self.engines.pop(id_no, None)
+
+    def fill(self):
+        while len(self.spares) + list(self.pending).count(None) < \
+                self.spare_count:
+            self.create()
+
+    def waiting(self, view_id):
+        for i, view in enumerate(self.pending):
+            if view is not None and view.id() == view_id:
+                return i
+        return None
+
+    def acquire(self, view):
+        view_id = view.id()
+        self.tick += 1
+        self.used[view_id] = self.tick
+        id_no = self.contexts.get(view_id)
+        if id_no is not None:
+            self.hits += 1
+            return id_no
+        if self.waiting(view_id) is not None:
+            return None
+        self.misses += 1
+        if len(self.contexts) >= self.size:
+            self.evictions += 1
+            self.release(min(self.contexts, key=self.used.get))
+        if self.spares:
+            id_no = self.spares.pop(0)
+        elif None in self.pending:
+            # Takes the spare on its way
+            self.pending[list(self.pending).index(None)] = view
+            return None
+        else:
+            self.create(view)
+            return None
+        self.contexts[view_id] = id_no
+        self.views[id_no] = view
+        return id_no
+
+    def release(self, view_id):
+        self.used.pop(view_id, None)
+        i = self.waiting(view_id)
+        if i is not None:
+            self.pending[i] = None
+        id_no = self.contexts.pop(view_id, None)
+        if id_no is not None:
+            del self.views[id_no]
+            self.destroy(id_no)
+        return id_no
+
+    def view(self, id_no):
+        return self.views.get(id_no)
+
+    def summary(self):
+        return ('%d views, %d spares, %d pending, created: %d, hits: %d, '
+                'misses: %d, evictions: %d' % (
+                    len(self.contexts), len(self.spares), len(self.pending),
+                    self.created, self.hits, self.misses, self.evictions))
+
+
+class KeyRegistry(object):
+    # Key tables compiled once from the settings files and rebuilt whenever
+    # one of them changes, so no settings are read per key.  Settings
+    # objects cannot enumerate their keys, hence the names are taken from
+    # the files; a name found in none of them is looked up in the settings
+    # when it is first used.
+    files = ['SublimeIBusKeyTable.sublime-settings',
+             'SublimeIBusFallBackCommand.sublime-settings']
+
+    def __init__(self):
+        self.keys = sublime.load_settings(self.files[0])
+        self.fallbacks = sublime.load_settings(self.files[1])
+        self.keys.add_on_change('sublime_ibus_keys', self.build)
+        self.fallbacks.add_on_change('sublime_ibus_keys', self.build)
+        self.builds = 0
+        self.extra_names = set()
+        self.build()
+
+    def sources(self, filename):
+        # Every package may add to the settings, where the editor can list
+        # them; otherwise only this package and User are read
+        if hasattr(sublime, 'find_resources'):
+            return [(resource, sublime.load_resource(resource))
+                    for resource in sublime.find_resources(filename)]
+        sources = []
+        for path in (join(BASE_PATH, filename),
+                     join(sublime.packages_path(), 'User', filename)):
+            text = read_text(path)
+            if text is not None:
+                sources.append((path, text))
+        return sources
+
+    def names(self, settings, filename):
+        names = set(self.extra_names)
+        for source, text in self.sources(filename):
+            try:
+                names.update(parse_names(text))
+            except ValueError as e:
+                print('SublimeIBus: key names in %s not read: %s' % (source, e))
+        if hasattr(settings, 'to_dict'):
+            names.update(settings.to_dict().keys())
+        return names
+
+    def build(self):
+        keysyms = {}
+        for name in self.names(self.keys, self.files[0]):
+            keysym = self.keys.get(name)
+            if keysym is not None:
+                keysyms[name] = keysym
+        fallbacks = {}
+        for name in self.names(self.fallbacks, self.files[1]):
+            cmd = self.fallbacks.get(name)
+            if cmd is not None:
+                fallbacks[name] = cmd
+        self.table = KeyTable(keysyms, fallbacks)
+        self.builds += 1
+
+    def lookup(self, name, settings):
+        # A name the files did not show joins the table if it is set
+        if name not in self.extra_names and settings.get(name) is not None:
+            self.extra_names.add(name)
+            self.build()
+            return True
+        return False
+
+    def keysym(self, name):
+        keysym = self.table.keysym(name)
+        if keysym is None and self.lookup(name, self.keys):
+            keysym = self.table.keysym(name)
+        return keysym
+
+    def fallback(self, name):
+        cmd = self.table.fallback(name)
+        if cmd is None and self.lookup(name, self.fallbacks):
+            cmd = self.table.fallback(name)
+        return cmd
+
+
+class LatencyStats(object):
+    # Per-stage latency of keys, from IbusKeyCommand.run to the end of
+    # ibus_process_key_event_cb.  Agent stages come from the time stamps
+    # the agent attaches to its replies (set_key_timing()).
+    stages = [
+        ('plugin', 'key press -> written to the agent (KeyCollector)'),
+        ('pipe', 'written -> read by the agent'),
+        ('agent', 'read by the agent -> handed to IBus'),
+        ('engine', 'IBus process_key_event'),
+        ('reply', 'engine done -> reply dispatched in the plugin'),
+        ('apply', 'reply dispatched -> fallback command done'),
+        ('total', 'key press -> reply handled'),
+        ('commit', 'key press -> committed text inserted'),
+        ]
+
+    def __init__(self):
+        self.histograms = {}
+        self.reset()
+
+    def reset(self):
+        for stage, _ in self.stages:
+            self.histograms[stage] = Histogram()
+
+    def record(self, stage, seconds):
+        self.histograms[stage].record(seconds * 1e6)
+
+    def record_key(self, event, stamps, replied, done):
+        if event.sent is not None:
+            self.record('plugin', event.sent - event.pressed)
+            if stamps:
+                received, start, end, _ = stamps
+                self.record('pipe', received - event.sent)
+                self.record('agent', start - received)
+                self.record('engine', end - start)
+                self.record('reply', replied - end)
+        self.record('apply', done - replied)
+        self.record('total', done - event.pressed)
+
+    def dump(self):
+        lines = ['SublimeIBus key latency (us):']
+        for stage, description in self.stages:
+            lines.append('  %-7s %-50s %s' % (
+                stage, self.histograms[stage].summary(), description))
+        return lines
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class CursorLocationUpdater(object):
+    # Selection changes come in bursts (multi-cursor edits, find-next loops,
+    # macro playback) and only the latest one matters.  Requests are
+    # debounced and the location is computed off the UI thread where the
+    # editor allows it, from the cached window layout.  On a cache miss,
+    # probing the window (see WindowMetrics) and updating the caches is
+    # left to the UI thread.  The location is sent only when it changed.
+    def __init__(self, command):
+        self.command = command
+        self.generation = 0
+        self.last_sent = None
+        self.requests = 0
+        self.computed = 0
+        self.misses = 0
+        self.sent = 0
+        self.ui_time = 0.0
+        settings = sublime.load_settings('SublimeIBus.sublime-settings')
+        self.delay = settings.get('sublime_ibus_cursor_location_delay', 20)
+        self.set_timeout = getattr(sublime, 'set_timeout_async',
+                                   sublime.set_timeout)
+
+    def request(self):
+        self.requests += 1
+        self.generation += 1
+        generation = self.generation
+        self.set_timeout(lambda: self.update(generation), self.delay)
+
+    def update(self, generation):
+        if generation != self.generation:
+            return  # superseded by a later request
+        start = time.time()
+        self.computed += 1
+        try:
+            location = self.command.cursor_location(cached_only=True)
+        except CacheMiss:
+            self.misses += 1
+            sublime.set_timeout(lambda: self.update_cache(generation), 0)
+            return
+        finally:
+            if not ASYNC_EVENTS:
+                self.ui_time += time.time() - start
+        if location is not None:
+            sublime.set_timeout(lambda: self.send(location), 0)
+
+    def update_cache(self, generation):
+        if generation != self.generation:
+            return
+        start = time.time()
+        location = self.command.cursor_location()
+        if location is not None:
+            self.send(location)
+        self.ui_time += time.time() - start
+
+    def send(self, location):
+        start = time.time()
+        if location != self.last_sent:
+            self.sent += 1
+            # Sent again next time if dropped
+            if self.command.send_cursor_location(location):
+                self.last_sent = location
+            else:
+                self.last_sent = None
+        self.ui_time += time.time() - start
+
+    def reset(self):
+        self.last_sent = None
+
+    def summary(self):
+        per_event = self.ui_time / self.requests if self.requests else 0
+        return ('selection events: %d, computed: %d, cache misses: %d, '
+                'sent: %d, UI thread: %.1f us/event' %
+                (self.requests, self.computed, self.misses, self.sent,
+                 per_event * 1e6))
+
+
+def escape_html(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class InlinePreedit(object):
+    # The preedit of a view is drawn as an inline phantom at the point where
+    # the composition started, so the buffer, its undo history and the
+    # selections are left alone.  The point is kept as the empty, hidden
+    # 'ibus_preedit' region, which moves with edits before it, and tells
+    # whether a view has a preedit.
+    def __init__(self):
+        # view id -> [text, cursor, attributes, PhantomSet]
+        self.views = {}
+        self.renders = 0
+
+    def update(self, view, start, end, text, cursor, attributes=None):
+        state = self.views.get(view.id())
+        if state is None:
+            if not text:
+                return
+            point = view.sel()[0].begin()
+            view.add_regions('ibus_preedit', [sublime.Region(point, point)],
+                             '', '', sublime.HIDDEN)
+            state = self.views[view.id()] = [
+                u'', 0, [], sublime.PhantomSet(view, 'ibus_preedit')]
+        state[0] = apply(state[0], start, end, text)
+        state[1] = cursor
+        if attributes is not None:
+            state[2] = attributes
+        if not state[0]:
+            self.clear(view)
+            return
+        self.render(view, state)
+
+    def clear(self, view):
+        state = self.views.pop(view.id(), None)
+        if state is not None:
+            state[3].update([])
+        view.erase_regions('ibus_preedit')
+
+    def render(self, view, state):
+        text, cursor, attributes, phantoms = state
+        regions = view.get_regions('ibus_preedit')
+        if not regions:
+            return
+        self.renders += 1
+        phantoms.update([sublime.Phantom(regions[0], self.html(
+            text, cursor, attributes), sublime.LAYOUT_INLINE)])
+
+    def html(self, text, cursor, attributes):
+        # Converted segments get the colors of their attributes
+        styles = [''] * len(text)
+        for kind, value, start, end in attributes:
+            if kind in ('foreground', 'background'):
+                prop = 'color' if kind == 'foreground' else 'background-color'
+                end = len(text) if end < 0 else min(end, len(text))
+                for i in range(start, end):
+                    styles[i] += '%s: #%06x;' % (prop, value & 0xffffff)
+        parts = []
+        for i, c in enumerate(text):
+            if i == cursor and 0 < cursor:
+                parts.append('|')
+            if i == 0 or styles[i] != styles[i - 1]:
+                if i:
+                    parts.append('</span>')
+                parts.append('<span style="%s">' % styles[i])
+            parts.append(escape_html(c))
+        parts.append('</span>')
+        return ('<span style="text-decoration: underline;">%s</span>' %
+                ''.join(parts))
+
+    def summary(self):
+        return 'views: %d, renders: %d' % (len(self.views), self.renders)
+
+
+class CandidateWindow(object):
+    # Lookup tables of the contexts, cached page by page for the current
+    # revision of each table.  The agent only sends pages we do not have,
+    # so moving the cursor or flipping pages is drawn from the cache.
+    # Drawn in a popup where the editor has them (ST3), in the status bar
+    # otherwise.
+    def __init__(self):
+        self.tables = {}
+        self.pages = 0
+        self.renders = 0
+
+    def table(self, id_no, revision):
+        table = self.tables.get(id_no)
+        if table is None or table['revision'] != revision:
+            table = self.tables[id_no] = {
+                'revision': revision, 'pages': {}, 'cursor': 0,
+                'page_size': 0, 'count': 0, 'visible': False}
+        return table
+
+    def add_page(self, id_no, revision, page, candidates):
+        self.table(id_no, revision)['pages'][page] = candidates
+        self.pages += 1
+
+    def update(self, id_no, revision, cursor, page_size, count, visible):
+        table = self.table(id_no, revision)
+        table['cursor'] = cursor
+        table['page_size'] = page_size
+        table['count'] = count
+        table['visible'] = visible
+        self.render(id_no)
+
+    def set_visible(self, id_no, visible):
+        table = self.tables.get(id_no)
+        if table is not None:
+            table['visible'] = visible
+        self.render(id_no)
+
+    def render(self, id_no):
+        view = pool.view(id_no)
+        if view is None:
+            return
+        table = self.tables.get(id_no)
+        if table is None or not table['visible'] or not table['page_size']:
+            self.hide(view)
+            return
+        page, index = divmod(table['cursor'], table['page_size'])
+        candidates = table['pages'].get(page)
+        if candidates is None:
+            return  # still on its way
+        self.renders += 1
+        if not hasattr(view, 'show_popup'):
+            view.set_status('ibus_candidates', ' '.join(
+                ('[%d.%s]' if i == index else '%d.%s') % (i + 1, text)
+                for i, text in enumerate(candidates)))
+            return
+        lines = []
+        for i, text in enumerate(candidates):
+            line = '%d. %s' % (i + 1, escape_html(text))
+            if i == index:
+                line = '<b>%s</b>' % line
+            lines.append(line)
+        pages = (table['count'] + table['page_size'] - 1) // table['page_size']
+        if pages > 1:
+            lines.append('<small>%d/%d</small>' % (page + 1, pages))
+        content = '<br>'.join(lines)
+        if view.is_popup_visible():
+            view.update_popup(content)
+        else:
+            regions = view.get_regions('ibus_preedit')
+            location = regions[0].begin() if regions else view.sel()[0].begin()
+            view.show_popup(content, location=location)
+
+    def hide(self, view):
+        if hasattr(view, 'hide_popup'):
+            view.hide_popup()
+        else:
+            view.erase_status('ibus_candidates')
+
+    def reset(self):
+        for id_no in list(self.tables):
+            del self.tables[id_no]
+            self.render(id_no)
+
+    def summary(self):
+        return 'pages received: %d, drawn: %d' % (self.pages, self.renders)
+
+
+class SurroundingText(object):
+    # The agent keeps a copy of the text around the cursor of each context
+    # (see sublimeibus/surrounding.py).  Before keys are sent, the window
+    # is brought up to date with only the span that changed since the last
+    # push, and nothing is done when neither the buffer nor the selection
+    # changed.  Deletions asked for by the engine are applied to the buffer
+    # and to our copy, in one edit per batch.
+    def __init__(self, command):
+        self.command = command
+        settings = sublime.load_settings('SublimeIBus.sublime-settings')
+        self.enabled = settings.get('sublime_ibus_surrounding_text', False)
+        self.chars = settings.get('sublime_ibus_surrounding_text_chars', 256)
+        # context id -> our copy of the window the agent has, as a (text,
+        # cursor, anchor) tuple, and the view state it was taken from
+        self.windows = {}
+        # context id -> number of deletions the agent made, which our
+        # changes are based on
+        self.revisions = {}
+        self.full = 0
+        self.deltas = 0
+        self.skipped = 0
+        self.deletions = 0
+
+    def sync(self, view):
+        if not self.enabled:
+            return
+        id_no = pool.contexts.get(view.id())
+        if id_no is None or view.get_regions('ibus_preedit'):
+            return
+        sel = view.sel()
+        if len(sel) == 0:
+            return
+        anchor, cursor = sel[0].a, sel[0].b
+        state = (view.change_count(), anchor, cursor)
+        known = self.windows.get(id_no)
+        if known is not None and known['state'] == state:
+            self.skipped += 1
+            return
+        start, end = surrounding.window(cursor, view.size(), self.chars)
+        text = view.substr(sublime.Region(start, end))
+        cursor -= start
+        anchor = max(0, min(len(text), anchor - start))
+        revision = self.revisions.get(id_no, 0)
+        if known is not None and known['window'] == (text, cursor, anchor):
+            # e.g. a deletion by the engine, already in our copy
+            self.skipped += 1
+            pushed = True
+        elif known is None:
+            self.full += 1
+            pushed = self.command.push(
+                'set_surrounding_text(%d, %s, %d, %d, %d)' % (
+                    id_no, quote(text), cursor, anchor, revision),
+                droppable=True)
+        else:
+            first, last, changed = delta(known['window'][0], text)
+            self.deltas += 1
+            pushed = self.command.push(
+                'update_surrounding_text(%d, %d, %d, %d, %s, %d, %d)' % (
+                    id_no, revision, first, last, quote(changed),
+                    cursor, anchor), droppable=True)
+        # After a dropped change the agent's copy is unknown; the whole
+        # window is sent next time
+        if pushed:
+            self.windows[id_no] = {'window': (text, cursor, anchor),
+                                   'state': state}
+        else:
+            self.windows.pop(id_no, None)
+
+    def delete(self, id_no, revision, deletions):
+        view = pool.view(id_no)
+        if view is None:
+            return
+        self.deletions += 1
+        commit_collector.flush()
+        view.run_command('ibus_delete_surrounding', {'deletions': deletions})
+        self.revisions[id_no] = revision
+        known = self.windows.get(id_no)
+        if known is not None:
+            known['window'] = surrounding.replay(known['window'], deletions)
+            known['state'] = None
+
+    def resend(self, id_no):
+        # The agent lost track of our copy and wants the whole window
+        self.windows.pop(id_no, None)
+        view = pool.view(id_no)
+        if view is not None:
+            self.sync(view)
+
+    def forget(self, id_no):
+        self.windows.pop(id_no, None)
+        self.revisions.pop(id_no, None)
+
+    def reset(self):
+        self.windows = {}
+        self.revisions = {}
+
+    def summary(self):
+        return 'full: %d, deltas: %d, unchanged: %d, deletions: %d' % (
+            self.full, self.deltas, self.skipped, self.deletions)
+
+
 class WindowLayout:
     def __init__(self):
         self.window_id = None
+        # window id -> cached group layout of that window
+        self.models = {}
         self.load_settings()
 
     def load_settings(self):
@@ -116,86 +881,99 @@ class WindowLayout:
     def get_setting(self, key, default=None):
         return self.settings.get(key, default)
 
-    def cursor_location(self):
-        if self.window_id is None:
-            return [0, 0]
-
-        cmd = ['xwininfo',
-               '-display', os.environ.get('DISPLAY'),
-               '-id', self.window_id]
-        env = {'PATH': os.environ.get('PATH', '')}
-        out, err = subprocess.Popen(cmd,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    env=env).communicate()
-        output = out.decode('utf-8')
-        if err != b'':
-            logger.debug(err)
-            return [0, 0]
-        m = re.search('Absolute upper-left X:\s*(\d+)', output)
-        x_pos = m.group(1)
-        m = re.search('Absolute upper-left Y:\s*(\d+)', output)
-        y_pos = m.group(1)
-        m = re.search('Width:\s*(\d+)', output)
-        width = m.group(1)
-        # logger.debug('window position x: ' + x_pos + ", y: " + y_pos + ", width: " + width)
-
-        window = self.window = sublime.active_window()
-        view = self.view = window.active_view()
-        layout = window.get_layout()
-        cols = len(layout['cols']) - 1
-        g2d = self.make_list2d(self.get_group_list(window), cols)
+    def cursor_location(self, cached_only=False):
+        # The agent pushes (left, top, width) of watched X windows whenever
+        # they change, so nothing needs to be queried here.
+        geometry = status.geometries.get(self.window_id)
+        if geometry is None:
+            return None
+        x_pos, y_pos, width = geometry
+
+        window = sublime.active_window()
+        view = window.active_view()
+        model = self.get_model(window, view, cached_only)
+        group, _ = window.get_view_index(view)
+        group_left, group_top = model['grid'].offset(group)
+        side_bar = width - model['grid'].total_width()
+        tabs = model['metrics']['tabs']
+
         cursor = view.text_to_layout(view.sel()[0].a)
         viewport = view.viewport_position()
-        all_views_width = sum(self.calc_group_offset_width(g2d, cols))
-        side_bar = int(width) - all_views_width
-
-        offset = self.calc_offset(window, view)
+        view_left = sum(self.calc_view_width_offset(view)) + cursor[0] - viewport[0]
+        view_top = (tabs['height'] if tabs['visible'] else 0) + cursor[1] - viewport[1]
 
         offset_x = self.get_setting('sublime_ibus_offset_x')
         offset_y = self.get_setting('sublime_ibus_offset_y')
 
-        left = offset_x + sum(offset[0]) + cursor[0] - viewport[0] + int(x_pos) + side_bar
-        top = offset_y + sum(offset[1]) + cursor[1] - viewport[1] + int(y_pos)
-        return [left, top]
-
-    def make_list2d(self, lst, cols):
-        assert (len(lst) % cols) == 0
-        return [lst[i * cols:(i + 1) * cols] for i in range(len(lst) // cols)]
-
-    def get_group_list(self, window):
-        return [window.active_view_in_group(g) for g in range(window.num_groups())]
+        left = offset_x + group_left + view_left + x_pos + side_bar
+        top = offset_y + group_top + view_top + y_pos
+        return [left, top, view]
 
-    def calc_group_offset_width(self, g2d, group_col):
-        r = len(g2d)
-        ret = []
-        for x in range(group_col):
-            for y in range(r):
-                if g2d[y][x] is not None:
-                    ret += self.calc_view_width(g2d, y, x)
-                    break
-            else:
-                logger.debug('WindowLayout.calc_group_offset_width: there is empty view.')
-        return ret
-
-    def calc_view_width(self, g2d, row, col):
-        view = self.view
-        minimap = self.minimap_status()
-        return self.calc_view_width_offset(g2d[row][col]) + [
-            view.viewport_extent()[0],
+    def get_model(self, window, view, cached_only=False):
+        layout = window.get_layout()
+        entry = metrics.get(window, view, cached_only)
+        model = self.models.get(window.id())
+        if cached_only:
+            if model is None or model['layout'] != layout \
+                    or model['metrics'] is not entry or model['dirty']:
+                raise CacheMiss()
+            return model
+        if model is None or model['layout'] != layout \
+                or model['metrics'] is not entry:
+            model = {'layout': layout,
+                     'metrics': entry,
+                     'grid': GroupLayout(layout),
+                     'digits': {},
+                     'dirty': set(range(len(layout['cells'])))}
+            self.models[window.id()] = model
+        while model['dirty']:
+            self.measure_group(window, model, model['dirty'].pop())
+        return model
+
+    def measure_group(self, window, model, group):
+        view = window.active_view_in_group(group)
+        if view is None:
+            logger.debug('WindowLayout.measure_group: there is empty view.')
+            model['grid'].set_group_size(group, None, None)
+            return
+        minimap = model['metrics']['minimap']
+        tabs = model['metrics']['tabs']
+        hscroll_bar = self.hscroll_bar_status(view)
+        extent = view.viewport_extent()
+        width = sum(self.calc_view_width_offset(view) + [
+            extent[0],
             (minimap['width'] if minimap['visible'] else 0),
             self.get_setting('sublime_ibus_view_right_vscroll_width')
-            ]
+            ])
+        height = sum([
+            (tabs['height'] if tabs['visible'] else 0),
+            extent[1],
+            (hscroll_bar['height'] if hscroll_bar['visible'] else 0)
+            ])
+        model['digits'][view.id()] = self.line_digits(view)
+        model['grid'].set_group_size(group, width, height)
 
-    def minimap_status(self):
-        window = self.window
-        view = self.view
-        extent1 = view.viewport_extent()
-        window.run_command('toggle_minimap')
-        extent2 = view.viewport_extent()
-        window.run_command('toggle_minimap')
-        diff = extent2[0] - extent1[0]
-        return {'visible': diff > 0, 'width': abs(diff)}
+    def invalidate(self):
+        self.models = {}
+
+    def invalidate_view(self, view):
+        window = view.window()
+        if window is None:
+            return
+        model = self.models.get(window.id())
+        if model is not None:
+            group, _ = window.get_view_index(view)
+            if group >= 0:
+                model['dirty'].add(group)
+
+    def on_modified(self, view):
+        # Only a change in the number of line-number digits moves the
+        # groups to the right of the view
+        window = view.window()
+        model = window and self.models.get(window.id())
+        if model is not None and view.id() in model['digits'] \
+                and model['digits'][view.id()] != self.line_digits(view):
+            self.invalidate_view(view)
 
     def calc_view_width_offset(self, view):
         left_width = self.get_setting('sublime_ibus_view_left_icon_width')
@@ -212,58 +990,15 @@ class WindowLayout:
         return {'visible': visible, 'width': width, 'mode': 'calc'}
 
     def calc_line_numbers_width(self, view):
+        return self.line_digits(view) * view.em_width()
+
+    def line_digits(self, view):
         lines, _ = view.rowcol(view.size())
-        c = self.get_number_column(lines + 1)
-        return c * view.em_width()
+        return self.get_number_column(lines + 1)
 
     def get_number_column(self, n):
         return int(math.log10(n)) + 1
 
-    def calc_offset(self, window, view):
-        self.tabs = self.tabs_status(window, view)
-
-        group, _ = window.get_view_index(view)
-        layout = window.get_layout()
-        _, c = self.get_layout_rowcol(layout)
-
-        g2d = self.make_list2d(self.get_group_list(window), c)
-        row, col = self.get_group_rowcol(layout, group)
-
-        offset = [[], []]
-        offset[0] += self.calc_group_offset_width(g2d, col)
-        offset[1] += self.calc_group_offset_height(g2d, row)
-        offset[0] += self.calc_view_width_offset(view)
-        offset[1] += self.calc_view_height_offset(view)
-        return offset
-
-    def get_layout_rowcol(self, layout):
-        c = len(layout['cols']) - 1
-        r = len(layout['rows']) - 1
-        return (r, c)
-
-    def get_group_rowcol(self, layout, group):
-        c = len(layout['cols']) - 1
-        return (group // c, group % c)
-
-    def calc_group_offset_height(self, g2d, group_row):
-        c = len(g2d[0])
-        ret = []
-        for y in range(group_row):
-            for x in range(c):
-                if g2d[y][x] is not None:
-                    ret += self.calc_view_height(g2d[y][x])
-                    break
-            else:
-                logger.debug('WindowLayout.calc_group_offset_height: there is empty view.')
-        return ret
-
-    def calc_view_height(self, view):
-        hscroll_bar = self.hscroll_bar_status(view)
-        return self.calc_view_height_offset(view) + [
-            view.viewport_extent()[1],
-            (hscroll_bar['height'] if hscroll_bar['visible'] else 0)
-            ]
-
     def hscroll_bar_status(self, view):
         word_wrap = view.settings().get('word_wrap')
         extent = view.viewport_extent()
@@ -275,22 +1010,87 @@ class WindowLayout:
             # 'diff': self.hscroll_bar_diff(view),
             }
 
-    def calc_view_height_offset(self, view):
-        return [self.tabs['height'] if self.tabs['visible'] else 0]
+class WindowMetrics(object):
+    # The minimap width and the tab bar height can only be found by toggling
+    # them and comparing viewport extents, which forces a relayout and a
+    # redraw.  They are measured once per window and reused until the
+    # layout, the font or the theme changes, or a view's extent changes
+    # without a layout change (e.g. the user toggled the minimap).
+    font_settings = ['font_face', 'font_size', 'font_options', 'theme',
+                     'line_padding_top', 'line_padding_bottom']
+
+    def __init__(self):
+        self.windows = {}
+        self.probes = 0
+        prefs = sublime.load_settings('Preferences.sublime-settings')
+        self.prefs = prefs
+        self.font = self.font_key()
+        prefs.add_on_change('sublime_ibus_metrics', self.on_preferences_changed)
+
+    def font_key(self):
+        return [self.prefs.get(key) for key in self.font_settings]
+
+    def on_preferences_changed(self):
+        font = self.font_key()
+        if font != self.font:
+            self.font = font
+            self.invalidate()
+
+    def invalidate(self, window=None):
+        if window is None:
+            self.windows = {}
+        else:
+            self.windows.pop(window.id(), None)
 
-    def tabs_status(self, window, view):
+    def get(self, window, view, cached_only=False):
+        entry = self.windows.get(window.id())
+        layout = window.get_layout()
+        extent = view.viewport_extent()
+        if cached_only:
+            if entry is None or entry['layout'] != layout \
+                    or entry['extents'].get(view.id()) != extent:
+                raise CacheMiss()
+            return entry
+        if entry is not None and entry['layout'] == layout:
+            known = entry['extents'].setdefault(view.id(), extent)
+            if known == extent:
+                return entry
+        entry = self.measure(window, view)
+        entry['layout'] = layout
+        entry['extents'] = {view.id(): view.viewport_extent()}
+        self.windows[window.id()] = entry
+        return entry
+
+    def measure(self, window, view):
+        self.probes += 1
+        logger.debug('WindowMetrics.measure: window %d (%d probes)' %
+                     (window.id(), self.probes))
+        return {'minimap': self.probe(window, view, 'toggle_minimap', 0),
+                'tabs': self.probe(window, view, 'toggle_tabs', 1)}
+
+    def probe(self, window, view, toggle, axis):
         extent1 = view.viewport_extent()
-        window.run_command('toggle_tabs')
+        window.run_command(toggle)
         extent2 = view.viewport_extent()
-        window.run_command('toggle_tabs')
-        diff = extent2[1] - extent1[1]
-        return {'visible': diff > 0, 'height': abs(diff)}
+        window.run_command(toggle)
+        diff = extent2[axis] - extent1[axis]
+        key = 'width' if axis == 0 else 'height'
+        result = {'visible': diff > 0}
+        result[key] = abs(diff)
+        return result
 
 
 class IBusCallback(object):
+    def __init__(self):
+        # command name -> bound method, built once
+        self.handlers = {}
+        for name in dir(self):
+            if not name.startswith('_') and name not in ('execute', 'handlers'):
+                self.handlers[name] = getattr(self, name)
+
     def execute(self, command, args):
-        if hasattr(self, command):
-            cb = getattr(self, command)
+        cb = self.handlers.get(command)
+        if cb is not None:
             if isinstance(args, list):
                 cb(*args)
             elif isinstance(args, dict):
@@ -307,8 +1107,38 @@ class IBusCallback(object):
         pass
 
     def ibus_create_imcontext_cb(self, id_no):
-        status.id_no = id_no
-        command.setup2()
+        view = pool.created_cb(id_no)
+        if view is not None and status.id_no < 0 and \
+                status.view is not None and status.view.id() == view.id():
+            command.activate(view)
+
+    def ibus_window_geometry_cb(self, window_id, left, top, width):
+        status.geometries[window_id] = (left, top, width)
+        layout = command.window_layout
+        if layout is not None and layout.window_id == window_id \
+                and status.enable:
+            command.set_cursor_location()
+
+    def ibus_active_window_cb(self, window_id, wm_class):
+        # Other applications' windows become active as well; only follow
+        # the editor's own windows.
+        if wm_class is None or 'sublime' not in wm_class.lower():
+            return
+        if window_id != status.active_window_id:
+            status.active_window_id = window_id
+            command.update_window(window_id)
+
+    def ibus_agent_restarted_cb(self):
+        # A new agent took over with the same contexts, engines and focus,
+        # but none of their preedit, candidates or surrounding text
+        logger.debug('agent restarted')
+        for view in list(pool.views.values()):
+            if view.get_regions('ibus_preedit'):
+                inline_preedit.clear(view)
+        candidate_window.reset()
+        surrounding_text.reset()
+        cursor_updater.reset()
+        pool.restarted()
 
     def ibus_start_focus_observation_cb(self, id):
         pass
@@ -319,49 +1149,138 @@ class IBusCallback(object):
     def ibus_redo_focus_in_cb(self):
         pass
 
+    def ibus_list_active_engines_cb(self, engines):
+        status.engines = engines
+
     def ibus_status_changed_cb(self, id_no, engine_name):
+        if pool.view(id_no) is None:
+            return
+        pool.engines[id_no] = engine_name
         enable = engine_name is not None
-        status.set_status(enable, None, engine_name)
+        if id_no != status.id_no:
+            # Shown when its view is activated again
+            pool.view(id_no).settings().set('ibus_mode', enable)
+            return
+        status.set_status(enable, pool.view(id_no), engine_name)
         if enable:
+            cursor_updater.reset()
+            if command.window_layout is not None:
+                command.window_layout.invalidate()
             command.set_cursor_location()
 
-    def ibus_query_surrounding_text_cb(self, id_no, keyval, modmask, backslash, pressed):
-        pass
-
-    def ibus_update_preedit_text_cb(self, id_no, text, cursor_pos, visible, attributes):
-        pass
+    def ibus_stats_cb(self, rows):
+        print('SublimeIBus agent: %-30s %6s %10s %6s %6s' % (
+            'command', 'calls', 'ms', 'X req', 'D-Bus'))
+        for row in rows:
+            print('SublimeIBus agent: %-30s %6d %10.3f %6d %6d' % tuple(row))
+
+    def ibus_profile_cb(self, report):
+        print(report)
+        sublime.status_message('SublimeIBus: profile written to the console')
+
+    def ibus_query_surrounding_text_cb(self, id_no):
+        surrounding_text.resend(id_no)
+
+    def ibus_delete_surrounding_text_cb(self, id_no, revision, deletions):
+        surrounding_text.delete(id_no, revision, deletions)
+
+    def ibus_update_preedit_cb(self, id_no, start, end, text, cursor_pos,
+                               attributes):
+        view = pool.view(id_no)
+        if view is not None:
+            commit_collector.flush()
+            inline_preedit.update(view, start, end, text, cursor_pos,
+                                  attributes)
+            command.set_cursor_location()
 
     def ibus_commit_text_cb(self, id_no, text):
-        if status.view is not None:
-            status.view.run_command('ibus_insert', {"text": text})
-            command.set_cursor_location()
+        # Text is committed while IBus processes a key, i.e. before that
+        # key is replied to.  Its latency is recorded once it is inserted.
+        event = None
+        if status.pending_keys and not status.pending_keys[0].committed:
+            event = status.pending_keys[0]
+            event.committed = True
+        # e.g. preedit committed on focus_out goes to the view left behind
+        self._commit_text(text, pool.view(id_no), event)
+
+    def _commit_text(self, text, view=None, event=None):
+        if view is None:
+            view = status.view
+        if view is not None:
+            # The agent forgets the preedit on commit as well
+            if view.get_regions('ibus_preedit'):
+                commit_collector.flush()
+                inline_preedit.clear(view)
+            commit_collector.add(view, text, event)
 
-    def ibus_hide_preedit_text_cb(self, id_no):
-        pass
+    def ibus_lookup_table_page_cb(self, id_no, revision, page, candidates):
+        candidate_window.add_page(id_no, revision, page, candidates)
+
+    def ibus_update_lookup_table_cb(self, id_no, revision, cursor_pos,
+                                    page_size, count, visible):
+        candidate_window.update(id_no, revision, cursor_pos, page_size,
+                                count, visible)
+
+    def ibus_show_lookup_table_cb(self, id_no):
+        candidate_window.set_visible(id_no, True)
 
-    def ibus_process_key_event_cb(self, id_no, handled):
+    def ibus_hide_lookup_table_cb(self, id_no):
+        candidate_window.set_visible(id_no, False)
+
+    def ibus_hide_preedit_text_cb(self, id_no):
+        view = pool.view(id_no)
+        if view is not None:
+            commit_collector.flush()
+            inline_preedit.clear(view)
+
+    def ibus_process_key_event_cb(self, id_no, handled, stamps=None,
+                                  keyval=None):
+        pending = status.pending_keys
+        # Replies name their key; keys ahead of it have lost their reply
+        if keyval is not None:
+            for skipped, event in enumerate(pending):
+                if event.keysym == keyval:
+                    break
+            else:
+                logger.debug('reply to an unknown key: %d' % keyval)
+                return
+            for i in range(skipped):
+                logger.debug('no reply to key: ' + pending.popleft().key)
+        if not pending:
+            return
+        replied = time.time()
+        event = pending.popleft()
+        key = event.key
         if handled == 0:
-            settings = sublime.load_settings('SublimeIBusFallBackCommand.sublime-settings')
-            cmd = settings.get(status.key)
+            cmd = key_registry.fallback(key)
             if cmd is not None:
-                status.view.run_command(cmd.get('command', None),
-                                        cmd.get('args', None))
-            elif len(status.key) == 1:
-                self.ibus_commit_text_cb(id_no, status.key)
-
-    def ibus_forward_key_event_cb(self, id_no, keyval, modifiers, is_released):
-        # Workaround for ibus-bogo as it uses fake backspaces instead of
-        # pre-editting.
-        #
-        # TODO This should be handled in a similar fashion to the unhandled case
-        # in `ibus_process_key_event_cb`. We also need a reverse lookup table of
-        # SublimeIBusKeyTable.sublime-settings.
-        if keyval == 65288:  # backspace
-            status.view.run_command('left_delete')
+                commit_collector.flush()
+                event.view.run_command(cmd.get('command', None),
+                                       cmd.get('args', None))
+            elif len(key) == 1:
+                self._commit_text(key, event.view)
+        latency.record_key(event, stamps, replied, time.time())
+
+    def ibus_forward_key_event_cb(self, id_no, keyval, modifiers, pressed):
+        # Engines such as ibus-bogo forward fake key events (e.g. backspaces)
+        # instead of pre-editing.  They are handled like unhandled keys.
+        if not pressed:
+            return
+        view = pool.view(id_no) or status.view
+        table = key_registry.table
+        cmd = table.command(keyval)
+        if cmd is not None:
+            commit_collector.flush()
+            view.run_command(cmd.get('command', None), cmd.get('args', None))
+            return
+        key = table.name(keyval)
+        if key is not None and len(key) == 1:
+            self._commit_text(key, view)
 
 
 class IbusToggleCommand(sublime_plugin.TextCommand):
     def run(self, edit):
+        command.activate(self.view)
         command.set_status(not status.enable)
         # logger.debug('enable = ' + str(enable))
 
@@ -369,48 +1288,82 @@ class IbusToggleCommand(sublime_plugin.TextCommand):
 class IbusCycleCommand(sublime_plugin.TextCommand):
     def run(self, edit):
         logger.debug("next_engine()")
+        command.activate(self.view)
         command.next_engine()
 
 
 class IbusKeyCommand(sublime_plugin.TextCommand):
-    def __init__(self, view):
-        super(IbusKeyCommand, self).__init__(view)
-        self.table = sublime.load_settings('SublimeIBusKeyTable.sublime-settings')
-
     def run(self, edit, key, alt=False, ctrl=False, shift=False, super=False):
-        if self.view.settings().get('is_widget'):
+        # Keys without a context would never be replied to
+        if self.view.settings().get('is_widget') or status.id_no < 0:
             return
 
-        keysym = self.table.get(key, None)
+        keysym = key_registry.keysym(key)
         if keysym is not None:
-            status.key = key
-            command.process_key(keysym)
+            event = KeyEvent(key, self.view, keysym)
+            status.pending_keys.append(event)
+            key_collector.add(event, keysym)
+
+
+class IbusStatsCommand(sublime_plugin.WindowCommand):
+    def run(self, reset=False):
+        lines = latency.dump() + [
+            'SublimeIBus cursor location: ' + cursor_updater.summary(),
+            'SublimeIBus window metrics probes: %d' % metrics.probes,
+            'SublimeIBus input contexts: ' + pool.summary(),
+            'SublimeIBus candidates: ' + candidate_window.summary(),
+            'SublimeIBus inline preedit: ' + inline_preedit.summary(),
+            'SublimeIBus surrounding text: ' + surrounding_text.summary(),
+            'SublimeIBus commits: ' + commit_collector.summary(),
+            'SublimeIBus writer: ' + agent.writer_summary(),
+            'SublimeIBus agent failovers: %d' % agent.failovers,
+            ]
+        for line in lines:
+            print(line)
+        if reset:
+            latency.reset()
+        # The agent's own table follows when it answers
+        command.push('stats(%s)' % bool(reset))
+        sublime.status_message('SublimeIBus: statistics written to the console')
+
+
+class IbusProfileCommand(sublime_plugin.WindowCommand):
+    def run(self, stop=False):
+        if stop:
+            command.push('profile_stop()')
+        else:
+            command.push('profile_start()')
+            sublime.status_message('SublimeIBus: profiling the agent')
 
 
 class IbusListener(sublime_plugin.EventListener):
     def on_activated(self, view):
         status.view = view
+        if not view.settings().get('is_widget'):
+            command.activate(view)
+        if command.window_layout is not None:
+            command.window_layout.invalidate_view(view)
+        # The agent keeps status.active_window_id up to date
+        command.update_window(status.active_window_id)
+
+    def on_close(self, view):
+        command.close(view)
+
+    def on_window_command(self, window, command_name, args):
+        if command_name in ('toggle_minimap', 'toggle_tabs', 'toggle_side_bar',
+                            'set_layout', 'toggle_full_screen',
+                            'toggle_distraction_free'):
+            metrics.invalidate(window)
+
+    def on_modified(self, view):
+        if status.enable and command.window_layout is not None:
+            command.window_layout.on_modified(view)
 
-        # get active X Window ID
-        cmd = ['xprop', '-root', '_NET_ACTIVE_WINDOW']
-        env = {'PATH': os.environ.get('PATH', ''),
-               'DISPLAY': os.environ.get('DISPLAY')}
-        out, err = subprocess.Popen(cmd,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE,
-                                    env=env).communicate()
-        if err == b'':
-            m = re.search('(0x[\da-f]+)', out.decode('utf-8'))
-            window_id = m.group(1)
-            # logger.debug(window_id)
-            if command.window_layout is None:
-                command.window_layout = WindowLayout()
-            command.window_layout.window_id = window_id
+    def on_selection_modified(self, view):
+        if not ASYNC_EVENTS and status.enable:
             command.set_cursor_location()
-        else:
-            logger.debug(err)
 
-    def on_selection_modified(self, view):
+    def on_selection_modified_async(self, view):
         if status.enable:
             command.set_cursor_location()
 
@@ -420,33 +1373,70 @@ class IbusListener(sublime_plugin.EventListener):
 
 
 class IbusInsertCommand(sublime_plugin.TextCommand):
+    # Like typing: every selection is replaced by the text, last first so
+    # the earlier ones stay where they are
     def run(self, edit, text):
-        self.view.insert(edit, self.view.sel()[0].a, text)
+        view = self.view
+        for region in reversed([region for region in view.sel()]):
+            if not region.empty():
+                view.erase(edit, region)
+            view.insert(edit, region.begin(), text)
+
+
+class IbusDeleteSurroundingCommand(sublime_plugin.TextCommand):
+    # deletions are [offset, n_chars] from the cursor, applied in order
+    def run(self, edit, deletions):
+        view = self.view
+        region = view.sel()[0]
+        cursor = region.b
+        for offset, n_chars in deletions:
+            start = max(0, min(view.size(), cursor + offset))
+            end = max(start, min(view.size(), cursor + offset + n_chars))
+            view.erase(edit, sublime.Region(start, end))
+            if cursor >= end:
+                cursor -= end - start
+            elif cursor > start:
+                cursor = start
+        view.sel().clear()
+        view.sel().add(sublime.Region(cursor))
 
 
 def proc_callback(cmdobj):
     if 'message' in cmdobj:
         logger.debug('message: ' + cmdobj['message'])
     elif 'command' in cmdobj:
-        IBusCallback().execute(cmdobj['command'], cmdobj['args'])
+        callback.execute(cmdobj['command'], cmdobj['args'])
     else:
-        assert False
+        logger.debug('unknown message: ' + repr(cmdobj))
 
 
+# Messages arrive already parsed by the reader thread
 def on_data(data):
-    if data.find('{') != 0:
-        logger.debug('message: ' + data)
+    if isinstance(data, dict):
+        proc_callback(data)
     else:
-        try:
-            proc_callback(json.loads(data))
-        except ValueError as e:
-            logger.debug('error: ' + str(e))
-            logger.debug(repr(data))
+        logger.debug('message: ' + data)
 
 
+callback = IBusCallback()
 agent.register_callback(on_data)
-agent.restart(join(BASE_PATH, 'sublimeibus'))
+# A shared agent daemon survives plugin reloads and serves every editor.
+# A private agent has a standby that takes over when it exits.
+agent_settings = sublime.load_settings('SublimeIBus.sublime-settings')
+agent.restart(join(BASE_PATH, 'sublimeibus'),
+              agent_settings.get('sublime_ibus_agent_daemon', True),
+              agent_settings.get('sublime_ibus_agent_standby', True))
 
 status = IBusStatus()
+latency = LatencyStats()
+metrics = WindowMetrics()
+key_registry = KeyRegistry()
 command = IBusCommand(agent)
+pool = ContextPool(command)
+candidate_window = CandidateWindow()
+inline_preedit = InlinePreedit()
+surrounding_text = SurroundingText(command)
+cursor_updater = CursorLocationUpdater(command)
+key_collector = KeyCollector(command)
+commit_collector = CommitCollector(command)
 command.setup()